@@ -0,0 +1 @@
+from gdc_client.cache import parser
@@ -0,0 +1,46 @@
+import logging
+from functools import partial
+
+from gdc_client.query.cache import MetadataCache
+
+logger = logging.getLogger("gdc-client")
+
+
+def invalidate(parser, args):
+    """Remove cached metadata, of the given files or all of it."""
+    if not args.metadata_cache:
+        parser.error("no metadata cache configured, use --metadata-cache")
+
+    cache = MetadataCache(args.metadata_cache)
+    try:
+        removed = cache.invalidate(args.file_ids or None)
+    finally:
+        cache.close()
+
+    logger.info("Removed {0} cached entries".format(removed))
+
+
+def config(parser, download_defaults):
+    """Configure a parser for managing the metadata cache."""
+    choices = parser.add_subparsers(title="Cache actions", dest="action")
+    choices.required = True
+
+    invalidate_choice = choices.add_parser(
+        "invalidate", help="Remove cached file metadata and versions"
+    )
+    invalidate_choice.set_defaults(
+        func=partial(invalidate, invalidate_choice),
+        metadata_cache=download_defaults.get("metadata_cache"),
+    )
+    invalidate_choice.add_argument(
+        "--metadata-cache",
+        dest="metadata_cache",
+        metavar="FILE",
+        help="The metadata cache file, defaults to the download setting",
+    )
+    invalidate_choice.add_argument(
+        "file_ids",
+        metavar="file_id",
+        nargs="*",
+        help="The GDC UUID of the file(s) to forget, all of them if none given",
+    )
@@ -5,10 +5,22 @@ from configparser import ConfigParser, NoOptionError, NoSectionError
 
 from gdc_client.defaults import (
     processes,
+    ENGINE,
     USER_DEFAULT_CONFIG_LOCATION,
     HTTP_CHUNK_SIZE,
+    MAX_HTTP_CHUNK_SIZE,
+    MIN_HTTP_CHUNK_SIZE,
+    MAX_BANDWIDTH,
+    MAX_REQUEST_RATE,
+    METADATA_CACHE_SIZE,
+    METADATA_CACHE_TTL,
+    PREPARE_AHEAD,
     SAVE_INTERVAL,
+    SMALL_FILE_SIZE,
+    STORAGE,
+    BUNDLE_SIZE,
     UPLOAD_PART_SIZE,
+    WRITE_METHOD,
 )
 
 log = logging.getLogger("gdc-client")
@@ -34,10 +46,27 @@ class GDCClientConfigShared(object):
     setting_getters = {
         "server": ConfigParser.get,
         "http_chunk_size": ConfigParser.getint,
+        "min_http_chunk_size": ConfigParser.getint,
+        "max_http_chunk_size": ConfigParser.getint,
         "upload_part_size": ConfigParser.getint,
         "save_interval": ConfigParser.getint,
+        "small_file_size": ConfigParser.getint,
+        "bundle_size": ConfigParser.getint,
+        "write_method": ConfigParser.get,
+        "storage": ConfigParser.get,
         "dir": ConfigParser.get,
         "n_processes": ConfigParser.getint,
+        "concurrent_files": ConfigParser.getint,
+        "concurrent_groups": ConfigParser.getint,
+        "prepare_ahead": ConfigParser.getint,
+        "engine": ConfigParser.get,
+        "max_bandwidth": ConfigParser.getint,
+        "max_request_rate": ConfigParser.getfloat,
+        "limits_file": ConfigParser.get,
+        "metadata_cache": ConfigParser.get,
+        "metadata_cache_ttl": ConfigParser.getfloat,
+        "metadata_cache_size": ConfigParser.getint,
+        "offline": ConfigParser.getboolean,
         "retry_amount": ConfigParser.getint,
         "wait_time": ConfigParser.getfloat,
         "no_segment_md5sums": ConfigParser.getboolean,
@@ -46,6 +75,7 @@ class GDCClientConfigShared(object):
         "no_related_files": ConfigParser.getboolean,
         "no_annotations": ConfigParser.getboolean,
         "no_auto_retry": ConfigParser.getboolean,
+        "no_run_journal": ConfigParser.getboolean,
         "insecure": ConfigParser.getboolean,
         "disable_multipart": ConfigParser.getboolean,
         "path": ConfigParser.get,
@@ -72,12 +102,28 @@ class GDCClientConfigShared(object):
                 "dir": ".",
                 "save_interval": SAVE_INTERVAL,
                 "http_chunk_size": HTTP_CHUNK_SIZE,
+                "min_http_chunk_size": MIN_HTTP_CHUNK_SIZE,
+                "max_http_chunk_size": MAX_HTTP_CHUNK_SIZE,
+                "small_file_size": SMALL_FILE_SIZE,
+                "bundle_size": BUNDLE_SIZE,
+                "write_method": WRITE_METHOD,
+                "storage": STORAGE,
+                "concurrent_files": 1,
+                "concurrent_groups": 4,
+                "prepare_ahead": PREPARE_AHEAD,
+                "engine": ENGINE,
+                "max_bandwidth": MAX_BANDWIDTH,
+                "max_request_rate": MAX_REQUEST_RATE,
+                "metadata_cache_ttl": METADATA_CACHE_TTL,
+                "metadata_cache_size": METADATA_CACHE_SIZE,
+                "offline": False,
                 "no_segment_md5sums": False,
                 "no_file_md5sum": False,
                 "no_verify": False,
                 "no_related_files": False,
                 "no_annotations": False,
                 "no_auto_retry": False,
+                "no_run_journal": False,
                 "retry_amount": 1,
                 "wait_time": 5.0,
                 "latest": False,
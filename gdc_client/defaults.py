@@ -21,9 +21,31 @@ tcp_url = "https://api.gdc.cancer.gov/"
 
 # The number of processes used to download data files
 processes = min(cpu_count(), 8)
+# Run download workers as "processes" or "threads"
+ENGINE = "processes"
 
 HTTP_CHUNK_SIZE = 1024 * 1024  # 1 MB
-SAVE_INTERVAL = 1024 * 1024 * 1024  # 1 GiB
+# Bounds of the chunk size each connection tunes from its throughput
+MIN_HTTP_CHUNK_SIZE = 256 * 1024  # 256 KiB
+MAX_HTTP_CHUNK_SIZE = 32 * 1024 * 1024  # 32 MiB
+SAVE_INTERVAL = 64 * 1024 * 1024  # 64 MiB
+# Files probed and preallocated in the background while earlier files download
+PREPARE_AHEAD = 4
+# Files up to SMALL_FILE_SIZE are downloaded in tarfile groups of about
+# BUNDLE_SIZE bytes
+SMALL_FILE_SIZE = 1024 * 1024  # 1 MiB
+BUNDLE_SIZE = 16 * 1024 * 1024  # 16 MiB
+# How downloaded chunks are written to disk, see gdc_client.parcel.const
+WRITE_METHOD = "pwrite" if hasattr(os, "pwrite") else "offset"
+# How partial files are allocated, "auto" chooses by filesystem type
+STORAGE = "auto"
+# Bandwidth (bytes/s) and request rate (requests/s) limits, 0 is unlimited
+MAX_BANDWIDTH = 0
+MAX_REQUEST_RATE = 0.0
+# Metadata cache entries expire after METADATA_CACHE_TTL seconds, the least
+# recently used are evicted beyond METADATA_CACHE_SIZE entries
+METADATA_CACHE_TTL = 24 * 60 * 60  # 1 day
+METADATA_CACHE_SIZE = 100000
 # Part size for multipart uploads
 UPLOAD_PART_SIZE = 1024 * 1024 * 1024  # 1 GiB
 
@@ -1,18 +1,21 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import hashlib
-from io import BytesIO
 import logging
 import os
 import re
 import requests
+import shutil
 import tarfile
 import time
 from urllib import parse as urlparse
 
-from gdc_client.parcel import HTTPClient, utils
+from gdc_client.parcel import HTTPClient, governor
 from gdc_client.parcel.download_stream import DownloadStream
 from gdc_client.parcel.utils import get_percentage_pbar
 
 from gdc_client.defaults import SUPERSEDED_INFO_FILENAME_TEMPLATE
+from gdc_client.query.index import EndpointStats
 from gdc_client.utils import build_url
 
 log = logging.getLogger("gdc-download")
@@ -34,9 +37,39 @@ def fix_url(url):
     return url
 
 
+def _write_file(path, data):
+    # type: (str, bytes) -> None
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+def _column(line, index):
+    # type: (bytes, int) -> bytes
+    """The value of a column of a tab separated line"""
+    values = line.rstrip(b"\r\n").split(b"\t")
+    return values[index] if index < len(values) else b""
+
+
+class _ThrottledReader(object):
+    """File-like wrapper of a response body that draws from the governor"""
+
+    def __init__(self, raw):
+        self.raw = raw
+
+    def read(self, size=-1):
+        data = self.raw.read(size)
+        governor.throttle_bytes(len(data))
+        return data
+
+
 class GDCHTTPDownloadClient(HTTPClient):
 
     annotation_name = "annotations.txt"
+    # annotation ids per annotations request
+    annotation_batch_size = 500
+    # members up to this size are written by a pool of writer threads
+    tiny_member_size = 1024 * 1024
+    tar_writer_threads = 4
 
     def __init__(
         self,
@@ -53,6 +86,7 @@ class GDCHTTPDownloadClient(HTTPClient):
             download_related_files (bool):
             download_annotations (bool):
             index_client (gdc_client.query.index.GDCIndexClient): gdc api files index client
+            concurrent_groups (int): number of small file groups to download at once
         """
 
         self.base_uri = uri
@@ -64,74 +98,143 @@ class GDCHTTPDownloadClient(HTTPClient):
         self.md5_check = kwargs.get("file_md5sum")
 
         self.gdc_index_client = index_client
+        # shared with the index client, so what the metadata lookups learned
+        # about the endpoints carries over to the data requests
+        self.endpoint_stats = (
+            index_client.endpoint_stats if index_client else EndpointStats()
+        )
         self.base_directory = kwargs.get("directory")
         self.verify = kwargs.get("verify")
+        self.concurrent_groups = max(1, kwargs.get("concurrent_groups", 1))
+        # related file urls of the files being downloaded, and the primary
+        # files each belongs to
+        self._related_owners = {}
+        # related file urls of each primary file
+        self._related_urls = {}
+        # primary files with related files that verified, recorded in the
+        # run journal once their related files are linked
+        self._unrecorded = {}
+        # streams of the files being downloaded, by url
+        self._streams = {}
+        # optional. gdc_client.download.journal.RunJournal of verified files
+        self.run_journal = kwargs.get("run_journal")
 
         super(GDCHTTPDownloadClient, self).__init__(self.data_uri, *args, **kwargs)
 
-    def download_related_files(self, file_id):
+    def download_annotations(self, file_id):
         # type: (str) -> None
-        """Finds and downloads files related to the primary entity.
+        """Finds and downloads annotations related to the primary entity.
         :param str file_id: String containing the id of the primary entity
         """
 
-        # The primary entity's directory
-        directory = os.path.join(self.base_directory, file_id)
+        self.download_run_annotations([file_id])
 
-        related_files = self.gdc_index_client.get_related_files(file_id)
-        if related_files:
+    def download_run_annotations(self, file_ids):
+        # type: (list[str]) -> list[str]
+        """Download the annotations of many files in a few batched requests
 
-            log.debug(
-                "Found {0} related files for {1}.".format(len(related_files), file_id)
-            )
-            for related_file in related_files:
+        Annotations shared by several files are only requested once. The
+        annotations.txt of every request is split by its id column into
+        the directory of each file it annotates.
 
-                log.debug("related file {0}".format(related_file))
-                related_file_url = urlparse.urljoin(self.data_uri, related_file)
-                stream = DownloadStream(related_file_url, directory, self.token)
+        Args:
+            file_ids (list): ids of the downloaded files
 
-                # TODO: un-set this when parcel is moved to dtt
-                # hacky way to get it working like the old dtt
-                stream.directory = directory
+        Returns:
+            list: ids of the files annotations were written for
+        """
 
-                # run original parallel download
-                super(GDCHTTPDownloadClient, self).parallel_download(stream)
+        wanted = {}
+        for file_id in file_ids:
+            annotations = self.gdc_index_client.get_annotations(file_id)
+            if annotations:
+                log.debug(
+                    "Found {0} annotations for {1}.".format(len(annotations), file_id)
+                )
+                wanted[file_id] = set(annotations)
 
-                if os.path.isfile(stream.temp_path):
-                    utils.remove_partial_extension(stream.temp_path)
-        else:
-            log.debug("No related files")
+        if not wanted:
+            return []
 
-    def download_annotations(self, file_id):
-        # type: (str) -> None
-        """Finds and downloads annotations related to the primary entity.
-        :param str file_id: String containing the id of the primary entity
-        """
+        ann_ids = sorted(set().union(*wanted.values()))
+        log.debug(
+            "Requesting {0} distinct annotations of {1} files".format(
+                len(ann_ids), len(wanted)
+            )
+        )
 
-        # The primary entity's directory
-        directory = os.path.join(self.base_directory, file_id)
+        header, lines = None, []
+        for i in range(0, len(ann_ids), self.annotation_batch_size):
+            batch_header, batch_lines = self._request_annotations(
+                ann_ids[i : i + self.annotation_batch_size]
+            )
+            header = header or batch_header
+            lines += batch_lines
+
+        if header is None:
+            return []
+
+        columns = header.rstrip(b"\r\n").split(b"\t")
+        id_column = columns.index(b"id") if b"id" in columns else None
+        if id_column is None and len(wanted) > 1:
+            log.warning(
+                "No id column in {0}, writing all annotations for every "
+                "file".format(self.annotation_name)
+            )
 
-        annotations = self.gdc_index_client.get_annotations(file_id)
+        written = []
+        for file_id, annotations in wanted.items():
+            if id_column is None or len(wanted) == 1:
+                file_lines = lines
+            else:
+                file_lines = [
+                    line
+                    for line in lines
+                    if _column(line, id_column).decode("utf-8") in annotations
+                ]
+
+            path = os.path.join(self.base_directory, file_id, self.annotation_name)
+            with open(path, "wb") as f:
+                f.write(header)
+                f.writelines(file_lines)
+            log.debug("Wrote annotations to {0}.".format(path))
+            written.append(file_id)
+
+        return written
+
+    def _request_annotations(self, ann_ids):
+        # type: (list[str]) -> tuple[bytes, list[bytes]]
+        """Request an annotations.txt covering the annotation ids
+
+        The compressed tarfile is read as it streams in, only the lines of
+        its annotations.txt are kept.
+
+        Returns:
+            bytes: the header line, None if there was no annotations.txt
+            list: the other lines
+        """
 
-        if annotations:
-            log.debug(
-                "Found {0} annotations for {1}.".format(len(annotations), file_id)
-            )
-            # {'ids': ['id1', 'id2'..., 'idn']}
-            ann_ids = {"ids": annotations}
-
-            # NOTE: Force compression
-            r = self._post(path="data?compress", json=ann_ids)
-            r.raise_for_status()
-            tar = tarfile.open(mode="r:gz", fileobj=BytesIO(r.content))
-            if self.annotation_name in tar.getnames():
-                member = tar.getmember(self.annotation_name)
-                ann = tar.extractfile(member).read()
-                path = os.path.join(directory, self.annotation_name)
-                with open(path, "wb") as f:
-                    f.write(ann)
-
-                log.debug("Wrote annotations to {0}.".format(path))
+        # NOTE: Force compression
+        r = self._post(path="data?compress", json={"ids": ann_ids})
+        r.raise_for_status()
+
+        header, lines = None, []
+        try:
+            with tarfile.open(mode="r|gz", fileobj=_ThrottledReader(r.raw)) as tar:
+                for member in tar:
+                    if member.name != self.annotation_name:
+                        continue
+                    member_lines = tar.extractfile(member).readlines()
+                    if member_lines:
+                        header, lines = member_lines[0], member_lines[1:]
+                    break
+        finally:
+            r.close()
+
+        # the last line may lack its line break
+        if lines and not lines[-1].endswith(b"\n"):
+            lines[-1] += b"\n"
+        return header, lines
 
     def _untar_file(self, tarfile_name):
         # type: (str) -> list[str]
@@ -180,37 +283,45 @@ class GDCHTTPDownloadClient(HTTPClient):
         return a python requests object to be handled by the method calling self._post
         """
 
+        urls = {
+            "active": urlparse.urljoin(self.base_uri, path),
+            "legacy": urlparse.urljoin(self.base_uri, "legacy/{0}".format(path)),
+        }
+        # try the endpoint that answered most requests first, and the other
+        # one if it doesn't return OK
+        first = self.endpoint_stats.preferred
+        endpoints = (first, "active" if first == "legacy" else "legacy")
+
         r = None
         try:
-            # try active
-            active = urlparse.urljoin(self.base_uri, path)
-            legacy = urlparse.urljoin(self.base_uri, "legacy/{0}".format(path))
-
-            r = requests.post(
-                active,
-                stream=stream,
-                verify=self.verify,
-                json=json or {},
-                headers=headers or {},
-            )
-            if r.status_code not in [200, 203]:
-                # try legacy if active doesn't return OK
+            for endpoint in endpoints:
+                if r is not None:
+                    r.close()
+                governor.throttle_request()
                 r = requests.post(
-                    legacy,
+                    urls[endpoint],
                     stream=stream,
                     verify=self.verify,
                     json=json or {},
                     headers=headers or {},
                 )
+                if r.status_code in [200, 203]:
+                    self.endpoint_stats.record(endpoint, 1)
+                    break
+                self.endpoint_stats.record(endpoint, 0, 1)
 
         except Exception as e:
             log.error(e)
 
         return r
 
-    def _download_tarfile(self, small_files):
-        # type: (list[str]) -> tuple[str, object]
-        """Make the request to the API for the tarfile downloads"""
+    def _request_tarfile(self, small_files):
+        # type: (list[str]) -> tuple[requests.models.Response, list[list[str]]]
+        """Make the request to the API for the tarfile downloads
+
+        Returns the streaming response, or None and the groups worth
+        retrying if the request failed
+        """
 
         errors = []
         headers = {
@@ -225,6 +336,10 @@ class GDCHTTPDownloadClient(HTTPClient):
         path = build_url("data", *params)
         r = self._post(path=path, headers=headers, json=ids)
 
+        if r is None:
+            errors.append(ids["ids"])
+            return None, errors
+
         if r.status_code == requests.codes.bad:
             log.error("Unable to connect to the API")
             log.error("Is this the correct URL? {0}".format(self.base_uri))
@@ -235,11 +350,21 @@ class GDCHTTPDownloadClient(HTTPClient):
             # If it fails to download because you don't have access then
             # don't bother trying again
             log.error(r.text)
-            return "", []
+            return None, []
 
         if r.status_code not in [200, 203]:
             log.warning("[{0}] Unable to download group".format(r.status_code))
             errors.append(ids["ids"])
+            return None, errors
+
+        return r, errors
+
+    def _download_tarfile(self, small_files):
+        # type: (list[str]) -> tuple[str, object]
+        """Make the request to the API for the tarfile downloads"""
+
+        r, errors = self._request_tarfile(small_files)
+        if r is None:
             return "", errors
 
         # {'content-disposition': 'filename=the_actual_filename.tar'}
@@ -257,80 +382,349 @@ class GDCHTTPDownloadClient(HTTPClient):
 
         with open(tarfile_name, "wb") as f:
             for chunk in r:
+                governor.throttle_bytes(len(chunk))
                 f.write(chunk)
 
         r.close()
 
         return tarfile_name, errors
 
-    def download_small_groups(self, smalls):
-        # type: (list[str]) -> tuple[list[str], int]
-        """Download small groups
+    def _member_path(self, name):
+        # type: (str) -> str
+        """Return where a tar member goes, refusing paths outside of the
+        download directory"""
 
-        Smalls are predetermined groupings of smaller file size files.
-        They are grouped to reduce the number of open connections per download.
-        """
+        base = os.path.realpath(self.base_directory)
+        path = os.path.realpath(os.path.join(base, name))
+        if os.path.commonpath([base, path]) != base:
+            raise ValueError(
+                "Refusing to extract {0} outside of {1}".format(name, base)
+            )
+        return path
 
-        successful_count = 0
-        errors = []
-        groupings_len = len(smalls)
+    def _extract_tarfile_stream(self, r):
+        # type: (requests.models.Response) -> tuple[list[str], list[str]]
+        """Extract the members of a tarfile response as it is downloaded
 
-        for i, small_group in enumerate(smalls):
+        Every member is written to its final location and hashed in the same
+        pass. Tiny members are read whole and written by a pool of threads,
+        so that creating many small files doesn't hold up the download.
 
-            if not small_group:
-                log.error("There are no files to download")
-                return [], 0
+        Returns the names of the extracted members and the UUIDs of those
+        with an invalid md5sum
+        """
 
-            log.debug("Saving grouping {0}/{1}".format(i + 1, groupings_len))
+        members, errors, pending = [], [], deque()
+        r.raw.decode_content = True
+        with ThreadPoolExecutor(max_workers=self.tar_writer_threads) as writers:
+            with tarfile.open(fileobj=_ThrottledReader(r.raw), mode="r|*") as tar:
+                for member in tar:
+                    if member.name == "MANIFEST.txt":
+                        continue
+                    path = self._member_path(member.name)
+                    if member.isdir():
+                        os.makedirs(path, exist_ok=True)
+                        continue
+                    if not member.isfile():
+                        log.debug("Skipping tar member {0}".format(member.name))
+                        continue
+
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    md5sum = hashlib.md5()
+                    source = tar.extractfile(member)
+                    if member.size <= self.tiny_member_size:
+                        data = source.read()
+                        md5sum.update(data)
+                        pending.append(writers.submit(_write_file, path, data))
+                        # bound the memory held by queued writes
+                        while len(pending) > 64 * self.tar_writer_threads:
+                            pending.popleft().result()
+                    else:
+                        with open(path, "wb") as f:
+                            for chunk in iter(lambda: source.read(1024 * 1024), b""):
+                                md5sum.update(chunk)
+                                f.write(chunk)
+
+                    members.append(member.name)
+                    if re.findall(SUPERSEDED_INFO_FILENAME_TEMPLATE, member.name):
+                        log.warning(
+                            "Some of the files have been superseded. See {} "
+                            "for reference.".format(member.name)
+                        )
+                        continue
+                    member_uuid = member.name.split("/")[0]
+                    if (
+                        self.md5_check
+                        and self.gdc_index_client.get_md5sum(member_uuid)
+                        != md5sum.hexdigest()
+                    ):
+                        log.error("UUID {0} has invalid md5sum".format(member_uuid))
+                        errors.append(member_uuid)
+
+            for future in pending:
+                future.result()
+
+        return members, errors
+
+    def _download_small_group(self, small_group):
+        # type: (list[str]) -> tuple[list[str], int]
+        """Download and extract a single group of small files
 
-            pbar = get_percentage_pbar(1)
+        The group takes one connection from the budget shared with the big
+        file downloads for as long as it is downloading.
+        """
 
-            tarfile_name, error = self._download_tarfile(small_group)
+        self.connection_budget.acquire(1)
+        try:
+            r, errors = self._request_tarfile(small_group)
 
             # this will happen in the result of an
             # error that shouldn't be retried
-            if tarfile_name == "":
-                continue
+            if r is None:
+                return errors, 0
 
-            if error:
-                errors += error
-                time.sleep(0.5)
-                continue
+            try:
+                members, md5_errors = self._extract_tarfile_stream(r)
+            except Exception as e:
+                log.warning("Unable to extract group: {0}".format(e))
+                return [small_group], 0
+            finally:
+                r.close()
+        finally:
+            self.connection_budget.release(1)
+
+        log.debug("Extracted {0} files".format(len(members)))
+        if self.run_journal is not None and self.md5_check:
+            for member in members:
+                member_uuid = member.split("/")[0]
+                if member_uuid in small_group and member_uuid not in md5_errors:
+                    path = os.path.join(self.base_directory, member)
+                    self.run_journal.record(
+                        member_uuid,
+                        path,
+                        self.gdc_index_client.get_md5sum(member_uuid),
+                    )
+
+        return md5_errors, len(small_group)
 
-            successful_count += len(small_group)
-            members = self._untar_file(tarfile_name)
+    def download_small_groups(self, smalls):
+        # type: (list[str]) -> tuple[list[str], int]
+        """Download small groups
 
-            if self.md5_check:
-                errors += self._md5_members(members)
+        Smalls are predetermined groupings of smaller file size files.
+        They are grouped to reduce the number of open connections per download.
+        Up to ``concurrent_groups`` groups are downloaded at once.
+        """
 
-            pbar.update(1)
-            pbar.finish()
+        successful_count = 0
+        errors = []
+
+        if not all(smalls):
+            log.error("There are no files to download")
+            return [], 0
+
+        log.debug(
+            "Saving {0} groupings, {1} at a time".format(
+                len(smalls), self.concurrent_groups
+            )
+        )
+        pbar = get_percentage_pbar(len(smalls))
+
+        with ThreadPoolExecutor(max_workers=self.concurrent_groups) as executor:
+            futures = [
+                executor.submit(self._download_small_group, small_group)
+                for small_group in smalls
+            ]
+            for i, future in enumerate(as_completed(futures)):
+                group_errors, count = future.result()
+                errors += group_errors
+                successful_count += count
+                pbar.update(i + 1)
+
+        pbar.finish()
 
         return errors, successful_count
 
-    def parallel_download(self, stream):
+    def download_files(self, urls, *args, **kwargs):
+        # type: (list[str]) -> tuple[list[str], dict[str,str]]
+        """Download the files together with their related files, then the
+        annotations of all of them at once
+
+        Related files are scheduled as peers of their primary file in the
+        same pool, so they download at the same time. A related file shared
+        by several primary files is downloaded once, into the directory of
+        the first of them, and linked into the directories of the others.
+        A related file that was asked for as a primary file too is
+        downloaded as a primary file, and linked into the directories of
+        the files it belongs to.
+
+        Returns:
+            list: urls of the primary files downloaded
+            dict: errors of the primary files that failed, by url
+        """
+
+        if not urls:
+            return super(GDCHTTPDownloadClient, self).download_files(urls)
+
+        self._related_owners = {}
+        self._related_urls = {}
+        self._unrecorded = {}
+        # related files that are primary files too, and the files they
+        # belong to
+        related_primaries = {}
+        self._streams = {}
+        schedule = []
+        primaries = set(urls)
+        for url in urls:
+            file_id = url.split("/")[-1]
+            related_files = (
+                self.gdc_index_client.get_related_files(file_id)
+                if self.related_files
+                else []
+            )
+            for related_file in related_files:
+                related_url = urlparse.urljoin(self.data_uri, related_file)
+                self._related_urls.setdefault(url, []).append(related_url)
+                if related_url in primaries:
+                    related_primaries.setdefault(related_url, []).append(file_id)
+                    continue
+                if related_url not in self._related_owners:
+                    self._related_owners[related_url] = []
+                    # before their primary file, so they hold a connection
+                    # by the time the primary file takes the rest
+                    schedule.append(related_url)
+                self._related_owners[related_url].append(file_id)
+            schedule.append(url)
+
+        if self._related_owners:
+            log.debug(
+                "Downloading {0} related files alongside {1} files".format(
+                    len(self._related_owners), len(urls)
+                )
+            )
 
-        # gdc-client calls parcel's parallel_download,
-        # which is where most of the downloading takes place
-        file_id = stream.url.split("/")[-1]
-        super(GDCHTTPDownloadClient, self).parallel_download(stream)
+        # related files take download slots like any other file, and draw
+        # their connections from the same budget
+        downloaded, errors = super(GDCHTTPDownloadClient, self).download_files(schedule)
 
-        if self.related_files:
-            try:
-                self.download_related_files(file_id)
-            except Exception as e:
+        linked = set()
+        for related_url, owners in self._related_owners.items():
+            if related_url in errors:
                 log.warning(
-                    "Unable to download related files for {0}: {1}".format(file_id, e)
+                    "Unable to download related file {0} of {1}: {2}".format(
+                        related_url.split("/")[-1],
+                        ", ".join(owners),
+                        errors.pop(related_url),
+                    )
                 )
-                if self.debug:
-                    raise
+            elif related_url in self._streams:
+                self._link_related_file(self._streams[related_url], owners)
+                linked.add(related_url)
+        for url, owners in related_primaries.items():
+            if url in self._streams and url not in errors:
+                self._link_related_file(self._streams[url], owners)
+                linked.add(url)
+
+        # a primary file whose related files are missing is downloaded
+        # again by the next run
+        for url, stream in self._unrecorded.items():
+            related_urls = self._related_urls[url]
+            if all(related_url in linked for related_url in related_urls):
+                directory = os.path.join(self.base_directory, url.split("/")[-1])
+                self._record(
+                    url,
+                    stream,
+                    [
+                        os.path.join(directory, self._streams[related_url].name)
+                        for related_url in related_urls
+                    ],
+                )
+
+        downloaded = [url for url in downloaded if url not in self._related_owners]
 
         if self.annotations:
             try:
-                self.download_annotations(file_id)
-            except Exception as e:
-                log.warning(
-                    "Unable to download annotations for {0}: {1}".format(file_id, e)
+                self.download_run_annotations(
+                    [url.split("/")[-1] for url in downloaded]
                 )
+            except Exception as e:
+                log.warning("Unable to download annotations: {0}".format(e))
                 if self.debug:
                     raise
+
+        return downloaded, errors
+
+    def _make_stream(self, url):
+        # type: (str) -> DownloadStream
+        """Set up a download stream with the file information of the index,
+        and related files to go into the directory of their primary file"""
+
+        stream = super(GDCHTTPDownloadClient, self)._make_stream(url)
+
+        # what the index knows about the file saves probing the data server
+        file_id = url.split("/")[-1]
+        metadata = (
+            self.gdc_index_client.metadata.get(file_id)
+            if self.gdc_index_client is not None
+            else None
+        )
+        if metadata and metadata.get("file_size") is not None:
+            stream.set_information(
+                size=int(metadata["file_size"]),
+                md5sum=metadata.get("md5sum"),
+                name=metadata.get("file_name"),
+            )
+
+        owners = self._related_owners.get(url)
+        if owners:
+            stream.directory = os.path.join(self.base_directory, owners[0])
+        self._streams[url] = stream
+        return stream
+
+    def _download_url(self, url):
+        # type: (str) -> tuple[str, str]
+        """Download a file, recording it in the run journal once verified
+
+        A file with related files is recorded once they are linked next to
+        it, so a run that stops before that downloads them the next time.
+        """
+
+        url, error = super(GDCHTTPDownloadClient, self)._download_url(url)
+        stream = self._streams.get(self.fix_uri(url))
+        if (
+            error is None
+            and self.run_journal is not None
+            and self.md5_check
+            and url not in self._related_owners
+            and stream is not None
+            and os.path.isfile(stream.path)
+        ):
+            if url in self._related_urls:
+                self._unrecorded[url] = stream
+            else:
+                self._record(url, stream)
+        return url, error
+
+    def _record(self, url, stream, related=()):
+        # type: (str, DownloadStream, list[str]) -> None
+        """Record a verified file in the run journal"""
+
+        self.run_journal.record(url.split("/")[-1], stream.path, stream.md5sum, related)
+
+    def _link_related_file(self, stream, owners):
+        # type: (DownloadStream, list[str]) -> None
+        """Link a downloaded related file into the directories of the primary
+        files it belongs to, copying it where links aren't possible"""
+
+        for owner in owners:
+            directory = os.path.join(self.base_directory, owner)
+            path = os.path.join(directory, stream.name)
+            if os.path.exists(path):
+                continue
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            try:
+                os.link(stream.path, path)
+            except OSError:
+                shutil.copy2(stream.path, path)
+            log.debug("Linked related file {0} to {1}".format(stream.name, path))
@@ -0,0 +1,124 @@
+"""gdc_client.download.journal
+
+Record of the files of a download directory that finished and verified.
+"""
+
+import json
+import logging
+import os
+import threading
+
+log = logging.getLogger("gdc-download")
+
+
+class RunJournal(object):
+    """Files downloaded and verified into a directory, across runs
+
+    Every file whose md5sum checked out is appended as a JSON line with its
+    UUID, md5sum, and the path, size and modification time of the file and
+    of the related files linked next to it. A later run into the same
+    directory skips the files that are still on disk with the size and
+    modification time they were recorded with, without asking the API
+    about them. The files are not hashed again.
+    """
+
+    file_name = ".gdc-client-journal.jsonl"
+
+    def __init__(self, directory):
+        """
+        Args:
+            directory (str): the download directory
+        """
+
+        self.directory = directory
+        self.path = os.path.join(directory, self.file_name)
+        self._lock = threading.Lock()
+        self._file = None
+
+    def load(self):
+        """
+        Read the entries recorded so far
+
+        Returns:
+            dict: the latest entry of each UUID
+        """
+
+        entries = {}
+        if not os.path.isfile(self.path):
+            return entries
+
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                    entries[entry["id"]] = entry
+                except (ValueError, KeyError, TypeError):
+                    # a line cut short by an interrupted run
+                    log.debug("Ignoring journal line {0!r}".format(line))
+        return entries
+
+    def completed(self, uuids):
+        """
+        Find the UUIDs whose files are on disk as they were recorded
+
+        Args:
+            uuids (iterable): UUIDs of the files to download
+
+        Returns:
+            set: the UUIDs that don't need downloading again
+        """
+
+        entries = self.load()
+        done = set()
+        for uuid in uuids:
+            entry = entries.get(uuid)
+            if entry is None:
+                continue
+            files = [entry] + entry.get("related", [])
+            if all(self._unchanged(f) for f in files):
+                done.add(uuid)
+        return done
+
+    def _describe(self, path):
+        stat = os.stat(path)
+        return {
+            "path": os.path.relpath(path, self.directory),
+            "size": stat.st_size,
+            "mtime": stat.st_mtime_ns,
+        }
+
+    def _unchanged(self, recorded):
+        try:
+            stat = os.stat(os.path.join(self.directory, recorded["path"]))
+        except (OSError, KeyError, TypeError):
+            return False
+        return stat.st_size == recorded.get(
+            "size"
+        ) and stat.st_mtime_ns == recorded.get("mtime")
+
+    def record(self, uuid, path, md5sum, related=()):
+        """
+        Record a file whose md5sum checked out
+
+        Args:
+            uuid (str): the UUID the file was downloaded as
+            path (str): where the file was written
+            md5sum (str): md5sum the file was verified against
+            related (iterable): paths of the related files linked next to
+                the file, a later run downloads the file again if any of
+                them changed
+        """
+
+        entry = dict(self._describe(path), id=uuid, md5sum=md5sum)
+        entry["related"] = [self._describe(p) for p in related]
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.path, "a")
+            self._file.write(json.dumps(entry) + "\n")
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
@@ -3,11 +3,14 @@ import time
 from urllib import parse as urlparse
 from functools import partial
 
-from gdc_client.parcel import colored, manifest
+from gdc_client.parcel import colored, governor, manifest
+from gdc_client.parcel.storage import STORAGE_CHOICES
 
 from gdc_client.download.client import GDCHTTPDownloadClient
+from gdc_client.download.journal import RunJournal
+from gdc_client.query.cache import MetadataCache
 from gdc_client.query.index import GDCIndexClient
-from gdc_client.query.versions import get_latest_versions
+from gdc_client.query.versions import iter_latest_versions
 from gdc_client.utils import build_url
 
 log = logging.getLogger("gdc-download")
@@ -18,23 +21,57 @@ def validate_args(parser, args):
     if not args.file_ids and not args.manifest:
         msg = "must specify either --manifest or file_id"
         parser.error(msg)
+    if args.offline and not args.metadata_cache:
+        parser.error("--offline requires --metadata-cache")
 
 
-def get_client(args, index_client):
+def get_metadata_cache(args):
+    if not args.metadata_cache:
+        return None
+    return MetadataCache(
+        args.metadata_cache,
+        ttl=args.metadata_cache_ttl,
+        max_entries=args.metadata_cache_size,
+    )
+
+
+def skip_completed(run_journal, ids):
+    """Leave out the files a previous run already downloaded and verified."""
+    if run_journal is None:
+        return ids, 0
+
+    completed = run_journal.completed(ids)
+    if completed:
+        log.info(
+            "Skipping {0} files completed in a previous run".format(len(completed))
+        )
+    return [i for i in ids if i not in completed], len(completed)
+
+
+def get_client(args, index_client, run_journal=None):
     # args get converted into kwargs
     kwargs = {
         "token": args.token_file,
         "n_procs": args.n_processes,
+        "concurrent_files": args.concurrent_files,
+        "concurrent_groups": args.concurrent_groups,
+        "prepare_ahead": args.prepare_ahead,
+        "engine": args.engine,
         "directory": args.dir,
         "segment_md5sums": not args.no_segment_md5sums,
         "file_md5sum": not args.no_file_md5sum,
         "http_chunk_size": args.http_chunk_size,
+        "min_http_chunk_size": args.min_http_chunk_size,
+        "max_http_chunk_size": args.max_http_chunk_size,
         "save_interval": args.save_interval,
+        "write_method": args.write_method,
+        "storage": args.storage,
         "download_related_files": not args.no_related_files,
         "download_annotations": not args.no_annotations,
         "no_auto_retry": args.no_auto_retry,
         "retry_amount": args.retry_amount,
         "verify": not args.no_verify,
+        "run_journal": run_journal,
     }
 
     return GDCHTTPDownloadClient(uri=args.server, index_client=index_client, **kwargs)
@@ -54,6 +91,13 @@ def download(parser, args):
     small_errors = []
     validate_args(parser, args)
 
+    # every download and metadata query from here on draws from the limits
+    governor.configure(
+        max_bandwidth=args.max_bandwidth,
+        max_request_rate=args.max_request_rate,
+        limits_file=args.limits_file,
+    )
+
     # sets do not allow duplicates in a list
     ids = set(args.file_ids)
     for i in args.manifest:
@@ -62,9 +106,33 @@ def download(parser, args):
             break
         ids.add(i["id"])
 
+    # files finished by a previous run into the same directory need no
+    # version or metadata lookup, unless a newer version of them is asked for
+    run_journal = None if args.no_run_journal else RunJournal(args.dir)
+    ids, skipped_count = sorted(ids), 0
+    if not args.latest:
+        ids, skipped_count = skip_completed(run_journal, ids)
+
+    cache = get_metadata_cache(args)
+    index_client = GDCIndexClient(
+        args.server, not args.no_verify, cache=cache, offline=args.offline
+    )
+
     # Query the api to get the latest version of a file(s) according to the gdc.
-    # Return OLD_ID => NEW_ID mapping
-    ids_map = get_latest_versions(args.server, ids, verify=not args.no_verify)
+    # Return OLD_ID => NEW_ID mapping. The metadata of each resolved chunk is
+    # fetched while the remaining versions are being queried
+    ids_map = {}
+    for chunk_versions in iter_latest_versions(
+        args.server,
+        ids,
+        verify=not args.no_verify,
+        cache=cache,
+        offline=args.offline,
+    ):
+        ids_map.update(chunk_versions)
+        index_client.prefetch_metadata(
+            chunk_versions.values() if args.latest else chunk_versions.keys()
+        )
 
     if args.latest:
         log.info("Downloading LATEST versions of files")
@@ -79,12 +147,19 @@ def download(parser, args):
             )
 
     ids = ids_map.values() if args.latest else ids_map.keys()
+    # the latest versions may have been downloaded before as well
+    ids, skipped = skip_completed(run_journal, list(ids))
+    skipped_count += skipped
 
-    index_client = GDCIndexClient(args.server, not args.no_verify)
-    client = get_client(args, index_client)
+    client = get_client(args, index_client, run_journal)
 
     # separate the smaller files from the larger files
-    bigs, smalls = index_client.separate_small_files(ids, args.http_chunk_size)
+    bigs, smalls = index_client.separate_small_files(
+        ids,
+        args.small_file_size,
+        args.bundle_size,
+        concurrency=args.concurrent_groups,
+    )
 
     # the big files will be normal downloads
     # the small files will be joined together and tarfiled
@@ -151,6 +226,13 @@ def download(parser, args):
         )
     )
 
+    if skipped_count > 0:
+        log.info("Already downloaded: {0}".format(skipped_count))
+
+    if run_journal is not None:
+        run_journal.close()
+    index_client.close()
+
     if unsuccessful_count > 0:
         msg = "Failed downloads"
         log.info(
@@ -232,18 +314,129 @@ def config(parser, download_defaults):
     parser.add_argument(
         "-n", "--n-processes", type=int, help="Number of client connections."
     )
+    parser.add_argument(
+        "--engine",
+        choices=["processes", "threads"],
+        help="Run download connections as separate processes or as threads "
+        "of a single process.",
+    )
+    parser.add_argument(
+        "--concurrent-files",
+        dest="concurrent_files",
+        type=int,
+        help="Number of files to download at once. They share the "
+        "--n-processes connections. Needs --engine threads.",
+    )
+    parser.add_argument(
+        "--concurrent-groups",
+        dest="concurrent_groups",
+        type=int,
+        help="Number of small file groups to download at once. They share "
+        "the --n-processes connections.",
+    )
+    parser.add_argument(
+        "--prepare-ahead",
+        dest="prepare_ahead",
+        type=int,
+        help="Number of files to probe and preallocate in the background "
+        "while earlier files download, 0 to disable. Needs --engine threads.",
+    )
+    parser.add_argument(
+        "--max-bandwidth",
+        dest="max_bandwidth",
+        type=int,
+        help="Limit the total download rate in bytes per second, " "0 for unlimited.",
+    )
+    parser.add_argument(
+        "--max-request-rate",
+        dest="max_request_rate",
+        type=float,
+        help="Limit the number of API requests per second, 0 for unlimited.",
+    )
+    parser.add_argument(
+        "--limits-file",
+        dest="limits_file",
+        metavar="FILE",
+        help="File with 'max_bandwidth = N' and 'max_request_rate = N' "
+        "lines, re-read while downloading to change the limits.",
+    )
+    parser.add_argument(
+        "--metadata-cache",
+        dest="metadata_cache",
+        metavar="FILE",
+        help="SQLite file caching file metadata and latest versions "
+        "between runs. Disabled unless given.",
+    )
+    parser.add_argument(
+        "--metadata-cache-ttl",
+        dest="metadata_cache_ttl",
+        type=float,
+        help="Seconds cached metadata stays valid, 0 to never expire.",
+    )
+    parser.add_argument(
+        "--metadata-cache-size",
+        dest="metadata_cache_size",
+        type=int,
+        help="Number of cache entries kept, the least recently used are "
+        "evicted first. 0 for no limit.",
+    )
+    parser.add_argument(
+        "--offline",
+        action="store_true",
+        help="Plan downloads from the metadata cache only, expired entries "
+        "included, without querying the API for metadata or versions.",
+    )
     parser.add_argument(
         "--http-chunk-size",
         "-c",
         type=int,
         help="Size in bytes of standard HTTP block size.",
     )
+    parser.add_argument(
+        "--min-http-chunk-size",
+        type=int,
+        help="Smallest chunk size in bytes each connection tunes itself to "
+        "from its throughput and errors, starting at --http-chunk-size.",
+    )
+    parser.add_argument(
+        "--max-http-chunk-size",
+        type=int,
+        help="Largest chunk size in bytes each connection tunes itself to. "
+        "Set both bounds to --http-chunk-size for a fixed chunk size.",
+    )
+    parser.add_argument(
+        "--small-file-size",
+        dest="small_file_size",
+        type=int,
+        help="Files up to this size in bytes are downloaded in groups.",
+    )
+    parser.add_argument(
+        "--bundle-size",
+        dest="bundle_size",
+        type=int,
+        help="Target combined size in bytes of a group of small files.",
+    )
     parser.add_argument(
         "--save-interval",
         type=int,
-        help="The number of chunks after which to flush state "
-        "file. A lower save interval will result in more "
-        "frequent printout but lower performance.",
+        help="The number of bytes downloaded after which to "
+        "checkpoint the state file. A lower save interval loses "
+        "less progress when a download is interrupted.",
+    )
+    parser.add_argument(
+        "--write-method",
+        dest="write_method",
+        choices=["pwrite", "offset"],
+        help="How chunks are written to disk: 'pwrite' keeps the partial file "
+        "open for positional writes, 'offset' reopens it for every chunk.",
+    )
+    parser.add_argument(
+        "--storage",
+        choices=STORAGE_CHOICES,
+        help="How partial files are allocated: 'fallocate' reserves their "
+        "blocks, 'truncate' only sets their length, 'sparse' writes their "
+        "last byte. 'auto' chooses by filesystem, and aligns writes to the "
+        "stripe size on parallel filesystems.",
     )
     parser.add_argument(
         "-k",
@@ -282,6 +475,13 @@ def config(parser, download_defaults):
         type=float,
         help="Amount of seconds to wait before retrying",
     )
+    parser.add_argument(
+        "--no-run-journal",
+        action="store_true",
+        dest="no_run_journal",
+        help="Do not record verified files in the download directory, and "
+        "do not skip the files a previous run recorded.",
+    )
     parser.add_argument(
         "--latest",
         action="store_true",
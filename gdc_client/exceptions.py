@@ -4,3 +4,17 @@ class ClientError(Exception):
 
 class MD5ValidationError(Exception):
     """Base MD5 validation error."""
+
+
+class HTTPStatusError(RuntimeError):
+    """Error response of the data server."""
+
+    def __init__(self, message, status_code):
+        super(HTTPStatusError, self).__init__(message)
+        self.status_code = status_code
+
+    @property
+    def retryable(self):
+        """Whether asking again may succeed, client errors other than
+        timeouts and rate limits won't."""
+        return not 400 <= self.status_code < 500 or self.status_code in (408, 429)
@@ -0,0 +1,40 @@
+import threading
+
+
+class ConnectionBudget(object):
+    """A fixed number of connections shared by concurrent downloads.
+
+    Every download takes its connections from the budget before it starts
+    and gives them back when it is done, so the total number of open
+    connections never exceeds ``size`` however many files are in flight.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.available = size
+        self._condition = threading.Condition()
+
+    def acquire(self, wanted, minimum=1):
+        """Take up to ``wanted`` connections from the budget.
+
+        Blocks until at least ``minimum`` connections are free, then takes
+        as many as are available instead of waiting for all of them.
+
+        :param int wanted: number of connections the download could use
+        :param int minimum: number of connections worth starting with
+        :returns: the number of connections granted
+        """
+        wanted = max(1, min(wanted, self.size))
+        minimum = max(1, min(minimum, wanted))
+        with self._condition:
+            while self.available < minimum:
+                self._condition.wait()
+            granted = min(wanted, self.available)
+            self.available -= granted
+            return granted
+
+    def release(self, count):
+        """Return connections to the budget."""
+        with self._condition:
+            self.available += count
+            self._condition.notify_all()
@@ -0,0 +1,71 @@
+from collections import Counter
+
+from gdc_client.parcel import const
+
+
+class ChunkSizer(object):
+    """Chunk size of one download connection, tuned from what it observed.
+
+    After every segment the chunk size is set so that a chunk takes about
+    ``chunk_seconds`` at the throughput measured on the connection, rounded
+    down to a power of two between ``minimum`` and ``maximum``. It grows at
+    most twofold per segment, and only while the connection isn't failing.
+    Every failed request halves it, so that less is downloaded again on a
+    flaky link.
+    """
+
+    def __init__(
+        self,
+        size,
+        minimum=const.MIN_HTTP_CHUNK_SIZE,
+        maximum=const.MAX_HTTP_CHUNK_SIZE,
+        chunk_seconds=const.CHUNK_SECONDS,
+    ):
+        """
+        :param int size: the chunk size of the first segment
+        :param int minimum: the smallest size chosen
+        :param int maximum: the largest size chosen
+        :param float chunk_seconds: the time a chunk should take
+        """
+        self.size = size
+        self.minimum = minimum
+        self.maximum = max(minimum, maximum)
+        self.chunk_seconds = chunk_seconds
+        # smoothed throughput in bytes per second
+        self.rate = None
+        # decaying count of recent failures
+        self.errors = 0.0
+        # bytes downloaded with each chunk size
+        self.sizes = Counter()
+
+    def _bounded(self, size):
+        size = 1 << max(0, int(size).bit_length() - 1)
+        return min(self.maximum, max(self.minimum, size))
+
+    def succeeded(self, length, seconds):
+        """Adjust the chunk size after ``length`` bytes of a segment were
+        read in ``seconds``."""
+        self.sizes[self.size] += length
+        self.errors /= 2
+        # a segment of a chunk or two mostly measures the request latency
+        if length < 2 * self.size or seconds <= 0:
+            return
+
+        rate = length / seconds
+        self.rate = rate if self.rate is None else (self.rate + rate) / 2
+        target = self._bounded(self.rate * self.chunk_seconds)
+        if target < self.size:
+            self.size = target
+        elif self.errors < 0.5:
+            self.size = min(target, 2 * self.size)
+
+    def failed(self, length):
+        """Halve the chunk size after a request failed ``length`` bytes in."""
+        self.sizes[self.size] += length
+        self.errors += 1
+        self.size = max(min(self.minimum, self.size), self.size // 2)
+
+    def report(self):
+        """Return the bytes downloaded with each chunk size, keyed for the
+        client's run report."""
+        return Counter({("chunk_size", size): n for size, n in self.sizes.items() if n})
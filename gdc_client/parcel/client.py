@@ -6,17 +6,26 @@
 # Availability: https://github.com/LabAdvComp/parcel
 # ***************************************************************************************
 
+from gdc_client.exceptions import HTTPStatusError
 from gdc_client.parcel import const
+from gdc_client.parcel import governor
+from gdc_client.parcel.budget import ConnectionBudget
+from gdc_client.parcel.chunk_sizer import ChunkSizer
 from gdc_client.parcel import utils
 from gdc_client.parcel.download_stream import DownloadStream
 from gdc_client.parcel.portability import colored
+from gdc_client.parcel.portability import OS_WINDOWS
 from gdc_client.parcel.portability import Process
 from gdc_client.parcel.segment import SegmentProducer
+from gdc_client.parcel.storage import select_storage
 
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 import logging
 import os
 import requests
 import tempfile
+from threading import Lock, Thread
 import time
 
 # Logging
@@ -36,20 +45,78 @@ class Client(object):
             The number of processes to use in download
         :param str directory:
             The directory to which any data will be downloaded
+        :param int concurrent_files:
+            optional. The number of files to download at once, they all
+            share the ``n_procs`` connections. Only with the ``threads``
+            engine
+        :param str engine:
+            optional. Run download workers as ``processes`` or as
+            ``threads`` of this process
+        :param str storage:
+            optional. How partial files are allocated: ``sparse``,
+            ``truncate``, ``fallocate``, or ``auto`` to choose by the
+            filesystem of ``directory``
+        :param int prepare_ahead:
+            optional. The number of following files probed and
+            preallocated in the background while a file downloads. Only
+            with the ``threads`` engine
+        :param int min_http_chunk_size:
+            optional. The smallest chunk size a connection tunes itself to
+        :param int max_http_chunk_size:
+            optional. The largest chunk size a connection tunes itself to
 
         """
 
         DownloadStream.http_chunk_size = kwargs.get(
             "http_chunk_size", const.HTTP_CHUNK_SIZE
         )
+        # every connection starts at http_chunk_size and tunes it within
+        # these bounds
+        self.min_http_chunk_size = kwargs.get(
+            "min_http_chunk_size", const.MIN_HTTP_CHUNK_SIZE
+        )
+        self.max_http_chunk_size = kwargs.get(
+            "max_http_chunk_size", const.MAX_HTTP_CHUNK_SIZE
+        )
         DownloadStream.check_segment_md5sums = kwargs.get("segment_md5sums", True)
         DownloadStream.check_file_md5sum = kwargs.get("file_md5sum", True)
         SegmentProducer.save_interval = kwargs.get("save_interval", const.SAVE_INTERVAL)
+        DownloadStream.connection_pool_size = n_procs
+        DownloadStream.write_method = kwargs.get("write_method", const.WRITE_METHOD)
+        if DownloadStream.write_method == "pwrite" and not hasattr(os, "pwrite"):
+            log.warning("pwrite is not available, reopening file for every chunk")
+            DownloadStream.write_method = "offset"
 
         self.debug = debug
         self.directory = directory or os.path.abspath(os.getcwd())
         self.directory = os.path.expanduser(self.directory)
+        DownloadStream.storage = select_storage(
+            self.directory, kwargs.get("storage", const.STORAGE)
+        )
         self.n_procs = n_procs
+        # there are no forked processes on windows, workers are always threads
+        self.engine = "threads" if OS_WINDOWS else kwargs.get("engine", const.ENGINE)
+        self.concurrent_files = max(1, kwargs.get("concurrent_files", 1))
+        # streams of the following files prepared while a file downloads
+        self.prepare_ahead = max(0, kwargs.get("prepare_ahead", const.PREPARE_AHEAD))
+        if self.engine == "processes":
+            # forking while other threads of this process hold locks can
+            # leave the workers deadlocked, so the files are downloaded and
+            # prepared one at a time
+            if self.concurrent_files > 1:
+                log.warning("Concurrent file downloads need --engine threads")
+            self.concurrent_files = 1
+            self.prepare_ahead = 0
+        # downloads in flight, which share the connection budget
+        self.workers = self.concurrent_files
+        self._prepare_pool = None
+        self._prepare_lock = Lock()
+        self._preparing = {}
+        self._started = set()
+        self._urls = []
+        self._url_index = {}
+        self.connection_budget = ConnectionBudget(n_procs)
+        self.report = Counter()
         self.start = None
         self.stop = None
         self.token = token
@@ -95,21 +162,60 @@ class Client(object):
 
         self.start_time = time.time()
 
-    def stop_timer(self, file_size=None):
+    def stop_timer(self, file_size=None, start_time=None):
         """Stop a download timer and pring a summary.
 
+        :param int file_size: The size of the downloaded file
+        :param float start_time:
+            The time the download started, defaults to the last
+            :func:`start_timer()` call
         :returns: None
 
         """
 
         self.stop_time = time.time()
+        start_time = start_time or self.start_time
         rate_info = ""
         if file_size and file_size > 0:
-            rate = (int(file_size) * 8 / 1e9) / (self.stop_time - self.start_time)
+            rate = (int(file_size) * 8 / 1e9) / (self.stop_time - start_time)
             rate_info = ": {0:.2f} Gbps average".format(rate)
 
         log.debug("Download complete" + rate_info)
 
+    def log_report(self):
+        """Print a summary of the run, including connection reuse and the
+        chunk sizes the connections tuned themselves to.
+
+        Worker processes report their own counters when they exit, the
+        counters of this process' long-lived sessions are added here.
+
+        :returns: None
+
+        """
+
+        report = self.report + Counter(DownloadStream.connection_stats())
+        log.debug(
+            "Connections: {0} opened, {1} reused".format(
+                report["connections_opened"], report["connections_reused"]
+            )
+        )
+        sizes = sorted(
+            (key[1], count)
+            for key, count in report.items()
+            if isinstance(key, tuple) and key[0] == "chunk_size"
+        )
+        if sizes:
+            log.debug(
+                "Chunk sizes: {0}".format(
+                    ", ".join(
+                        "{0:g} MiB for {1:.1f} MiB".format(
+                            size / const.MB, count / const.MB
+                        )
+                        for size, count in sizes
+                    )
+                )
+            )
+
     def download_files(self, urls, *args, **kwargs):
         """Download a list of files.
 
@@ -129,47 +235,151 @@ class Client(object):
         for url in urls:
             log.debug("Given url: {0}".format(url))
 
-        # Download each file
+        # Download each file, several at once if concurrent downloads are
+        # enabled. All of them draw from the same connection budget
         downloaded, errors = [], {}
-        for url in urls:
-            url = self.fix_uri(url)
-
-            # Construct download stream
-            stream = DownloadStream(url, self.directory, self.token)
+        self._start_preparing(urls)
+        try:
+            if self.workers > 1:
+                with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                    results = list(executor.map(self._download_url, urls))
+            else:
+                results = list(map(self._download_url, urls))
+        finally:
+            self._stop_preparing()
 
-            # Download file
-            try:
-                # validate temporary file before renaming to permanent file location
-                self.parallel_download(stream)
-                utils.validate_file_md5sum(
-                    stream,
-                    (
-                        stream.temp_path
-                        if os.path.isfile(stream.temp_path)
-                        else stream.path
-                    ),
-                )
-                if os.path.isfile(stream.temp_path):
-                    utils.remove_partial_extension(stream.temp_path)
+        for url, error in results:
+            if error is None:
                 downloaded.append(url)
-
-            # Handle file download error, store error to print out later
-            except Exception as e:
-                errors[url] = str(e)
-                if self.debug:
-                    log.exception(e)
-                    raise
-
-            finally:
-                utils.print_closing_header(url)
+            else:
+                errors[url] = error
 
         # Print error messages
         for url, error in errors.items():
             file_id = url.split("/")[-1]
             log.error("{0}: {1}".format(file_id, error))
 
+        self.log_report()
+
         return downloaded, errors
 
+    def _download_url(self, url):
+        """Download and validate a single file.
+
+        :params str url: The url of the file to download
+        :returns: A tuple of the url and an error message, if any
+
+        """
+
+        url = self.fix_uri(url)
+
+        # Construct download stream, or take the one prepared ahead
+        stream = self._prepared_stream(url)
+
+        # Download file
+        try:
+            # validate temporary file before renaming to permanent file location
+            self.parallel_download(stream)
+            utils.validate_file_md5sum(
+                stream,
+                (stream.temp_path if os.path.isfile(stream.temp_path) else stream.path),
+                computed_md5sum=stream.computed_md5sum,
+            )
+            if os.path.isfile(stream.temp_path):
+                utils.remove_partial_extension(stream.temp_path)
+            return url, None
+
+        # Handle file download error, store error to print out later
+        except Exception as e:
+            if self.debug:
+                log.exception(e)
+                raise
+            return url, str(e)
+
+        finally:
+            utils.print_closing_header(url)
+
+    def _make_stream(self, url):
+        """Construct the download stream of a url.
+
+        :params str url: The url of the file to download
+        :returns: A DownloadStream into ``self.directory``
+
+        """
+
+        return DownloadStream(url, self.directory, self.token)
+
+    def _start_preparing(self, urls):
+        """Set up the look-ahead preparation of the streams of ``urls``.
+
+        :params list urls: The urls about to be downloaded, in order
+
+        """
+
+        self._urls = [self.fix_uri(url) for url in urls]
+        self._url_index = {}
+        for index, url in enumerate(self._urls):
+            self._url_index.setdefault(url, index)
+        self._preparing = {}
+        self._started = set()
+        if self.prepare_ahead:
+            self._prepare_pool = ThreadPoolExecutor(max_workers=self.prepare_ahead)
+
+    def _stop_preparing(self):
+        if self._prepare_pool is not None:
+            for future in self._preparing.values():
+                future.cancel()
+            self._prepare_pool.shutdown(wait=True)
+            self._prepare_pool = None
+        self._preparing = {}
+
+    def _prepared_stream(self, url):
+        """Take the stream of a url, and start preparing the streams of the
+        ``prepare_ahead`` urls following it.
+
+        :params str url: The url about to be downloaded
+        :returns: A DownloadStream, initialized if it was prepared
+
+        """
+
+        with self._prepare_lock:
+            future = self._preparing.pop(url, None)
+            self._started.add(url)
+            index = self._url_index.get(url)
+            if self._prepare_pool is not None and index is not None:
+                following = self._urls[index + 1 : index + 1 + self.prepare_ahead]
+                for next_url in following:
+                    if next_url in self._preparing or next_url in self._started:
+                        continue
+                    self._preparing[next_url] = self._prepare_pool.submit(
+                        self._prepare_stream, next_url
+                    )
+
+        if future is not None:
+            try:
+                return future.result()
+            except Exception as e:
+                # the download will run into the error again and report it
+                log.debug("Unable to prepare {0}: {1}".format(url, e))
+        return self._make_stream(url)
+
+    def _prepare_stream(self, url):
+        """Probe a file and preallocate it ahead of its download.
+
+        Files with a state file are left alone, their download resumes
+        from it.
+
+        :params str url: The url of the file
+        :returns: An initialized DownloadStream
+
+        """
+
+        stream = self._make_stream(url)
+        stream.init()
+        if stream.size and not os.path.isfile(stream.state_path):
+            stream.setup_file()
+        return stream
+
     def serial_download(self, stream):
         """Download file to directory serially."""
         self._download(1, stream)
@@ -188,8 +398,9 @@ class Client(object):
 
         # Start stream
         utils.print_opening_header(stream.url)
-        log.debug("Getting file information...")
-        stream.init()
+        if not stream.initialized:
+            log.debug("Getting file information...")
+            stream.init()
 
         # if there's no size/Content-Length in the http header
         # then you can't parallel stream it in chunks
@@ -197,48 +408,104 @@ class Client(object):
             # Do a regular TCP download in python
             return self._standard_tcp_download(stream)
 
-        # Create segments producer to stream
+        # Take connections from the budget shared with concurrent downloads,
+        # small files only need one
         n_procs = 1 if stream.size < 0.01 * const.GB else nprocs
-        producer = SegmentProducer(stream, n_procs)
+        n_procs = self.connection_budget.acquire(
+            n_procs, minimum=self.n_procs // self.workers
+        )
+        try:
+            self._download_segments(n_procs, stream)
+        finally:
+            self.connection_budget.release(n_procs)
+
+    def _download_segments(self, n_procs, stream):
+        """Start ``n_procs`` to download the segments of the file.
+
+        :params int n_procs: The number of processes to start
+        :params stream: The initialized DownloadStream
+
+        """
+
+        # Create segments producer to stream
+        producer = SegmentProducer(stream, n_procs, self.engine)
 
         if producer.done:
             return
 
         def download_worker():
+            # the chunk size of this worker's connection, tuned as it goes
+            chunk_sizer = ChunkSizer(
+                DownloadStream.http_chunk_size,
+                self.min_http_chunk_size,
+                self.max_http_chunk_size,
+            )
             while True:
+                segment = producer.q_work.get()
+                if segment is None:
+                    log.debug("Producer returned with no more work")
+                    stream.close_file()
+                    report = chunk_sizer.report()
+                    if self.engine == "processes":
+                        # threads share this process' sessions, only
+                        # separate processes report their own counters
+                        report.update(DownloadStream.connection_stats())
+                    producer.q_report.put(report)
+                    return
                 try:
-                    segment = producer.q_work.get()
-                    if segment is None:
-                        log.debug("Producer returned with no more work")
-                        return
-                    stream.write_segment(segment, producer.q_complete)
-                    # write_segment completed successfully, send sentinel value
-                    # to master process to indicate a task was completed
-                    producer.q_complete.put(None)
+                    stream.write_segment(
+                        segment,
+                        producer.q_complete,
+                        limits=producer.segment_limits,
+                        chunk_sizer=chunk_sizer,
+                        hash_limit=producer.hash_limits.get(segment.data),
+                    )
+                except HTTPStatusError as e:
+                    # e.g. 403 Forbidden, the other segments would be
+                    # refused as well
+                    producer.fail(e)
                 except Exception as e:
-                    # send sentinel value to master process even though
-                    # write_segment failed to indicate a task is "finished"
-                    producer.q_complete.put(None)
                     if self.debug:
                         raise
                     else:
                         log.error("Download aborted: {0}".format(str(e)))
-                        # worker needs to stay alive until final sentinel value
-                        # from master process is received
-                        continue
+                finally:
+                    # report the task as finished even if write_segment
+                    # failed, so the producer can hand out more work. The
+                    # worker needs to stay alive until the final sentinel
+                    # value from the master process is received
+                    producer.task_done(segment)
 
-        # Divide work amongst process pool
-        pool = [Process(target=download_worker) for i in range(n_procs)]
+        # Divide work amongst process (or thread) pool
+        worker = Process if self.engine == "processes" else Thread
+        pool = [worker(target=download_worker) for i in range(n_procs)]
 
         # Start pool
         for p in pool:
             p.start()
 
-        self.start_timer()
+        start_time = time.time()
 
         # Wait for file to finish download
         producer.wait_for_completion()
-        self.stop_timer(stream.size)
+        self.stop_timer(stream.size, start_time)
+
+        # Children exit after taking their NoneType from the work queue,
+        # collect what they reported on the way out
+        for p in pool:
+            p.join()
+        while not producer.q_report.empty():
+            self.report.update(producer.q_report.get())
+
+        if producer.error is not None:
+            raise RuntimeError(producer.error)
+        # segments that ran out of retries leave holes in the file, better
+        # found here than by the md5sum of the whole file
+        completed = producer.integrate(producer.completed)
+        if completed != stream.size:
+            raise RuntimeError(
+                "Incomplete download: {0} of {1} bytes".format(completed, stream.size)
+            )
 
     def _standard_tcp_download(self, stream):
         """Backup download method for when you can't
@@ -248,12 +515,14 @@ class Client(object):
         """
 
         try:
+            governor.throttle_request()
             r = requests.get(stream.url, stream=True, verify=self.verify)
 
             if r.status_code == 200:
                 stream.setup_directories()
                 with open(stream.path, "wb") as f:
                     for chunk in r:
+                        governor.throttle_bytes(len(chunk))
                         f.write(chunk)
 
             else:
@@ -6,6 +6,8 @@
 # Availability: https://github.com/LabAdvComp/parcel
 # ***************************************************************************************
 
+import os
+
 ###############################################################################
 #                              Constants
 ###############################################################################
@@ -14,4 +16,44 @@ GB = 1024 * 1024 * 1024
 MB = 1024 * 1024
 
 HTTP_CHUNK_SIZE = 1 * MB
-SAVE_INTERVAL = 1 * GB
+# Each download connection tunes its chunk size between these bounds, so
+# that a chunk takes about CHUNK_SECONDS at its measured throughput
+MIN_HTTP_CHUNK_SIZE = MB // 4
+MAX_HTTP_CHUNK_SIZE = 32 * MB
+CHUNK_SECONDS = 0.25
+# Checkpoints append to the download journal, so they are cheap enough to
+# be taken often
+SAVE_INTERVAL = 64 * MB
+
+# Workers merge adjacent chunks and report them to the producer once they
+# add up to REPORT_SIZE bytes or REPORT_INTERVAL seconds have passed
+REPORT_SIZE = 32 * MB
+REPORT_INTERVAL = 1
+
+# Workers send the bytes they received up to MD5_BUFFER_SIZE ahead of the
+# file md5sum's watermark, so the md5sum doesn't read them back from disk
+MD5_BUFFER_SIZE = 256 * MB
+
+# Segments are handed out on demand, sized so that each takes about
+# SEGMENT_SECONDS at the measured per-connection throughput
+INITIAL_SEGMENT_SIZE = 64 * MB
+MIN_SEGMENT_SIZE = 16 * MB
+SEGMENT_SECONDS = 10
+
+# Write chunks with positional writes on a descriptor kept open per worker
+# where the platform supports it, otherwise reopen the file for every chunk
+WRITE_METHODS = ("pwrite", "offset")
+WRITE_METHOD = "pwrite" if hasattr(os, "pwrite") else "offset"
+
+# Run download workers as separate processes, or as threads of the main
+# process sharing in-process queues instead of a multiprocessing Manager
+ENGINES = ("processes", "threads")
+ENGINE = "processes"
+
+# Files whose streams are probed and preallocated in the background while
+# the files before them download
+PREPARE_AHEAD = 4
+
+# How partial files are allocated, "auto" chooses by filesystem type, see
+# gdc_client.parcel.storage
+STORAGE = "auto"
@@ -6,22 +6,112 @@
 # Availability: https://github.com/LabAdvComp/parcel
 # ***************************************************************************************
 
+from gdc_client.exceptions import HTTPStatusError
 from gdc_client.parcel import utils
 from gdc_client.parcel import const
+from gdc_client.parcel import governor
 from gdc_client.parcel.defaults import max_timeout, deprecation_header
+from gdc_client.parcel.storage import Storage
 
 import logging
 from intervaltree import Interval
 import os
 import requests
+import threading
 import time
 from urllib.parse import urlparse
+from urllib3.exceptions import IncompleteRead
+
+
+class CompletionBatch(object):
+    """Adjacent chunks of a segment that are reported as one interval.
+
+    The md5sums of the chunks are kept in a side list in the interval
+    data, every chunk but the last one is ``chunk_size`` bytes long. The
+    bytes received are sent along as well when the md5sum of the whole file
+    is about to reach them.
+    """
+
+    def __init__(self, q_complete, size, interval):
+        self.q_complete = q_complete
+        self.size = size
+        self.interval = interval
+        self._reset()
+
+    def _reset(self):
+        self.begin = None
+        self.end = None
+        self.chunk_size = None
+        self.md5sums = []
+        self.received = None
+        self.started = time.time()
+
+    def _fits(self, offset, length, received):
+        if self.begin is None:
+            return True
+        return (
+            offset == self.end
+            and length <= self.chunk_size
+            and self.end - self.begin == self.chunk_size * len(self.md5sums)
+            and (received is None) == (self.received is None)
+        )
+
+    def add(self, offset, length, md5sum=None, received=None):
+        """Add a chunk that was written at ``offset``, reporting the batch
+        first if the chunk can not be merged into it.
+
+        :param received: optional. The bytes of the chunk, for the md5sum
+            of the whole file
+        """
+        if not self._fits(offset, length, received):
+            self.flush()
+        if self.begin is None:
+            self.begin = self.end = offset
+            self.chunk_size = length
+            if received is not None:
+                self.received = bytearray()
+        self.end += length
+        self.md5sums.append(md5sum)
+        if received is not None:
+            self.received += received
+
+        if (
+            self.end - self.begin >= self.size
+            or time.time() - self.started >= self.interval
+        ):
+            self.flush()
+
+    def flush(self):
+        """Report the batch to the producer and start a new one."""
+        if self.begin is not None and self.end > self.begin:
+            iv_data = {}
+            if self.md5sums[0] is not None:
+                iv_data = {"md5sums": self.md5sums, "chunk_size": self.chunk_size}
+            if self.received is not None:
+                iv_data["received"] = self.received
+            self.q_complete.put(Interval(self.begin, self.end, iv_data or None))
+        self._reset()
 
 
 class DownloadStream(object):
 
     http_chunk_size = const.HTTP_CHUNK_SIZE
     check_segment_md5sums = True
+    connection_pool_size = 1
+    # seconds between checks for a new end of the current segment
+    limit_check_interval = 0.5
+    write_method = const.WRITE_METHOD
+    report_size = const.REPORT_SIZE
+    report_interval = const.REPORT_INTERVAL
+    # how the partial file is allocated, written and evicted from the cache
+    storage = Storage()
+    # receive buffer of each download worker, reused for every chunk
+    _buffers = threading.local()
+
+    # Sessions are cached per process so that keep-alive connections are
+    # reused across segments and retries, but never shared with a forked
+    # download worker
+    _sessions = {}
 
     def __init__(self, url, directory, token=None):
         self.initialized = False
@@ -31,12 +121,20 @@ class DownloadStream(object):
         self.directory = self._get_directory_name(directory, url)
         self.size = None
         self.md5sum = None
+        # md5sum of the file computed while it was downloaded
+        self.computed_md5sum = None
         self.token = token
         self.url = url
         self.check_file_md5sum = True
+        # temp file descriptors for the pwrite path, keyed by worker. Workers
+        # running as threads of one process each keep their own
+        self._fds = {}
 
     def init(self):
-        self.get_information()
+        if self.has_information:
+            self.log.debug("File information known, skipping probe request")
+        else:
+            self.get_information()
         self.print_download_information()
         self.initialized = True
         return self
@@ -64,7 +162,7 @@ class DownloadStream(object):
     def setup_file(self):
         self.setup_directories()
         try:
-            utils.set_file_length(self.temp_path, self.size)
+            self.storage.allocate(self.temp_path, self.size)
         except:
             self.log.warning(
                 utils.STRIP(
@@ -139,6 +237,46 @@ class DownloadStream(object):
             header["host"] = host
         return header
 
+    def session(self, max_retries=16):
+        """Return the long-lived pooled session for the current process.
+
+        :param int max_retries: urllib3 retries for the session adapter
+        :returns: A `requests` session
+        """
+        key = (os.getpid(), max_retries)
+        session = self._sessions.get(key)
+        if session is None:
+            adapter = requests.adapters.HTTPAdapter(
+                pool_maxsize=self.connection_pool_size, max_retries=max_retries
+            )
+            session = requests.Session()
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            DownloadStream._sessions[key] = session
+        return session
+
+    @classmethod
+    def connection_stats(cls):
+        """Count the connections opened and reused by this process' sessions.
+
+        :returns: A dictionary with the number of connections opened and
+            the number of requests that reused an existing connection
+        """
+        opened, requests_made = 0, 0
+        for (pid, _), session in cls._sessions.items():
+            if pid != os.getpid():
+                continue
+            adapters = {id(a): a for a in session.adapters.values()}
+            for adapter in adapters.values():
+                pools = adapter.poolmanager.pools
+                for key in pools.keys():
+                    opened += pools[key].num_connections
+                    requests_made += pools[key].num_requests
+        return {
+            "connections_opened": opened,
+            "connections_reused": max(0, requests_made - opened),
+        }
+
     def request(self, headers=None, verify=True, close=False, max_retries=16):
         """Make request for file and return the response.
 
@@ -153,12 +291,11 @@ class DownloadStream(object):
         """
         self.log.debug("Request to {0}".format(self.url))
 
-        # Set urllib3 retries and mount for session
-        a = requests.adapters.HTTPAdapter(max_retries=max_retries)
-        s = requests.Session()
-        s.mount(urlparse(self.url).scheme, a)
+        # Reuse the pooled session, urllib3 retries are set on its adapter
+        s = self.session(max_retries)
 
         headers = self.headers() if headers is None else headers
+        governor.throttle_request()
         try:
             r = s.get(
                 self.url,
@@ -177,31 +314,77 @@ class DownloadStream(object):
         try:
             r.raise_for_status()
         except Exception as e:
-            raise RuntimeError("{0}: {1}".format(str(e), r.text))
+            raise HTTPStatusError("{0}: {1}".format(str(e), r.text), r.status_code)
 
         if close:
             r.close()
         return r
 
+    def set_information(self, size=None, md5sum=None, name=None):
+        """Set what is already known about the file, e.g. from an index of
+        the files, so that :func:`init` only asks the data server for what
+        is missing.
+
+        :param int size: optional. The size of the file in bytes
+        :param str md5sum: optional. The md5sum of the file
+        :param str name: optional. The name to save the file as
+        """
+
+        self.size = size
+        self.md5sum = md5sum
+        self.name = self._parse_filename(name) if name else None
+
+    @property
+    def has_information(self):
+        """Whether the file is known well enough to skip :func:`get_information`"""
+        return (
+            self.size is not None
+            and self.name is not None
+            and (bool(self.md5sum) or not self.check_file_md5sum)
+        )
+
     def get_information(self):
         """Make a request to the data server for information on the file.
 
-        :param str file_id: The id of the entity being requested.
+        Only the first byte is requested, the size of the file comes from
+        the Content-Range of the response. The whole file is requested,
+        and closed once its headers are read, if the server ignores the
+        range or the md5sum is still needed. Information set with
+        :func:`set_information` is kept.
+
         :returns: Tuple containing the name and size of the entity
 
         """
 
-        headers = self.header()
-        r = self.request(headers, close=True)
+        r = None
+        try:
+            r = self.request(self.header(0, 0), close=True)
+        except RuntimeError as e:
+            # e.g. an empty file can't satisfy the range
+            self.log.debug("Range request failed: {0}".format(e))
+
+        if r is None or (
+            r.status_code == 206
+            and self.check_file_md5sum
+            and not self.md5sum
+            and not r.headers.get("content-md5")
+        ):
+            # the md5sum may only come with the whole file
+            r = self.request(self.header(), close=True)
         self.log.debug("Request responded")
 
-        content_length = r.headers.get("Content-Length")
-        if not content_length:
+        if r.status_code == 206:
+            content_length = r.headers.get("Content-Range", "").rpartition("/")[2]
+        else:
+            content_length = r.headers.get("Content-Length")
+        if self.size is None and content_length and content_length.isdigit():
+            self.size = int(content_length)
+
+        if self.size is None:
             self.log.debug("Missing content length.")
             # it also won't come with an md5sum
             self.check_file_md5sum = False
         else:
-            self.size = int(content_length)
             self.log.debug("{0} bytes".format(self.size))
 
         attachment = r.headers.get("content-disposition", None)
@@ -209,27 +392,133 @@ class DownloadStream(object):
 
         # Some of the filenames are set to be equal to an S3 key, which can
         # contain '/' characters and it breaks saving the file
-        self.name = (
-            self._parse_filename(attachment.split("filename=")[-1])
-            if attachment
-            else "untitled"
-        )
+        if self.name is None:
+            self.name = (
+                self._parse_filename(attachment.split("filename=")[-1])
+                if attachment
+                else "untitled"
+            )
 
-        self.md5sum = None
         if self.check_file_md5sum:
-            self.md5sum = r.headers.get("content-md5", "")
+            self.md5sum = self.md5sum or r.headers.get("content-md5", "")
+        else:
+            self.md5sum = None
 
         return self.name, self.size
 
-    def write_segment(self, segment, q_complete, retries=5):
+    @staticmethod
+    def _worker():
+        return os.getpid(), threading.get_ident()
+
+    def write_chunk(self, chunk, offset):
+        """Write a downloaded chunk to the temp file at the given offset.
+
+        With the ``pwrite`` write method the temp file is opened once per
+        worker and written with positional writes, otherwise it is
+        reopened for every chunk.
+
+        :param chunk: bytes-like data to write
+        :param int offset: position of the chunk in the file
+        """
+        if self.write_method != "pwrite":
+            utils.write_offset(self.temp_path, chunk, offset)
+            return
+
+        fd = self._fds.get(self._worker())
+        if fd is None:
+            fd = self._fds[self._worker()] = os.open(
+                self.temp_path, os.O_WRONLY | getattr(os, "O_BINARY", 0)
+            )
+        utils.pwrite_all(fd, chunk, offset)
+
+    def receive_buffer(self, size):
+        """Return ``size`` bytes of the receive buffer of the current worker,
+        which grows to the largest chunk size asked for."""
+        view = getattr(self._buffers, "view", None)
+        if view is None or len(view) < size:
+            view = self._buffers.view = memoryview(bytearray(size))
+        return view[:size]
+
+    def iter_response(self, r, chunk_size=None):
+        """Iterate over the body of a segment response.
+
+        A body sent without a content encoding is read into the receive
+        buffer of the worker, and each chunk is a memoryview of that
+        buffer, only valid until the next one is read. Encoded bodies are
+        decoded by requests.
+
+        :param r: A streamed `requests` response
+        :param int chunk_size: optional. Defaults to ``http_chunk_size``
+        :returns: A generator of chunks
+        :raises urllib3.exceptions.ProtocolError:
+            when the body ends before its Content-Length
+        """
+        chunk_size = chunk_size or self.http_chunk_size
+        encoding = r.headers.get("content-encoding", "identity").lower()
+        if encoding != "identity" or not hasattr(r.raw, "readinto"):
+            yield from r.iter_content(chunk_size=chunk_size)
+            return
+
+        view = self.receive_buffer(chunk_size)
+        received = 0
+        while True:
+            count = r.raw.readinto(view)
+            if not count:
+                break
+            received += count
+            yield view[:count]
+
+        # older urllib3 versions end a truncated body quietly
+        expected = r.headers.get("content-length")
+        if expected and expected.isdigit() and received < int(expected):
+            raise IncompleteRead(received, int(expected) - received)
+        # the whole body was read, the connection can be reused
+        r.raw.release_conn()
+
+    def evict_written(self, offset, length):
+        """Drop written data from the page cache."""
+        fd = self._fds.get(self._worker())
+        if fd is not None:
+            self.storage.evict(fd, offset, length)
+
+    def close_file(self):
+        """Close the temp file descriptor held by the current worker."""
+        fd = self._fds.pop(self._worker(), None)
+        if fd is not None:
+            os.close(fd)
+
+    def write_segment(
+        self,
+        segment,
+        q_complete,
+        retries=5,
+        limits=None,
+        chunk_sizer=None,
+        hash_limit=None,
+    ):
         """Read data from the data server and write it to a file.
 
         :param str file_id: The id of the file
         :params str path: A string specifying the full download path
         :params tuple segment:
             A tuple containing the interval to download (start, end)
+            and the id of the task it belongs to
         :params q_out: A multiprocessing Queue used for async reporting
+        :params dict limits:
+            optional. Shared mapping of task id to a new end of the
+            segment, set by the producer when it gives the rest of the
+            segment to an idle worker
+        :param chunk_sizer:
+            optional. The ChunkSizer of the worker's connection, which
+            chooses the chunk size and learns from how the segment went.
+            Without one, chunks are ``http_chunk_size`` bytes
+        :param int hash_limit:
+            optional. The bytes received before this offset are sent to
+            the producer along with the chunks, for the md5sum of the file
         :returns: The total number of bytes written
+        :raises HTTPStatusError:
+            when the data server refuses the segment for good, e.g. with
+            403 Forbidden, rather than retrying it
 
         """
 
@@ -240,51 +529,94 @@ class DownloadStream(object):
         # the interval.
         start, end = segment.begin, segment.end - 1
         assert end >= start, "Invalid segment range."
+        stop = segment.end
+        last_limit_check = time.time()
+        batch = CompletionBatch(q_complete, self.report_size, self.report_interval)
+        chunk_size = self.http_chunk_size if chunk_sizer is None else chunk_sizer.size
 
         try:
             # Initialize segment request
             r = self.request(self.header(start, end))
+            started = time.time()
 
             # Iterate over the data stream
             self.log.debug("Initializing segment: {0}-{1}".format(start, end))
-            for chunk in r.iter_content(chunk_size=self.http_chunk_size):
-                if not chunk:
-                    continue  # Empty are keep-alives.
-                offset = start + written
-
-                # Write the chunk to disk, create an interval that
-                # represents the chunk, get md5 info if necessary, and
-                # report completion back to the producer
-                utils.write_offset(self.temp_path, chunk, offset)
-                if self.check_segment_md5sums:
-                    iv_data = {"md5sum": utils.md5sum(chunk)}
-                else:
-                    iv_data = None
-                complete_segment = Interval(offset, offset + len(chunk), iv_data)
-                q_complete.put(complete_segment)
-
-                written += len(chunk)
+            try:
+                chunks = self.storage.aligned_chunks(
+                    self.iter_response(r, chunk_size), start, chunk_size
+                )
+                for chunk in chunks:
+                    if not chunk:
+                        continue  # Empty are keep-alives.
+                    offset = start + written
+
+                    # Check now and then whether part of this segment was
+                    # handed to another worker
+                    if (
+                        limits is not None
+                        and time.time() - last_limit_check >= self.limit_check_interval
+                    ):
+                        last_limit_check = time.time()
+                        stop = min(stop, limits.get(segment.data, stop))
+                    if offset >= stop:
+                        break
+                    chunk = chunk[: stop - offset]
+                    governor.throttle_bytes(len(chunk))
+
+                    # Write the chunk to disk, get md5 info if necessary,
+                    # and add it to the batch reported back to the producer
+                    self.write_chunk(chunk, offset)
+                    received = None
+                    if hash_limit is not None and offset + len(chunk) <= hash_limit:
+                        received = chunk
+                    if self.check_segment_md5sums:
+                        batch.add(offset, len(chunk), utils.md5sum(chunk), received)
+                    else:
+                        batch.add(offset, len(chunk), received=received)
+
+                    written += len(chunk)
+            finally:
+                # whatever was written is reported, even if the rest of
+                # the segment is retried
+                batch.flush()
+                self.evict_written(start, written)
 
         except KeyboardInterrupt:
             return self.log.error("Process stopped by user.")
 
         # Retry on exception if we haven't exceeded max retries
         except Exception as e:
+            if written >= stop - segment.begin:
+                # the rest of the segment was handed to another worker
+                return written
+            if isinstance(e, HTTPStatusError) and not e.retryable:
+                raise
+
             # TODO FIXME HACK create new segment to avoid duplicate downloads
-            segment = Interval(segment.begin + written, segment.end, None)
+            segment = Interval(segment.begin + written, stop, segment.data)
+            if chunk_sizer is not None:
+                chunk_sizer.failed(written)
 
             self.log.debug("Unable to download part of file: {0}\n.".format(str(e)))
             if retries > 0:
                 self.log.debug("Retrying download of this segment")
-                return self.write_segment(segment, q_complete, retries - 1)
+                return self.write_segment(
+                    segment, q_complete, retries - 1, limits, chunk_sizer, hash_limit
+                )
             else:
                 self.log.error("Max retries exceeded.")
                 return 0
 
-        # Check that the data is not truncated or elongated
-        if written != segment.end - segment.begin:
+        r.close()
+
+        # Check that the data is not truncated. A worker may have written
+        # past the point where the rest of its segment was handed to another
+        # worker before it noticed, which is fine as the data is the same
+        if written < stop - segment.begin:
             # TODO FIXME HACK create new segment to avoid duplicate downloads
-            segment = Interval(segment.begin + written, segment.end, None)
+            segment = Interval(segment.begin + written, stop, segment.data)
+            if chunk_sizer is not None:
+                chunk_sizer.failed(written)
 
             self.log.debug(
                 "Segment corruption: {0}".format(
@@ -292,11 +624,14 @@ class DownloadStream(object):
                 )
             )
             if retries:
-                return self.write_segment(segment, q_complete, retries - 1)
+                return self.write_segment(
+                    segment, q_complete, retries - 1, limits, chunk_sizer, hash_limit
+                )
             else:
                 raise RuntimeError("Segment corruption. Max retries exceeded.")
 
-        r.close()
+        if chunk_sizer is not None:
+            chunk_sizer.succeeded(written, time.time() - started)
         return written
 
     def print_download_information(self):
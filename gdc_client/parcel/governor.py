@@ -0,0 +1,172 @@
+import logging
+import multiprocessing
+import os
+import time
+
+log = logging.getLogger("governor")
+
+# names of the limits that can be set in a limits file
+LIMITS = ("max_bandwidth", "max_request_rate")
+
+
+class TokenBucket(object):
+    """Tokens refilled at ``rate`` per second, up to one second worth.
+
+    The bucket lives in shared memory so download workers forked from the
+    process that created it draw from the same tokens. Taking more tokens
+    than are available puts the bucket in debt, and the caller sleeps
+    until the debt would be paid off.
+    """
+
+    def __init__(self, rate, lock):
+        self._lock = lock
+        # rate, tokens, time of the last refill
+        self._state = multiprocessing.RawArray("d", [rate, rate, time.monotonic()])
+
+    @property
+    def rate(self):
+        return self._state[0]
+
+    def set_rate(self, rate):
+        with self._lock:
+            self._state[0] = rate
+            self._state[1] = min(self._state[1], rate)
+
+    def take(self, amount):
+        """Take ``amount`` tokens, sleeping until they are paid for.
+
+        :param float amount: number of tokens to take
+        :returns: the number of seconds slept
+        """
+        if self._state[0] <= 0:
+            return 0
+
+        with self._lock:
+            rate, tokens, stamp = self._state
+            if rate <= 0:
+                return 0
+            now = time.monotonic()
+            tokens = min(rate, tokens + (now - stamp) * rate) - amount
+            self._state[1] = tokens
+            self._state[2] = now
+
+        wait = -tokens / rate if tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+        return wait
+
+
+def read_limits(path):
+    """Read limits from a file of ``name = value`` lines.
+
+    :param str path: path of the limits file
+    :returns: A dictionary of the limits set in the file
+    """
+    limits = {}
+    with open(path) as f:
+        for line in f:
+            line = line.split("#", 1)[0].strip()
+            if not line:
+                continue
+            name, _, value = line.partition("=")
+            name = name.strip().replace("-", "_")
+            if name not in LIMITS:
+                log.warning("Unknown limit in {0}: {1}".format(path, name))
+                continue
+            limits[name] = float(value)
+    return limits
+
+
+class Governor(object):
+    """Bandwidth and request rate limits shared by all downloads.
+
+    Every download worker, grouped small file download and metadata query
+    draws from the same token buckets, so the limits hold for the client
+    as a whole. A limit of 0 means unlimited. When a ``limits_file`` is
+    given it is checked for changes every ``check_interval`` seconds, so
+    the limits of a running download can be adjusted by editing it.
+    """
+
+    check_interval = 1
+
+    def __init__(self, max_bandwidth=0, max_request_rate=0, limits_file=None):
+        lock = multiprocessing.Lock()
+        self.bandwidth = TokenBucket(max_bandwidth or 0, lock)
+        self.requests = TokenBucket(max_request_rate or 0, lock)
+        self.limits_file = limits_file
+        # time of the last check and modification time of the limits file
+        self._checked = multiprocessing.RawArray("d", [0, 0])
+        self.check_limits_file(force=True)
+
+    def take_bytes(self, count):
+        self.check_limits_file()
+        return self.bandwidth.take(count)
+
+    def take_request(self):
+        self.check_limits_file()
+        return self.requests.take(1)
+
+    def check_limits_file(self, force=False):
+        """Apply the limits file if it changed since it was last read."""
+        if not self.limits_file:
+            return
+        now = time.monotonic()
+        if not force and now - self._checked[0] < self.check_interval:
+            return
+        self._checked[0] = now
+
+        try:
+            mtime = os.path.getmtime(self.limits_file)
+            if mtime == self._checked[1]:
+                return
+            self._checked[1] = mtime
+            limits = read_limits(self.limits_file)
+        except (OSError, ValueError) as e:
+            log.warning(
+                "Unable to read limits file {0}: {1}".format(self.limits_file, e)
+            )
+            return
+
+        if "max_bandwidth" in limits:
+            self.bandwidth.set_rate(limits["max_bandwidth"])
+        if "max_request_rate" in limits:
+            self.requests.set_rate(limits["max_request_rate"])
+        log.debug(
+            "Limits: {0:.0f} B/s, {1:g} requests/s".format(
+                self.bandwidth.rate, self.requests.rate
+            )
+        )
+
+
+# The governor of this process, inherited by forked download workers
+_governor = None
+
+
+def configure(max_bandwidth=0, max_request_rate=0, limits_file=None):
+    """Set the limits every download and query of this process draws from.
+
+    :param int max_bandwidth: bytes per second, 0 for unlimited
+    :param float max_request_rate: requests per second, 0 for unlimited
+    :param str limits_file:
+        optional. File of ``name = value`` lines that overrides the
+        limits while the client runs
+    :returns: The new governor, or None if nothing is limited
+    """
+    global _governor
+    if max_bandwidth or max_request_rate or limits_file:
+        _governor = Governor(max_bandwidth, max_request_rate, limits_file)
+    else:
+        _governor = None
+    return _governor
+
+
+def throttle_bytes(count):
+    """Wait until ``count`` bytes may be transferred."""
+    if _governor is not None:
+        _governor.take_bytes(count)
+
+
+def throttle_request():
+    """Wait until another request may be made."""
+    if _governor is not None:
+        _governor.take_request()
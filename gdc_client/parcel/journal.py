@@ -0,0 +1,192 @@
+import logging
+import os
+import pickle
+import struct
+import zlib
+
+from intervaltree import Interval, IntervalTree
+
+log = logging.getLogger("journal")
+
+# A journal starts with a header naming the format and its version,
+# followed by one record per completed interval:
+#
+#   begin, end, chunk_size, count    RECORD
+#   count 16 byte md5 digests        one per chunk_size long chunk
+#   crc32 of the above               CHECKSUM
+#
+# Records are only ever appended, a record cut short by a crash fails its
+# checksum and everything from there on is ignored.
+MAGIC = b"PARCELJ\0"
+VERSION = 1
+HEADER = struct.Struct("<8sI")
+RECORD = struct.Struct("<QQII")
+CHECKSUM = struct.Struct("<I")
+DIGEST_SIZE = 16
+
+
+def encode_interval(interval):
+    """Serialize a completed interval as a journal record."""
+    data = interval.data or {}
+    if "md5sums" in data:
+        chunk_size, md5sums = data["chunk_size"], data["md5sums"]
+    elif data.get("md5sum"):
+        chunk_size, md5sums = interval.end - interval.begin, [data["md5sum"]]
+    else:
+        chunk_size, md5sums = 0, []
+
+    record = RECORD.pack(interval.begin, interval.end, chunk_size, len(md5sums))
+    record += b"".join(bytes.fromhex(checksum) for checksum in md5sums)
+    return record + CHECKSUM.pack(zlib.crc32(record))
+
+
+def decode_intervals(buf):
+    """Parse the records of a journal, stopping at the first torn one.
+
+    :param bytes buf: journal contents after the header
+    :returns: A list of intervals
+    """
+    intervals, pos = [], 0
+    while pos + RECORD.size <= len(buf):
+        begin, end, chunk_size, count = RECORD.unpack_from(buf, pos)
+        size = RECORD.size + count * DIGEST_SIZE
+        if pos + size + CHECKSUM.size > len(buf):
+            break
+        record = buf[pos : pos + size]
+        (crc,) = CHECKSUM.unpack_from(buf, pos + size)
+        if crc != zlib.crc32(record) or end < begin:
+            break
+        pos += size + CHECKSUM.size
+
+        digests = record[RECORD.size :]
+        md5sums = [
+            digests[i : i + DIGEST_SIZE].hex()
+            for i in range(0, len(digests), DIGEST_SIZE)
+        ]
+        iv_data = {"md5sums": md5sums, "chunk_size": chunk_size} if count else None
+        intervals.append(Interval(begin, end, iv_data))
+
+    if pos < len(buf):
+        log.warning("Ignoring {0} bytes of torn journal records".format(len(buf) - pos))
+    return intervals
+
+
+def _mergeable(a, b):
+    if a.end != b.begin:
+        return False
+    if a.data is None or b.data is None:
+        return a.data is None and b.data is None
+    chunk_size = a.data["chunk_size"]
+    return (
+        b.data["chunk_size"] == chunk_size
+        and a.end - a.begin == chunk_size * len(a.data["md5sums"])
+        and b.end - b.begin <= chunk_size * len(b.data["md5sums"])
+    )
+
+
+def compact_intervals(completed):
+    """Merge adjacent intervals whose chunks line up into single records.
+
+    :param IntervalTree completed: intervals written to disk
+    :returns: A sorted list of intervals covering the same bytes
+    """
+    merged = []
+    for interval in sorted(completed.items()):
+        data = interval.data or {}
+        if data.get("md5sum"):
+            # chunks of the old state format, one md5sum each
+            data = {"md5sums": [data["md5sum"]], "chunk_size": interval.length()}
+            interval = Interval(interval.begin, interval.end, data)
+        elif "md5sums" not in data:
+            interval = Interval(interval.begin, interval.end)
+
+        if merged and _mergeable(merged[-1], interval):
+            last = merged.pop()
+            data = None
+            if last.data is not None:
+                data = {
+                    "md5sums": last.data["md5sums"] + interval.data["md5sums"],
+                    "chunk_size": last.data["chunk_size"],
+                }
+            interval = Interval(last.begin, interval.end, data)
+        merged.append(interval)
+    return merged
+
+
+class Journal(object):
+    """Append-only record of the completed intervals of a download.
+
+    Every checkpoint appends the intervals completed since the previous
+    one, so its cost does not depend on the size of the file. The journal
+    is rewritten from the completed intervals when it is first saved by a
+    process and once ``compact_records`` records have been appended.
+    """
+
+    compact_records = 1024
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+        self.appended = 0
+        self.stale = False
+
+    def load(self):
+        """Read the completed intervals from the journal.
+
+        State files written with pickle by earlier versions are loaded as
+        well, they are replaced by a journal on the next compaction.
+
+        :returns: An IntervalTree of completed intervals
+        """
+        with open(self.path, "rb") as f:
+            buf = f.read()
+
+        if not buf.startswith(MAGIC):
+            completed = pickle.loads(buf)
+            assert isinstance(completed, IntervalTree), "Bad save state: {0}".format(
+                self.path
+            )
+            return completed
+
+        magic, version = HEADER.unpack_from(buf)
+        if version != VERSION:
+            raise ValueError(
+                "Unsupported journal version {0}: {1}".format(version, self.path)
+            )
+        return IntervalTree(decode_intervals(buf[HEADER.size :]))
+
+    @property
+    def needs_compaction(self):
+        return self._file is None or self.stale or self.appended >= self.compact_records
+
+    def mark_stale(self):
+        """Rewrite the journal at the next checkpoint, e.g. because
+        intervals were found corrupt after they were recorded."""
+        self.stale = True
+
+    def write(self, f, completed):
+        """Write a compacted journal of ``completed`` to the file ``f``."""
+        f.write(HEADER.pack(MAGIC, VERSION))
+        for interval in compact_intervals(completed):
+            f.write(encode_interval(interval))
+
+    def reopen(self):
+        """Start appending to a journal that was just compacted."""
+        self.close()
+        self._file = open(self.path, "ab")
+        self.appended = 0
+        self.stale = False
+
+    def append(self, intervals):
+        """Append records for ``intervals`` and flush them to disk."""
+        if not intervals:
+            return
+        self._file.write(b"".join(encode_interval(i) for i in intervals))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self.appended += len(intervals)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
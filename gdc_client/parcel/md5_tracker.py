@@ -0,0 +1,303 @@
+import ctypes
+import ctypes.util
+import hashlib
+import logging
+import os
+import struct
+import threading
+
+from gdc_client.parcel.const import MB, MD5_BUFFER_SIZE
+
+log = logging.getLogger("md5_tracker")
+
+# A checkpoint holds the file it was taken for, how far the file was
+# hashed and the state of the hash at that point
+CHECKPOINT_MAGIC = b"PARCELM\0"
+CHECKPOINT = struct.Struct("<8sQ32sQI")
+
+
+class ResumableMd5(object):
+    """An md5 hash whose state can be saved and restored.
+
+    hashlib does not expose the state of a hash, so where libcrypto can be
+    loaded its MD5 functions are called directly and the MD5_CTX is the
+    state. Elsewhere the hash falls back to hashlib and has no state.
+    """
+
+    # larger than an MD5_CTX of any OpenSSL version, which is 92 bytes
+    state_size = 128
+    _lib = None
+
+    def __init__(self, state=None):
+        lib = self.libcrypto()
+        self._md5 = None
+        self._ctx = None
+        if lib is None:
+            self._md5 = hashlib.md5()
+        elif state is not None:
+            self._ctx = ctypes.create_string_buffer(state, self.state_size)
+        else:
+            self._ctx = ctypes.create_string_buffer(self.state_size)
+            lib.MD5_Init(self._ctx)
+
+    @classmethod
+    def libcrypto(cls):
+        """Return libcrypto with its MD5 functions set up, or None."""
+        if cls._lib is None:
+            cls._lib = False
+            try:
+                lib = ctypes.CDLL(ctypes.util.find_library("crypto"))
+                lib.MD5_Init.argtypes = [ctypes.c_void_p]
+                lib.MD5_Update.argtypes = [
+                    ctypes.c_void_p,
+                    ctypes.c_void_p,
+                    ctypes.c_size_t,
+                ]
+                lib.MD5_Final.argtypes = [ctypes.c_void_p, ctypes.c_void_p]
+                cls._lib = lib
+            except (OSError, TypeError, AttributeError) as e:
+                log.debug("Unable to load libcrypto, md5 can't resume: {0}".format(e))
+        return cls._lib or None
+
+    @property
+    def state(self):
+        """The state of the hash as bytes, or None if it has none."""
+        return None if self._ctx is None else self._ctx.raw
+
+    def update(self, data):
+        if not len(data):
+            return
+        if self._md5 is not None:
+            self._md5.update(data)
+            return
+        if not isinstance(data, bytes):
+            view = memoryview(data)
+            if view.readonly:
+                data = bytes(view)
+            else:
+                data = (ctypes.c_char * view.nbytes).from_buffer(view)
+        self.libcrypto().MD5_Update(self._ctx, data, len(data))
+
+    def hexdigest(self):
+        if self._md5 is not None:
+            return self._md5.hexdigest()
+        # finalize a copy, so the hash can still be updated
+        ctx = ctypes.create_string_buffer(self._ctx.raw, self.state_size)
+        digest = ctypes.create_string_buffer(16)
+        self.libcrypto().MD5_Final(digest, ctx)
+        return digest.raw.hex()
+
+
+class Md5Tracker(object):
+    """Compute the md5sum of a file while it is being downloaded.
+
+    Segments complete out of order, so the tracker follows the contiguous
+    "written up to" watermark of the completed intervals and hashes bytes
+    as soon as everything before them is on disk. Workers send the bytes
+    they received along with the intervals they completed, those are kept
+    until the watermark reaches them, up to ``buffer_size`` bytes. Bytes
+    that were not sent, or did not fit, are read back from disk.
+
+    The state of the hash is saved in a checkpoint next to the journal, so
+    a resumed download carries on hashing where it stopped.
+    """
+
+    read_size = MB
+
+    def __init__(
+        self,
+        path,
+        size,
+        storage=None,
+        checkpoint_path=None,
+        md5sum=None,
+        buffer_size=MD5_BUFFER_SIZE,
+    ):
+        """
+        :param str path: the partial file
+        :param int size: size of the file
+        :param storage: optional. Evicts the bytes hashed from the page cache
+        :param str checkpoint_path: optional. Where the state is saved
+        :param str md5sum: optional. Expected md5sum, ties a checkpoint to
+            the file it was taken for
+        :param int buffer_size: bytes received ahead of the watermark kept
+        """
+        self.path = path
+        self.size = size
+        self.storage = storage
+        self.checkpoint_path = checkpoint_path
+        self.md5sum = md5sum or ""
+        self.buffer_size = buffer_size
+        self.offset = 0
+        self._md5 = ResumableMd5()
+        self._file = None
+        # received bytes ahead of the watermark, by offset
+        self._pending = {}
+        self._buffered = 0
+        # the watermark is moved by the producer, or by the verification
+        # of a resumed download while the producer buffers received bytes
+        self._lock = threading.Lock()
+
+    @property
+    def complete(self):
+        return self.offset == self.size
+
+    def add(self, offset, data):
+        """Keep bytes received at ``offset`` until the watermark reaches
+        them, if they fit in the buffer."""
+        with self._lock:
+            if offset + len(data) <= self.offset:
+                return
+            if self._buffered + len(data) > self.buffer_size:
+                return
+            self._pending[offset] = data
+            self._buffered += len(data)
+
+    def update(self, data):
+        """Hash data that starts at the current watermark."""
+        with self._lock:
+            self._update(data)
+
+    def update_at(self, offset, data):
+        """Hash the part of ``data`` read at ``offset`` that is past the
+        watermark.
+
+        :returns: True if the watermark reached the end of the data
+        """
+        end = offset + len(data)
+        with self._lock:
+            if offset <= self.offset < end:
+                self._update(memoryview(data)[self.offset - offset :])
+            return self.offset >= end
+
+    def _update(self, data):
+        self._md5.update(data)
+        self.offset += len(data)
+
+    def _take_pending(self, end):
+        """Hash buffered bytes at the watermark, up to ``end``.
+
+        :returns: True if any bytes were hashed
+        """
+        for begin in sorted(self._pending):
+            data = self._pending[begin]
+            if begin <= self.offset < begin + len(data):
+                stop = min(end, begin + len(data))
+                self._update(memoryview(data)[self.offset - begin : stop - begin])
+                return True
+        return False
+
+    def _drop_pending(self):
+        for begin in list(self._pending):
+            data = self._pending[begin]
+            if begin + len(data) <= self.offset:
+                del self._pending[begin]
+                self._buffered -= len(data)
+
+    def _read(self, end):
+        """Hash bytes read back from disk, up to ``end`` or the next
+        buffered bytes."""
+        following = [begin for begin in self._pending if begin > self.offset]
+        end = min([end] + following)
+        if self._file is None:
+            # unbuffered, read-ahead could hold bytes that are rewritten
+            # before the watermark reaches them
+            self._file = open(self.path, "rb", buffering=0)
+        self._file.seek(self.offset)
+        while self.offset < end:
+            data = self._file.read(min(self.read_size, end - self.offset))
+            if not data:
+                log.debug("{0} is shorter than expected".format(self.path))
+                return False
+            self._update(data)
+        return True
+
+    def advance(self, completed):
+        """Hash all bytes that became contiguous in ``completed``.
+
+        :param IntervalTree completed: intervals that are written to disk
+        """
+        end = self.offset
+        while True:
+            ends = [interval.end for interval in completed.at(end)]
+            if not ends:
+                break
+            end = max(ends)
+
+        with self._lock:
+            start = self.offset
+            while self.offset < end:
+                if not self._take_pending(end) and not self._read(end):
+                    break
+            self._drop_pending()
+            if self.storage is not None and self.offset > start:
+                if self._file is None:
+                    self._file = open(self.path, "rb", buffering=0)
+                self.storage.evict(self._file.fileno(), start, self.offset - start)
+
+    def save_checkpoint(self):
+        """Save how far the file was hashed and the state of the hash."""
+        if not self.checkpoint_path or self._md5.state is None:
+            return
+        with self._lock:
+            state = self._md5.state
+            record = CHECKPOINT.pack(
+                CHECKPOINT_MAGIC,
+                self.size,
+                self.md5sum.encode("ascii"),
+                self.offset,
+                len(state),
+            )
+            record += state
+        temp = self.checkpoint_path + ".tmp"
+        with open(temp, "wb") as f:
+            f.write(record)
+        os.replace(temp, self.checkpoint_path)
+
+    def load_checkpoint(self):
+        """Carry on from the checkpoint of an interrupted download.
+
+        :returns: True if the checkpoint was loaded
+        """
+        if (
+            not self.checkpoint_path
+            or not os.path.isfile(self.checkpoint_path)
+            or ResumableMd5.libcrypto() is None
+        ):
+            return False
+        try:
+            with open(self.checkpoint_path, "rb") as f:
+                buf = f.read()
+            magic, size, md5sum, offset, length = CHECKPOINT.unpack_from(buf)
+            state = buf[CHECKPOINT.size : CHECKPOINT.size + length]
+        except (OSError, struct.error) as e:
+            log.debug("Unable to read md5 checkpoint: {0}".format(e))
+            return False
+        if (
+            magic != CHECKPOINT_MAGIC
+            or size != self.size
+            or md5sum.rstrip(b"\0").decode("ascii", "replace") != self.md5sum
+            or len(state) != length
+            or offset > size
+        ):
+            log.debug("Ignoring md5 checkpoint of another file")
+            return False
+
+        self._md5 = ResumableMd5(state)
+        self.offset = offset
+        log.debug("Resuming md5sum at {0} bytes".format(offset))
+        return True
+
+    def discard_checkpoint(self):
+        """Remove the checkpoint of a download that starts over."""
+        if self.checkpoint_path and os.path.isfile(self.checkpoint_path):
+            os.remove(self.checkpoint_path)
+
+    def hexdigest(self):
+        """Return the md5sum of the file, or None if it is not complete."""
+        return self._md5.hexdigest() if self.complete else None
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
@@ -6,10 +6,11 @@
 # Availability: https://github.com/LabAdvComp/parcel
 # ***************************************************************************************
 
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 import logging
 import math
 import os
-import pickle
 import random
 import string
 import tempfile
@@ -18,23 +19,30 @@ import sys
 
 from intervaltree import Interval, IntervalTree
 
+from gdc_client.parcel.journal import Journal
+from gdc_client.parcel.md5_tracker import Md5Tracker
 from gdc_client.parcel.portability import OS_WINDOWS
 from gdc_client.parcel.utils import (
     get_file_transfer_pbar,
-    get_percentage_pbar,
     md5sum,
-    mmap_open,
     STRIP,
     check_file_existence_and_size,
     validate_file_md5sum,
 )
-from gdc_client.parcel.const import SAVE_INTERVAL
+from gdc_client.parcel.const import (
+    ENGINE,
+    INITIAL_SEGMENT_SIZE,
+    MIN_SEGMENT_SIZE,
+    SAVE_INTERVAL,
+    SEGMENT_SECONDS,
+)
+
+from queue import Queue
 
 if OS_WINDOWS:
     WINDOWS = True
-    from queue import Queue
 else:
-    # if we are running on a posix system, then we will be
+    # if we are running on a posix system, then we may be
     # communicating across processes, and will need
     # multiprocessing manager
     from multiprocessing import Manager
@@ -43,12 +51,57 @@ else:
 
 log = logging.getLogger("segment")
 
+# Sent by a worker once it is done with a segment, whether it succeeded or not
+TaskDone = namedtuple("TaskDone", ["task_id"])
+# Sent by a worker when the data server refused a segment for good, the
+# download fails with the error
+Failed = namedtuple("Failed", ["error"])
+# Sent once a completed interval of a resumed download was checked, with
+# the chunks of it that turned out to be corrupt
+Verified = namedtuple("Verified", ["interval", "corrupt"])
+
+
+def interval_chunks(interval):
+    """Yield ``(begin, end, md5sum)`` for the chunks of a completed interval.
+
+    An interval either carries the md5sum of a single chunk or, when a
+    worker reported several adjacent chunks at once, the md5sums of
+    ``chunk_size`` long chunks in a side list.
+    """
+    data = interval.data or {}
+    if "md5sums" in data:
+        chunk_size = data["chunk_size"]
+        for i, checksum in enumerate(data["md5sums"]):
+            begin = interval.begin + i * chunk_size
+            yield begin, min(begin + chunk_size, interval.end), checksum
+    else:
+        yield interval.begin, interval.end, data.get("md5sum")
+
+
+class Task(object):
+    """A segment handed out to a worker and how far the worker has got."""
+
+    def __init__(self, task_id, begin, end):
+        self.id = task_id
+        self.begin = begin
+        self.end = end
+        self.progress = begin
+        self.started = time.time()
+
+    @property
+    def remaining(self):
+        return self.end - self.progress
+
 
 class SegmentProducer(object):
 
     save_interval = SAVE_INTERVAL
+    initial_segment_size = INITIAL_SEGMENT_SIZE
+    min_segment_size = MIN_SEGMENT_SIZE
+    segment_seconds = SEGMENT_SECONDS
+    verify_threads = min(8, os.cpu_count() or 1)
 
-    def __init__(self, download, n_procs):
+    def __init__(self, download, n_procs, engine=ENGINE):
 
         assert (
             download.size is not None
@@ -56,8 +109,12 @@ class SegmentProducer(object):
 
         self.download = download
         self.n_procs = n_procs
+        self.engine = engine
         self.pbar = None
         self.done = False
+        self.verifying = 0
+        # why the download failed, if a segment was refused
+        self.error = None
 
         # Initialize producer
         self.load_state()
@@ -66,63 +123,172 @@ class SegmentProducer(object):
             self._setup_queues()
             self._setup_work()
             self.schedule()
+            self.start_verification()
+
+    def _setup_md5_tracker(self):
+        self.md5_tracker = None
+        if (
+            self.download.check_file_md5sum
+            and self.download.md5sum
+            and self.download.is_regular_file
+        ):
+            self.md5_tracker = Md5Tracker(
+                self.download.temp_path,
+                self.download.size,
+                self.download.storage,
+                checkpoint_path=self.download.state_path + ".md5",
+                md5sum=self.download.md5sum,
+            )
 
     def _setup_pbar(self):
         self.pbar = get_file_transfer_pbar(self.download.url, self.download.size)
 
     def _setup_work(self):
+        # Segments are handed out on demand, start small and adapt the
+        # block size once the per-connection throughput is known
         work_size = self.integrate(self.work_pool)
-        self.block_size = work_size // self.n_procs
-        self.total_tasks = math.ceil(work_size / self.block_size)
-        log.debug("Total number of tasks: {0}".format(self.total_tasks))
+        self.block_size = max(
+            1, min(math.ceil(work_size / self.n_procs), self.initial_segment_size)
+        )
+        if not work_size:
+            # corrupt segments found on resume are the only work left
+            self.block_size = self.initial_segment_size
+        self.in_flight = {}
+        self.connection_rate = None
+        log.debug("Initial block size: {0}".format(self.block_size))
 
     def _setup_queues(self):
-        if WINDOWS:
+        # Workers running as threads share plain queues with the producer,
+        # only separate processes need them served by a Manager
+        if WINDOWS or self.engine != "processes":
             self.q_work = Queue()
             self.q_complete = Queue()
+            self.q_report = Queue()
+            self.segment_limits = {}
+            self.hash_limits = {}
         else:
             manager = Manager()
             self.q_work = manager.Queue()
             self.q_complete = manager.Queue()
+            self.q_report = manager.Queue()
+            self.segment_limits = manager.dict()
+            self.hash_limits = manager.dict()
 
     def integrate(self, itree):
-        return sum([i.end - i.begin for i in itree.items()])
+        """Return the number of bytes covered by the intervals in ``itree``.
 
-    def validate_segment_md5sums(self, path=None):
-        if not self.download.check_segment_md5sums:
-            return True
-        corrupt_segments = 0
+        Intervals may overlap when a worker wrote past a split point before
+        noticing it, overlapping bytes are only counted once.
+        """
+        total, reach = 0, 0
+        for i in sorted(itree.items()):
+            if i.end > reach:
+                total += i.end - max(i.begin, reach)
+                reach = i.end
+        return total
+
+    def start_verification(self):
+        """Check the md5sums of the segments of a resumed download.
+
+        The segments are hashed by a pool of threads while the missing
+        ranges are downloaded, results come back on ``q_complete``. The
+        segments that follow on from the md5sum's watermark are checked in
+        order by one of the threads, which hands the intact bytes on to
+        the md5sum rather than having them read again afterwards.
+        """
+        self.verifying = 0
+        if not self.download.check_segment_md5sums or not self.completed:
+            return
         intervals = sorted(self.completed.items())
+        for interval in intervals:
+            if not interval.data or not (
+                "md5sum" in interval.data or "md5sums" in interval.data
+            ):
+                log.error(
+                    STRIP(
+                        """User opted to check segment md5sums on restart.
+                    Previous download did not record segment
+                    md5sums (--no-segment-md5sums)."""
+                    )
+                )
+                return
+
+        prefix = []
+        if self.md5_tracker:
+            reach = self.md5_tracker.offset
+            for interval in intervals:
+                if interval.begin <= reach < interval.end:
+                    prefix.append(interval)
+                    reach = interval.end
 
         log.debug("Checksumming {0}:".format(self.download.url))
+        self.verifying = len(intervals)
+        self.corrupt_segments = 0
+        self._verify_pool = ThreadPoolExecutor(max_workers=self.verify_threads)
+        if prefix:
+            self._verify_pool.submit(
+                self._verify_intervals, prefix, self.download.temp_path, True
+            )
+        for interval in intervals:
+            if interval not in prefix:
+                self._verify_pool.submit(
+                    self._verify_intervals, [interval], self.download.temp_path
+                )
+        self._verify_pool.shutdown(wait=False)
 
-        pbar = get_percentage_pbar(len(intervals))
-
-        with mmap_open(path or self.download.path) as data:
-            for interval in pbar(intervals):
-                log.debug("Checking segment md5: {0}".format(interval))
-                if not interval.data or "md5sum" not in interval.data:
-                    log.error(
-                        STRIP(
-                            """User opted to check segment md5sums on restart.
-                        Previous download did not record segment
-                        md5sums (--no-segment-md5sums)."""
-                        )
-                    )
-                    return
-                chunk = data[interval.begin : interval.end]
-                checksum = md5sum(chunk)
-                if checksum != interval.data.get("md5sum"):
+    def _verify_intervals(self, intervals, path, feed=False):
+        """Check the chunks of ``intervals`` in order.
+
+        :param bool feed: hand the chunks on to the md5sum of the file
+            until one is corrupt
+        """
+        for interval in intervals:
+            corrupt = []
+            try:
+                with open(path, "rb") as f:
+                    for begin, end, expected in interval_chunks(interval):
+                        f.seek(begin)
+                        data = f.read(end - begin)
+                        if md5sum(data) != expected:
+                            corrupt.append((begin, end))
+                            feed = False
+                        elif feed:
+                            feed = self.md5_tracker.update_at(begin, data)
+                        self.download.storage.evict(f.fileno(), begin, end - begin)
+            except Exception as e:
+                log.warning("Unable to check segment {0}: {1}".format(interval, e))
+                corrupt = [(begin, end) for begin, end, _ in interval_chunks(interval)]
+                feed = False
+            self.q_complete.put(Verified(interval, corrupt))
+
+    def _verified_interval(self, interval, corrupt):
+        self.verifying -= 1
+        if corrupt:
+            # keep the chunks of a batch that are still intact, and hand
+            # the corrupt ones out again
+            self.completed.remove(interval)
+            for begin, end, checksum in interval_chunks(interval):
+                if (begin, end) in corrupt:
                     log.debug(
-                        "Redownloading corrupt segment {0}, {1}.".format(
-                            interval, checksum
-                        )
+                        "Redownloading corrupt segment {0}-{1}.".format(begin, end)
                     )
-                    corrupt_segments += 1
-                    self.completed.remove(interval)
-
-        if corrupt_segments:
-            log.warning("Redownloading {0} corrupt segments.".format(corrupt_segments))
+                    self.corrupt_segments += 1
+                    self.work_pool.add(Interval(begin, end))
+                    self.size_complete -= end - begin
+                else:
+                    self.completed.add(Interval(begin, end, {"md5sum": checksum}))
+            # the journal still holds the corrupt chunks
+            self.journal.mark_stale()
+            self.print_progress()
+
+        if not self.verifying:
+            log.debug("Segments checksum validation complete")
+            if self.corrupt_segments:
+                log.warning(
+                    "Redownloading {0} corrupt segments.".format(self.corrupt_segments)
+                )
+            if self.md5_tracker:
+                self.md5_tracker.advance(self.completed)
 
     def recover_intervals(self) -> bool:
         """Recreate list of completed intervals and calculate remaining work pool
@@ -156,11 +322,7 @@ class SegmentProducer(object):
         )
         # Attempt to load completed segments from state file
         try:
-            with open(self.download.state_path, "rb") as f:
-                self.completed = pickle.load(f)
-            assert isinstance(
-                self.completed, IntervalTree
-            ), "Bad save state: {0}".format(self.download.state_path)
+            self.completed = self.journal.load()
         except Exception as e:
             # An error has occured while loading state file.
             # Treat as entire file download and recreate temporary file
@@ -218,10 +380,8 @@ class SegmentProducer(object):
         )
 
         # If temporary file exists, means that a previous download of the file
-        # failed or was interrupted.
-        # Check completed segments md5 sums of each completed segment
-        self.validate_segment_md5sums(self.download.temp_path)
-        log.debug("Segments checksum validation complete")
+        # failed or was interrupted. The md5 sums of the completed segments
+        # are checked once the download has started, see start_verification
         self.size_complete = self.integrate(self.completed)
         log.debug("size complete: {0}".format(self.size_complete))
         # Remove already completed intervals from work_pool
@@ -236,16 +396,41 @@ class SegmentProducer(object):
         self.completed = IntervalTree()
         self.size_complete = 0
         self.total_tasks = 0
+        self.journal = Journal(self.download.state_path)
+        # intervals completed since the last checkpoint
+        self.unsaved = []
+        self._setup_md5_tracker()
 
         if not self.recover_intervals():
             # Recovery failed, treat as new download
             self.download.setup_file()
             self.completed = IntervalTree()
+            self._setup_md5_tracker()
+            if self.md5_tracker:
+                self.md5_tracker.discard_checkpoint()
             return
 
+        if self.md5_tracker:
+            self.md5_tracker.load_checkpoint()
         log.debug("State loaded successfully")
 
     def save_state(self):
+        """Checkpoint the completed intervals.
+
+        Intervals completed since the last checkpoint are appended to the
+        journal, which is rewritten when it needs compaction. The state of
+        the md5sum of the file is saved next to it.
+        """
+        if not self.journal.needs_compaction:
+            self.journal.append(self.unsaved)
+            self.unsaved = []
+        else:
+            self._compact_state()
+        if self.md5_tracker:
+            self.md5_tracker.save_checkpoint()
+
+    def _compact_state(self):
+        """Rewrite the journal with the completed intervals."""
         try:
             # Grab a temp file in the same directory (hopefully avoud
             # cross device links) in order to atomically write our save file
@@ -255,11 +440,12 @@ class SegmentProducer(object):
                 delete=False,
             )
             # Write completed state
-            pickle.dump(self.completed, temp)
+            self.journal.write(temp, self.completed)
             # Make sure all data is written to disk
             temp.flush()
             os.fsync(temp.fileno())
             temp.close()
+            self.journal.close()
 
             # Rename temp file as our save file, this could fail if
             # the state file and the temp directory are on different devices
@@ -293,6 +479,9 @@ class SegmentProducer(object):
                 # atomically rename the file
                 os.rename(temp.name, self.download.state_path)
 
+            self.journal.reopen()
+            self.unsaved = []
+
         except KeyboardInterrupt:
             log.warning("Keyboard interrupt. removing temp save file".format(temp.name))
             temp.close()
@@ -302,22 +491,127 @@ class SegmentProducer(object):
             raise
 
     def schedule(self):
-        while True:
-            interval = self._get_next_interval()
+        """Hand out work until every worker has a segment."""
+        if self.error is not None:
+            return
+        while len(self.in_flight) < self.n_procs:
+            interval = self._get_next_interval() or self._steal_interval()
             log.debug("Returning interval: {0}".format(interval))
             if not interval:
                 return
             self.q_work.put(interval)
 
+    def _new_task(self, start, end):
+        task = Task(self.total_tasks, start, end)
+        self.total_tasks += 1
+        self.in_flight[task.id] = task
+        if self.md5_tracker:
+            # the worker sends what it receives close enough to the
+            # md5sum's watermark to be kept until the watermark gets there
+            self.hash_limits[task.id] = (
+                self.md5_tracker.offset + self.md5_tracker.buffer_size
+            )
+        return Interval(start, end, task.id)
+
     def _get_next_interval(self):
         intervals = sorted(self.work_pool.items())
         if not intervals:
             return None
         interval = intervals[0]
         start = interval.begin
-        end = min(interval.end, start + self.block_size)
+        # Never hand out more than an even share of what is left so the
+        # tail of the file is spread over all the workers
+        remaining = self.integrate(self.work_pool) + sum(
+            task.remaining for task in self.in_flight.values()
+        )
+        share = math.ceil(remaining / self.n_procs)
+        end = min(interval.end, start + min(self.block_size, share))
         self.work_pool.chop(start, end)
-        return Interval(start, end)
+        return self._new_task(start, end)
+
+    def _steal_interval(self):
+        """Split the segment with the most work left between its worker and
+        an idle one.
+
+        The worker that owns the segment stops at the split point once it
+        sees the new limit in ``segment_limits``.
+        """
+        if not self.in_flight:
+            return None
+        task = max(self.in_flight.values(), key=lambda t: t.remaining)
+        if task.remaining < 2 * self.min_segment_size:
+            return None
+
+        split = task.progress + task.remaining // 2
+        end = task.end
+        log.debug(
+            "Splitting segment {0}-{1} at {2}".format(task.progress, task.end, split)
+        )
+        self.segment_limits[task.id] = split
+        task.end = split
+        return self._new_task(split, end)
+
+    def task_done(self, segment):
+        """Tell the producer that a worker is done with ``segment``."""
+        self.q_complete.put(TaskDone(segment.data))
+
+    def fail(self, error):
+        """Tell the producer that the data server refused a segment, so no
+        more segments are handed out and the download fails with ``error``."""
+        self.q_complete.put(Failed(str(error)))
+
+    def _finish_task(self, task_id):
+        task = self.in_flight.pop(task_id, None)
+        self.segment_limits.pop(task_id, None)
+        self.hash_limits.pop(task_id, None)
+        if task is None:
+            return
+
+        # Adapt the block size to the measured per-connection throughput
+        elapsed = time.time() - task.started
+        if elapsed <= 0 or task.progress <= task.begin:
+            return
+        rate = (task.progress - task.begin) / elapsed
+        if self.connection_rate is None:
+            self.connection_rate = rate
+        else:
+            self.connection_rate = 0.7 * self.connection_rate + 0.3 * rate
+        self.block_size = max(
+            self.min_segment_size, int(self.connection_rate * self.segment_seconds)
+        )
+        log.debug("Block size: {0}".format(self.block_size))
+
+    def _complete_interval(self, interval):
+        # the bytes received are only for the md5sum, not for the journal
+        received = interval.data and interval.data.pop("received", None)
+        if received is not None:
+            if not interval.data:
+                interval = Interval(interval.begin, interval.end)
+            if self.md5_tracker:
+                self.md5_tracker.add(interval.begin, received)
+
+        for task in self.in_flight.values():
+            if task.begin <= interval.begin < task.end:
+                task.progress = max(task.progress, interval.end)
+                break
+
+        # Only count bytes that were not already reported by the worker a
+        # segment was split from
+        overlap = sum(
+            min(i.end, interval.end) - max(i.begin, interval.begin)
+            for i in self.completed.overlap(interval.begin, interval.end)
+        )
+        self.completed.add(interval)
+        self.unsaved.append(interval)
+        # the tracker waits until resumed segments are known to be intact
+        if self.md5_tracker and not self.verifying:
+            self.md5_tracker.advance(self.completed)
+
+        # Get bytes downloaded and update progress bar
+        this_size = max(0, interval.end - interval.begin - overlap)
+        self.size_complete += this_size
+        self.print_progress()
+        return this_size
 
     def print_progress(self):
         if not self.pbar:
@@ -354,37 +648,53 @@ class SegmentProducer(object):
         # children return, causing them to read from a closed queue
         log.debug("Waiting for children to report")
         while not self.q_work.empty():
-            time.sleep(0.1)
+            time.sleep(0.01)
 
         # Finish the progressbar
         self.pbar.finish()
+        self.journal.close()
+
+        # Hand the md5sum computed in flight over for file validation
+        if self.md5_tracker:
+            self.md5_tracker.close()
+            self.download.computed_md5sum = self.md5_tracker.hexdigest()
+
+    def handle_message(self, message):
+        """Process a message from ``q_complete``.
+
+        :returns: The number of new bytes the message completed
+        """
+        # Once a process completes a task (success or failure), it
+        # reports it so the producer can hand out more work
+        if isinstance(message, TaskDone):
+            self._finish_task(message.task_id)
+            self.schedule()
+            return 0
+        if isinstance(message, Failed):
+            if self.error is None:
+                log.debug("Download failed: {0}".format(message.error))
+                self.error = message.error
+            return 0
+        if isinstance(message, Verified):
+            self._verified_interval(message.interval, message.corrupt)
+            self.schedule()
+            return 0
+        return self._complete_interval(message)
 
     def wait_for_completion(self):
         try:
             since_save = 0
-            num_tasks_completed = 0
-            while num_tasks_completed != self.total_tasks:
-                while since_save < self.save_interval:
-                    interval = self.q_complete.get()
-                    # Once a process completes a tasks (sucess or failure),
-                    # it will return a sentinel value (None) to main process
-                    # to indicate that a task was completed
-                    if interval is None:
-                        num_tasks_completed += 1
-                        if num_tasks_completed == self.total_tasks:
-                            break
-                        continue
-
-                    self.completed.add(interval)
-
-                    # Get bytes downloaded and update progress bar
-                    this_size = interval.end - interval.begin
-                    self.size_complete += this_size
-                    since_save += this_size
-
-                    self.print_progress()
-
-                since_save = 0
-                self.save_state()
+            # after a failure only the segments in flight are waited for
+            while (
+                self.in_flight
+                or (self.work_pool and self.error is None)
+                or self.verifying
+            ):
+                since_save += self.handle_message(self.q_complete.get())
+                if since_save >= self.save_interval:
+                    since_save = 0
+                    self.save_state()
+
+            self.save_state()
         finally:
             self.finish_download()
@@ -0,0 +1,170 @@
+import logging
+import os
+
+from gdc_client.parcel.const import MB
+
+log = logging.getLogger("storage")
+
+# Filesystems that allocate blocks for posix_fallocate without writing them
+FALLOCATE_FILESYSTEMS = ("ext4", "xfs")
+# Network filesystems, where glibc may emulate posix_fallocate by writing
+# zeros over the network, so files only get their length
+NETWORK_FILESYSTEMS = ("nfs", "nfs4", "cifs", "smb3", "fuse.sshfs")
+# Striped filesystems, written in whole stripes
+PARALLEL_FILESYSTEMS = ("lustre", "gpfs", "beegfs", "ceph", "fuse.ceph")
+
+STORAGE_CHOICES = ("auto", "sparse", "truncate", "fallocate")
+
+
+class Storage(object):
+    """How partial files are allocated, written and kept out of the cache.
+
+    :param str allocate:
+        ``sparse`` writes the last byte of the file, the way parcel always
+        did, ``truncate`` only sets the length and ``fallocate`` reserves
+        the blocks of the whole file up front
+    :param int alignment:
+        optional. Cut the downloaded data so that writes end on multiples
+        of ``alignment`` bytes, e.g. the stripe size
+    :param bool drop_cache:
+        optional. Evict data from the page cache once it was last read
+    """
+
+    def __init__(self, allocate="sparse", alignment=0, drop_cache=False):
+        self.allocate_method = allocate
+        self.alignment = alignment
+        self.drop_cache = drop_cache and hasattr(os, "posix_fadvise")
+
+    def __repr__(self):
+        return "Storage(allocate={0!r}, alignment={1}, drop_cache={2})".format(
+            self.allocate_method, self.alignment, self.drop_cache
+        )
+
+    def allocate(self, path, length):
+        """Create the file at ``path`` with ``length`` bytes.
+
+        An existing file of the right length is left as it is, it may hold
+        the data of an interrupted download.
+        """
+        if os.path.isfile(path) and os.path.getsize(path) == length:
+            return
+
+        with open(path, "wb") as f:
+            if self.allocate_method == "fallocate" and length:
+                try:
+                    os.posix_fallocate(f.fileno(), 0, length)
+                    return
+                except (AttributeError, OSError) as e:
+                    log.debug("Unable to fallocate {0}: {1}".format(path, e))
+                    f.truncate(length)
+            elif self.allocate_method == "truncate":
+                f.truncate(length)
+            elif length:
+                f.seek(length - 1)
+                f.write(b"\0")
+                f.truncate()
+
+    def aligned_chunks(self, chunks, offset, size):
+        """Re-cut a stream of chunks written from ``offset`` on, so that each
+        piece but the last ends on a multiple of ``alignment``.
+
+        :param chunks: iterable of bytes-like chunks
+        :param int offset: where the first chunk is written
+        :param int size: the preferred size of the pieces
+        :returns: A generator of pieces
+        """
+        if not self.alignment:
+            yield from chunks
+            return
+
+        size = max(self.alignment, size - size % self.alignment)
+        buf = bytearray()
+        for chunk in chunks:
+            buf += chunk
+            while True:
+                # up to the next boundary, then whole pieces
+                cut = -offset % self.alignment or size
+                if len(buf) < cut:
+                    break
+                yield bytes(buf[:cut])
+                del buf[:cut]
+                offset += cut
+        if buf:
+            yield bytes(buf)
+
+    def evict(self, fd, offset, length):
+        """Drop a range of the file from the page cache, once nothing reads
+        it anymore. Dirty pages are written back first."""
+        if not self.drop_cache or length <= 0:
+            return
+        try:
+            os.posix_fadvise(fd, offset, length, os.POSIX_FADV_DONTNEED)
+        except OSError as e:
+            log.debug("Unable to drop cached pages: {0}".format(e))
+
+
+def filesystem_type(path, mounts="/proc/mounts"):
+    """Return the type of the filesystem ``path`` is on, if it is known.
+
+    :param str path: a path on the filesystem, it doesn't need to exist
+    :param str mounts: optional. The mount table to look ``path`` up in
+    :returns: The type from the mount table, or None
+    """
+    path = os.path.realpath(path)
+    try:
+        with open(mounts) as f:
+            mounts = [line.split() for line in f]
+    except (IOError, OSError):
+        return None
+
+    fs_type, longest = None, -1
+    for fields in mounts:
+        if len(fields) < 3:
+            continue
+        # spaces in mount points are escaped as \040
+        mount_point = fields[1].replace("\\040", " ")
+        inside = path == mount_point or path.startswith(mount_point.rstrip("/") + "/")
+        if inside and len(mount_point) > longest:
+            fs_type, longest = fields[2], len(mount_point)
+    return fs_type
+
+
+def _block_size(directory):
+    while directory and not os.path.isdir(directory):
+        directory = os.path.dirname(directory)
+    try:
+        return os.stat(directory or ".").st_blksize
+    except OSError:
+        return 0
+
+
+def select_storage(directory, choice="auto"):
+    """Choose how to store the files downloaded to ``directory``.
+
+    :param str directory: the download directory
+    :param str choice:
+        an allocation method, or ``auto`` to choose one for the
+        filesystem of the directory
+    :returns: A Storage
+    """
+    if choice != "auto":
+        return Storage(allocate=choice, drop_cache=True)
+
+    fs_type = filesystem_type(directory)
+    if fs_type in FALLOCATE_FILESYSTEMS:
+        storage = Storage(allocate="fallocate", drop_cache=True)
+    elif fs_type in NETWORK_FILESYSTEMS:
+        storage = Storage(allocate="truncate", drop_cache=True)
+    elif fs_type in PARALLEL_FILESYSTEMS:
+        # striped filesystems report the stripe size as their block size
+        alignment = _block_size(directory)
+        storage = Storage(
+            allocate="truncate",
+            alignment=alignment if alignment >= 64 * 1024 else MB,
+            drop_cache=True,
+        )
+    else:
+        storage = Storage(drop_cache=True)
+
+    log.debug("Storing files on {0} filesystem with {1}".format(fs_type, storage))
+    return storage
@@ -120,6 +120,15 @@ def write_offset(path, data, offset):
         f.write(data)
 
 
+def pwrite_all(fd, data, offset):
+    """Write all of ``data`` at ``offset`` without moving the file position."""
+    view = memoryview(data)
+    while view:
+        written = os.pwrite(fd, view, offset)
+        view = view[written:]
+        offset += written
+
+
 def read_offset(path, offset, size):
     with open(path, "r+b") as f:
         f.seek(offset)
@@ -199,12 +208,16 @@ def md5sum_whole_file(fname):
     return hash_md5.hexdigest()
 
 
-def validate_file_md5sum(stream: DownloadStream, file_path: str) -> None:
+def validate_file_md5sum(
+    stream: DownloadStream, file_path: str, computed_md5sum: str = None
+) -> None:
     """Function to validate md5sum for given file if prerequisite checks pass
 
     Args:
         stream: initialized DownloadStream object
         file_path: file to validate
+        computed_md5sum: md5sum computed while downloading, the file is only
+                         read again when it is not given
     Raises:
         MD5ValidationError: if correct DownloadStream flags are not set or
                             md5sum does not have given md5sum
@@ -221,7 +234,11 @@ def validate_file_md5sum(stream: DownloadStream, file_path: str) -> None:
         raise MD5ValidationError(
             "Cannot validate this file since the server did not provide an md5sum. Use the '--no-file-md5sum' option to ignore this error."
         )
-    if md5sum_whole_file(file_path) != stream.md5sum:
+    if computed_md5sum is None:
+        computed_md5sum = md5sum_whole_file(file_path)
+    else:
+        log.debug("Using checksum computed during download")
+    if computed_md5sum != stream.md5sum:
         raise MD5ValidationError("File checksum is invalid")
 
 
@@ -0,0 +1,155 @@
+"""gdc_client.query.cache
+
+Persistent cache of file metadata and latest versions.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from gdc_client.defaults import METADATA_CACHE_SIZE, METADATA_CACHE_TTL
+
+# kinds of cached entries
+METADATA = "metadata"
+VERSION = "version"
+
+# SQLite limits the number of parameters of a single statement
+_MAX_PARAMS = 500
+
+
+def _batches(elements, size=_MAX_PARAMS):
+    elements = list(elements)
+    for i in range(0, len(elements), size):
+        yield elements[i : i + size]
+
+
+class MetadataCache(object):
+    """SQLite cache of API lookups keyed by UUID
+
+    Entries expire ``ttl`` seconds after they were stored, and once there
+    are more than ``max_entries`` of them the least recently used ones are
+    evicted. The cache is shared by every gdc-client run pointing at the
+    same file.
+    """
+
+    def __init__(self, path, ttl=METADATA_CACHE_TTL, max_entries=METADATA_CACHE_SIZE):
+        """
+        Args:
+            path (str): path of the SQLite database, created if missing
+            ttl (float): seconds an entry is valid for, 0 to never expire
+            max_entries (int): entries kept, 0 for no limit
+        """
+
+        self.path = os.path.expanduser(path)
+        self.ttl = ttl
+        self.max_entries = max_entries
+
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        # metadata pages are stored from several threads
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                " uuid TEXT NOT NULL,"
+                " kind TEXT NOT NULL,"
+                " value TEXT NOT NULL,"
+                " stored REAL NOT NULL,"
+                " used REAL NOT NULL,"
+                " PRIMARY KEY (uuid, kind))"
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS entries_used ON entries (used)"
+            )
+
+    def get_many(self, kind, uuids, expired=False):
+        """
+        Look up cached entries
+
+        Args:
+            kind (str): METADATA or VERSION
+            uuids (list): UUIDs to look up
+            expired (bool): also return entries older than the TTL
+
+        Returns:
+            dict: the cached value of each UUID found
+        """
+
+        now = time.time()
+        oldest = now - self.ttl if self.ttl and not expired else 0
+        found = {}
+        with self._lock, self._conn:
+            for batch in _batches(set(uuids)):
+                marks = ",".join("?" * len(batch))
+                rows = self._conn.execute(
+                    "SELECT uuid, value FROM entries WHERE kind = ? AND stored >= ?"
+                    " AND uuid IN ({0})".format(marks),
+                    [kind, oldest] + batch,
+                ).fetchall()
+                found.update((uuid, json.loads(value)) for uuid, value in rows)
+            for batch in _batches(found):
+                marks = ",".join("?" * len(batch))
+                self._conn.execute(
+                    "UPDATE entries SET used = ? WHERE kind = ?"
+                    " AND uuid IN ({0})".format(marks),
+                    [now, kind] + batch,
+                )
+        return found
+
+    def put_many(self, kind, values):
+        """
+        Store entries, evicting the least recently used ones over the limit
+
+        Args:
+            kind (str): METADATA or VERSION
+            values (dict): the value of each UUID, serializable as JSON
+        """
+
+        if not values:
+            return
+
+        now = time.time()
+        rows = [
+            (uuid, kind, json.dumps(value), now, now) for uuid, value in values.items()
+        ]
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)", rows
+            )
+            if self.max_entries:
+                self._conn.execute(
+                    "DELETE FROM entries WHERE rowid IN (SELECT rowid FROM entries"
+                    " ORDER BY used DESC LIMIT -1 OFFSET ?)",
+                    (self.max_entries,),
+                )
+
+    def invalidate(self, uuids=None):
+        """
+        Remove the entries of the UUIDs, or every entry
+
+        Args:
+            uuids (list): UUIDs to forget, None for all of them
+
+        Returns:
+            int: the number of entries removed
+        """
+
+        with self._lock, self._conn:
+            if uuids is None:
+                return self._conn.execute("DELETE FROM entries").rowcount
+            removed = 0
+            for batch in _batches(set(uuids)):
+                marks = ",".join("?" * len(batch))
+                removed += self._conn.execute(
+                    "DELETE FROM entries WHERE uuid IN ({0})".format(marks), batch
+                ).rowcount
+            return removed
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -1,19 +1,94 @@
+from collections import Counter
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+import heapq
 import logging
+import math
+import threading
 from json import dumps
 from urllib import parse as urlparse
 
 import requests
 
+from gdc_client.parcel import governor
+from gdc_client.query.cache import METADATA
+
 log = logging.getLogger("query")
 
 
+class EndpointStats(object):
+    """Hits and misses of the active and legacy API endpoints
+
+    Used to learn which endpoint to try first, and whether a manifest mixes
+    files of both so they are better asked at the same time.
+    """
+
+    def __init__(self):
+        self.hits = Counter()
+        self.misses = Counter()
+        self._lock = threading.Lock()
+
+    def record(self, endpoint, hits, misses=0):
+        with self._lock:
+            self.hits[endpoint] += hits
+            self.misses[endpoint] += misses
+
+    @property
+    def preferred(self):
+        """The endpoint to try first"""
+        return "legacy" if self.hits["legacy"] > self.hits["active"] else "active"
+
+    @property
+    def mixed(self):
+        """Whether both endpoints returned hits"""
+        return self.hits["active"] > 0 and self.hits["legacy"] > 0
+
+
 class GDCIndexClient(object):
-    def __init__(self, uri, verify=True):
+
+    # UUIDs per metadata request, and requests made at once
+    metadata_page_size = 500
+    metadata_concurrency = 4
+
+    def __init__(self, uri, verify=True, cache=None, offline=False):
+        """
+        Args:
+            uri (str): the API url
+            verify (bool): verify the server certificate
+            cache (MetadataCache): optional. Cache checked before the API,
+                and updated with the metadata it returns
+            offline (bool): only use the cache, expired entries included,
+                and never query the API
+        """
+
         self.uri = uri
         self.active_meta_endpoint = "/v0/files"
         self.legacy_meta_endpoint = "/v0/legacy/files"
         self.metadata = dict()
         self.verify = verify
+        self.cache = cache
+        self.offline = offline
+        self.endpoint_stats = EndpointStats()
+        # metadata pages being fetched, and the page future of each UUID
+        self._metadata_pool = ThreadPoolExecutor(max_workers=self.metadata_concurrency)
+        self._pages = {}
+        # legacy lookups made alongside the active ones of a page
+        self._legacy_pool = ThreadPoolExecutor(max_workers=self.metadata_concurrency)
+        # keep-alive connections shared by the concurrent metadata requests
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=self.metadata_concurrency)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def close(self):
+        """
+        Stop the threads fetching metadata and close their connections
+        """
+
+        for future in self._pages.values():
+            future.cancel()
+        self._metadata_pool.shutdown(wait=True)
+        self._legacy_pool.shutdown(wait=True)
+        self.session.close()
 
     def get_related_files(self, uuid):
         # type: (str) -> list[str]
@@ -54,7 +129,8 @@ class GDCIndexClient(object):
         """
         json_response = {}
         # using a POST request lets us avoid the MAX URL character length limit
-        r = requests.post(url, json=metadata_query, verify=self.verify)
+        governor.throttle_request()
+        r = self.session.post(url, json=metadata_query, verify=self.verify)
 
         if r is None:
             return []
@@ -94,42 +170,112 @@ class GDCIndexClient(object):
             }
         """
 
-        filters = {
-            "op": "and",
-            "content": [
-                {
-                    "op": "in",
-                    "content": {
-                        "field": "files.file_id",
-                        # Sometimes a <type 'set'> is passed
-                        "value": list(uuids),
-                    },
-                }
-            ],
-        }
+        for _ in self.iter_metadata(uuids):
+            pass
 
-        metadata_query = {
-            "fields": "file_id,file_size,md5sum,annotations.annotation_id,"
-            "metadata_files.file_id,index_files.file_id,access",
-            "filters": dumps(filters),
-            "from": "0",
-            "size": str(len(uuids)),  # one big request
-        }
+        return self.metadata
+
+    def prefetch_metadata(self, uuids):
+        """
+        Start fetching the metadata of the UUIDs in the background, in pages
+        of ``metadata_page_size``. UUIDs already fetched or being fetched
+        are skipped, so planning can start while the ids are still being
+        resolved.
+
+        Args:
+            uuids (list): A list of UUIDs of the files
+        """
+
+        uuids = [uuid for uuid in dict.fromkeys(uuids) if uuid not in self._pages]
+
+        if self.cache is not None and uuids:
+            cached = self.cache.get_many(METADATA, uuids, expired=self.offline)
+            for uuid, metadata in cached.items():
+                self.metadata.setdefault(uuid, metadata)
+            self._resolved(cached, len(cached))
+            uuids = [uuid for uuid in uuids if uuid not in cached]
+
+        if self.offline and uuids:
+            log.warning(
+                "No cached metadata for {0} files, planning them as large "
+                "files".format(len(uuids))
+            )
+            self._resolved(uuids, 0)
+            return
+
+        for i in range(0, len(uuids), self.metadata_page_size):
+            page = uuids[i : i + self.metadata_page_size]
+            future = self._metadata_pool.submit(self._get_metadata_page, page)
+            for uuid in page:
+                self._pages[uuid] = future
+
+    def _resolved(self, uuids, hits):
+        """Record the UUIDs as a page that needs no request"""
+
+        future = Future()
+        future.set_result(hits)
+        for uuid in uuids:
+            self._pages[uuid] = future
+
+    def iter_metadata(self, uuids):
+        """
+        Fetch the metadata of the UUIDs in pages of ``metadata_page_size``,
+        ``metadata_concurrency`` pages at a time. Pages started by
+        :func:`prefetch_metadata` are not fetched again.
+
+        Args:
+            uuids (list): A list of UUIDs of the files
+
+        Yields:
+            list: the UUIDs of a page, once its metadata is stored in
+            self.metadata. Pages are yielded in the order they arrive
+        """
 
-        active_meta_url = urlparse.urljoin(self.uri, self.active_meta_endpoint)
-        legacy_meta_url = urlparse.urljoin(self.uri, self.legacy_meta_endpoint)
+        uuids = list(dict.fromkeys(uuids))
+        self.prefetch_metadata(uuids)
 
-        active_hits = self._get_hits(active_meta_url, metadata_query)
-        legacy_hits = self._get_hits(legacy_meta_url, metadata_query)
+        futures = {}
+        for uuid in uuids:
+            futures.setdefault(self._pages[uuid], []).append(uuid)
 
-        if not active_hits and not legacy_hits:
+        hits = 0
+        for future in as_completed(futures):
+            hits += future.result()
+            yield futures[future]
+
+        if uuids and not hits:
             log.debug(
                 "Unable to retrieve file metadata information. "
                 "continuing downloading as if they were large files"
             )
-            return self.metadata
 
-        for h in active_hits + legacy_hits:
+    def _get_metadata_page(self, uuids):
+        """
+        Fetch and store the metadata of a single page of UUIDs
+
+        Args:
+            uuids (list): A list of UUIDs of the files
+
+        Returns:
+            int: the number of hits
+        """
+
+        if self.endpoint_stats.mixed:
+            # the files are spread over both endpoints, ask them together
+            legacy = self._legacy_pool.submit(self._get_endpoint_hits, "legacy", uuids)
+            hits = self._get_endpoint_hits("active", uuids) + legacy.result()
+        else:
+            # ask the endpoint that resolved most files so far, and the
+            # other one only for the files it didn't know
+            first = self.endpoint_stats.preferred
+            second = "active" if first == "legacy" else "legacy"
+            hits = self._get_endpoint_hits(first, uuids)
+            found = set(h["id"] for h in hits)
+            unresolved = [uuid for uuid in uuids if uuid not in found]
+            if unresolved:
+                hits += self._get_endpoint_hits(second, unresolved)
+
+        for h in hits:
             related_returns = h.get("index_files", []) + h.get("metadata_files", [])
             related_files = [r["file_id"] for r in related_returns]
 
@@ -142,15 +288,65 @@ class GDCIndexClient(object):
                 # don't want to overwrite
                 self.metadata[h["id"]] = {
                     "access": h["access"],
+                    "file_name": h.get("file_name"),
                     "file_size": h["file_size"],
                     "md5sum": h["md5sum"],
                     "annotations": annotations,
                     "related_files": related_files,
                 }
 
-        return self.metadata
+        if self.cache is not None:
+            self.cache.put_many(
+                METADATA, {h["id"]: self.metadata[h["id"]] for h in hits}
+            )
+
+        return len(hits)
+
+    def _get_endpoint_hits(self, endpoint, uuids):
+        """
+        Get the metadata hits of the UUIDs from the active or legacy endpoint
+
+        Args:
+            endpoint (str): "active" or "legacy"
+            uuids (list): A list of UUIDs of the files
+
+        Returns:
+            list: hits from the response data
+        """
+
+        filters = {
+            "op": "and",
+            "content": [
+                {
+                    "op": "in",
+                    "content": {
+                        "field": "files.file_id",
+                        "value": uuids,
+                    },
+                }
+            ],
+        }
+
+        metadata_query = {
+            "fields": "file_id,file_name,file_size,md5sum,annotations.annotation_id,"
+            "metadata_files.file_id,index_files.file_id,access",
+            "filters": dumps(filters),
+            "from": "0",
+            "size": str(len(uuids)),  # the whole page in one request
+        }
 
-    def separate_small_files(self, ids, chunk_size):
+        path = (
+            self.active_meta_endpoint
+            if endpoint == "active"
+            else self.legacy_meta_endpoint
+        )
+        hits = self._get_hits(urlparse.urljoin(self.uri, path), metadata_query)
+        self.endpoint_stats.record(endpoint, len(hits), len(uuids) - len(hits))
+        return hits
+
+    def separate_small_files(
+        self, ids, small_file_size, bundle_size=None, concurrency=1
+    ):
         """Separate big and small files
 
         Separate the small files from the larger files in
@@ -163,7 +359,10 @@ class GDCIndexClient(object):
 
         Args:
             ids (list): a set of file UUIDs
-            chunk_size (int): the maximum allowed combined size of small files
+            small_file_size (int): the maximum size of a file to be grouped
+            bundle_size (int): the target combined size of a group of small
+                files, defaults to small_file_size
+            concurrency (int): the number of groups downloaded at once
 
         Return:
             list: a list of big file UUIDs
@@ -180,66 +379,47 @@ class GDCIndexClient(object):
         # relate and annotation files so they can be handled by parcel
         log.debug("Grouping ids by size")
 
-        self._get_metadata(ids)
-        for uuid in ids:
-            if uuid not in self.metadata.keys():
-                bigs.add(uuid)
-                continue
+        # sort the files of each page as soon as its metadata arrives
+        for page in self.iter_metadata(ids):
+            for uuid in page:
+                if uuid not in self.metadata.keys():
+                    bigs.add(uuid)
+                    continue
 
-            rf = self.get_related_files(uuid)
-            af = self.get_annotations(uuid)
+                rf = self.get_related_files(uuid)
+                af = self.get_annotations(uuid)
 
-            # if there are any related files, add file to a regular/big file
-            # download list
-            if rf:
-                bigs.add(uuid)
+                # if there are any related files, add file to a regular/big file
+                # download list
+                if rf:
+                    bigs.add(uuid)
 
-            # if there are any annotations, add file to a regular/big file
-            # download list
-            if af:
-                bigs.add(uuid)
-
-            # if uuid has no related or annotation files
-            # then proceed to the small file sorting with them
-            if not af and not rf:
-                potential_smalls.add(uuid)
+                # if there are any annotations, add file to a regular/big file
+                # download list
+                if af:
+                    bigs.add(uuid)
 
-        # the following line is to trigger the first if statement
-        # to start the process off properly
-        bundle_open_size = chunk_size + 1
-        bundle_control_size = chunk_size + 1
-
-        i_open = -1
-        i_control = -1
+                # if uuid has no related or annotation files
+                # then proceed to the small file sorting with them
+                if not af and not rf:
+                    potential_smalls.add(uuid)
 
         for uuid in potential_smalls:
-            # grouping of file exceeds chunk_size, create a new grouping
-            if bundle_open_size > chunk_size:
-                smalls_open.append([])
-                i_open += 1
-                bundle_open_size = 0
-
-            if bundle_control_size > chunk_size:
-                smalls_control.append([])
-                i_control += 1
-                bundle_control_size = 0
-
-            # individual file is more than chunk_size, big file download
-            if self.get_filesize(uuid) > chunk_size:
+            # individual file is more than small_file_size, big file download
+            if self.get_filesize(uuid) > small_file_size:
                 bigs.add(uuid)
 
-            # file size is less than chunk_size then group and tarfile it
-            else:
-                if self.get_access(uuid) == "open":
-                    smalls_open[i_open].append(uuid)
-                    bundle_open_size += self.get_filesize(uuid)
+            # file size is less than small_file_size then group and tarfile it
+            elif self.get_access(uuid) == "open":
+                smalls_open.append(uuid)
 
-                elif self.get_access(uuid) == "controlled":
-                    smalls_control[i_control].append(uuid)
-                    bundle_control_size += self.get_filesize(uuid)
+            elif self.get_access(uuid) == "controlled":
+                smalls_control.append(uuid)
 
-        # they are still small files to be downloaded in a group
-        smalls = smalls_open + smalls_control
+        bundle_size = bundle_size or small_file_size
+        smalls = self._pack_small_files(
+            smalls_open, bundle_size, concurrency
+        ) + self._pack_small_files(smalls_control, bundle_size, concurrency)
 
         # for logging/reporting purposes
         total_count = len(bigs) + sum([len(s) for s in smalls])
@@ -252,6 +432,47 @@ class GDCIndexClient(object):
         log.debug("{0} total number of files to download".format(total_count))
         log.debug("{0} groupings of files".format(len(smalls)))
 
-        smalls = [s for s in smalls if s != []]
+        return sorted(bigs), smalls
+
+    def _pack_small_files(self, uuids, bundle_size, concurrency=1):
+        """
+        Pack small files into groups, largest file first into the group
+        with the least data so far
+
+        There are as many groups as ``bundle_size`` bundles needed to hold
+        the files. When that is more groups than are downloaded at once, it
+        is rounded up to a multiple of the concurrency, so that the groups
+        downloaded at the same time are about the same size. Fewer files
+        are never split into groups smaller than the bundle size.
+
+        Args:
+            uuids (list): UUIDs of small files with the same access
+            bundle_size (int): the target combined size of a group
+            concurrency (int): the number of groups downloaded at once
+
+        Returns:
+            list: a list of lists of UUIDs, one per group
+        """
+
+        if not uuids:
+            return []
 
-        return list(bigs), smalls
+        # largest first, ties broken by UUID so the grouping is deterministic
+        uuids = sorted(uuids, key=lambda uuid: (-self.get_filesize(uuid), uuid))
+        total_size = sum(self.get_filesize(uuid) for uuid in uuids)
+        concurrency = max(1, concurrency)
+
+        n_groups = max(1, math.ceil(total_size / float(bundle_size)))
+        if n_groups > concurrency:
+            n_groups = math.ceil(n_groups / float(concurrency)) * concurrency
+        n_groups = min(n_groups, len(uuids))
+
+        groups = [[] for _ in range(n_groups)]
+        # (bytes in the group, index of the group)
+        loads = [(0, i) for i in range(n_groups)]
+        for uuid in uuids:
+            load, i = heapq.heappop(loads)
+            groups[i].append(uuid)
+            heapq.heappush(loads, (load + self.get_filesize(uuid), i))
+
+        return groups
@@ -3,20 +3,36 @@
 Functionality related to versioning.
 """
 
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 import logging
 import requests
+import time
 
 from requests.exceptions import HTTPError
 
+from gdc_client.parcel import governor
+from gdc_client.query.cache import VERSION
+
 logger = logging.getLogger(__name__)
 
 
-def get_latest_versions(url, uuids, verify=True):
+# Statuses worth retrying after a backoff, and statuses that suggest the
+# request asked for too many ids at once
+RETRY_STATUSES = (429, 503, 504)
+SPLIT_STATUSES = (413, 504)
+
+# seconds to wait for a versions query before splitting it
+REQUEST_TIMEOUT = 60
+
+
+def get_latest_versions(url, uuids, verify=True, cache=None, offline=False):
     """Get the latest version of a UUID according to the api.
 
     Args:
         url (str):
         uuids (list): list of UUIDs that might have a new version
+        cache (MetadataCache): optional. Cache of previous lookups
+        offline (bool): only use the cache, see iter_latest_versions
 
     Returns:
         dict: mapping for user requested file UUIDs potentially new versions
@@ -24,37 +40,212 @@ def get_latest_versions(url, uuids, verify=True):
         ServerError: if request for files versions fails
     """
 
-    uuids = list(uuids)
-    versions_url = url + "/files/versions"
     latest_versions = {}
+    for chunk_versions in iter_latest_versions(
+        url, uuids, verify=verify, cache=cache, offline=offline
+    ):
+        latest_versions.update(chunk_versions)
 
-    # Make multiple queries in an attempt to balance the load on the server.
-    for chunk in _chunk_list(uuids):
-        resp = requests.post(versions_url, json={"ids": chunk}, verify=verify)
+    return latest_versions
 
-        if not resp.ok:
-            raise HTTPError(
-                (
-                    "The following request {0} for ids {1} returned with "
-                    "status code: {2} and response content: {3}"
-                ).format(
+
+def iter_latest_versions(
+    url,
+    uuids,
+    verify=True,
+    chunk_size=500,
+    max_workers=4,
+    retries=3,
+    backoff=1.0,
+    cache=None,
+    offline=False,
+):
+    """Get the latest versions of UUIDs, yielding them as chunks resolve.
+
+    Chunks of ids are queried concurrently over a pooled session. A chunk
+    that times out or is too large for the server is split in half, and
+    the size of the following chunks is halved as well until queries
+    succeed again.
+
+    Args:
+        url (str):
+        uuids (list): list of UUIDs that might have a new version
+        chunk_size (int): max number of ids in a single query
+        max_workers (int): number of queries made at once
+        retries (int): number of retries of a query that failed with a
+            status in RETRY_STATUSES or a connection error
+        backoff (float): seconds to wait before the first retry, doubled
+            for every following one
+        cache (MetadataCache): optional. Cached versions are yielded first
+            and only the other UUIDs are queried
+        offline (bool): only use the cache, expired entries included. UUIDs
+            that aren't cached are assumed to be their latest version
+
+    Yields:
+        dict: mapping of the UUIDs of a chunk to their latest versions
+    Raises:
+        HTTPError: if request for files versions fails
+    """
+
+    remaining = list(uuids)
+
+    if cache is not None and remaining:
+        cached = cache.get_many(VERSION, remaining, expired=offline)
+        if cached:
+            yield cached
+        remaining = [uuid for uuid in remaining if uuid not in cached]
+
+    if offline:
+        if remaining:
+            logger.warning(
+                "No cached versions for {0} files, using them as given".format(
+                    len(remaining)
+                )
+            )
+            yield {uuid: uuid for uuid in remaining}
+        return
+
+    versions_url = url + "/files/versions"
+    max_chunk_size = current_chunk_size = chunk_size
+
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=max_workers)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+
+    # chunks split after a failure go before the remaining ids
+    split_chunks = []
+
+    def next_chunk():
+        if split_chunks:
+            return split_chunks.pop()
+        chunk = remaining[:current_chunk_size]
+        del remaining[:current_chunk_size]
+        return chunk
+
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    pending = {}
+    try:
+        while remaining or split_chunks or pending:
+            # Make multiple queries in an attempt to balance the load on the
+            # server, but only as many as there are workers
+            while (remaining or split_chunks) and len(pending) < max_workers:
+                chunk = next_chunk()
+                future = executor.submit(
+                    _post_versions,
+                    session,
                     versions_url,
                     chunk,
-                    resp.status_code,
-                    resp.content,
-                ),
-                response=resp,
+                    verify,
+                    retries,
+                    backoff,
+                )
+                pending[future] = chunk
+
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                chunk = pending.pop(future)
+                try:
+                    resp = future.result()
+                except requests.exceptions.Timeout:
+                    resp = None
+
+                too_large = resp is None or resp.status_code in SPLIT_STATUSES
+                if too_large and len(chunk) > 1:
+                    half = len(chunk) // 2
+                    logger.debug(
+                        "Splitting versions query of {0} ids".format(len(chunk))
+                    )
+                    split_chunks.extend([chunk[half:], chunk[:half]])
+                    current_chunk_size = max(1, min(current_chunk_size, half))
+                    continue
+
+                if resp is None:
+                    raise HTTPError(
+                        "The following request {0} for ids {1} timed out".format(
+                            versions_url, chunk
+                        )
+                    )
+
+                if not resp.ok:
+                    raise HTTPError(
+                        (
+                            "The following request {0} for ids {1} returned with "
+                            "status code: {2} and response content: {3}"
+                        ).format(
+                            versions_url,
+                            chunk,
+                            resp.status_code,
+                            resp.content,
+                        ),
+                        response=resp,
+                    )
+
+                current_chunk_size = min(max_chunk_size, current_chunk_size * 2)
+                chunk_versions = _parse_versions(resp.json())
+                if cache is not None:
+                    cache.put_many(VERSION, chunk_versions)
+                yield chunk_versions
+    finally:
+        for future in pending:
+            future.cancel()
+        # the idle threads are joined once every chunk is done, so they are
+        # gone before download workers are forked
+        executor.shutdown(wait=not pending)
+
+
+def _post_versions(session, versions_url, chunk, verify, retries, backoff):
+    """Query the versions of a chunk of ids, retrying transient failures.
+
+    Returns:
+        requests.Response: the last response, successful or not
+    """
+
+    for attempt in range(retries + 1):
+        last_attempt = attempt == retries
+        try:
+            governor.throttle_request()
+            resp = session.post(
+                versions_url,
+                json={"ids": chunk},
+                verify=verify,
+                timeout=REQUEST_TIMEOUT,
             )
+        except requests.exceptions.Timeout:
+            # a chunk that takes too long is split rather than retried
+            if last_attempt or len(chunk) > 1:
+                raise
+        except requests.exceptions.ConnectionError:
+            if last_attempt:
+                raise
+        else:
+            if resp.status_code not in RETRY_STATUSES or last_attempt:
+                return resp
+            # a chunk that is too large is split rather than retried
+            if resp.status_code in SPLIT_STATUSES and len(chunk) > 1:
+                return resp
 
-        # Parse the results of the chunked query.
-        for result in resp.json():
-            file_id = result.get("id")
-            uuid = result.get("latest_id")
-            if uuid:
-                latest_versions[file_id] = uuid
-            else:
-                # Might happen for legacy files
-                latest_versions[file_id] = file_id
+        delay = backoff * 2**attempt
+        logger.debug(
+            "Retrying versions query in {0:.1f} seconds ({1}/{2})".format(
+                delay, attempt + 1, retries
+            )
+        )
+        time.sleep(delay)
+
+
+def _parse_versions(results):
+    """Map the ids of a versions response to their latest versions."""
+
+    latest_versions = {}
+    for result in results:
+        file_id = result.get("id")
+        uuid = result.get("latest_id")
+        if uuid:
+            latest_versions[file_id] = uuid
+        else:
+            # Might happen for legacy files
+            latest_versions[file_id] = file_id
 
     return latest_versions
 
@@ -114,6 +114,9 @@ def files():
             if "access" in fields and node.get("access"):
                 hit["access"] = node["access"]
 
+            if "file_name" in fields and node.get("contents") is not None:
+                hit["file_name"] = "test_file.txt"
+
             if "file_size" in fields and node.get("file_size"):
                 hit["file_size"] = node["file_size"]
 
@@ -220,8 +223,12 @@ def handle_range_request(
     # Long sleep times purposefully set to cause ReadTimeout in client
     time.sleep(sleep_time)
 
-    data = uuids[ids[0]]["contents"][start:end]
-    resp = Response(data)
+    contents = uuids[ids[0]]["contents"]
+    data = contents[start:end]
+    resp = Response(data, status=206)
+    resp.headers["Content-Range"] = "bytes {0}-{1}/{2}".format(
+        start, start + len(data) - 1, len(contents)
+    )
     resp.headers["Content-Disposition"] = "attachment; filename={0}".format(filename)
     resp.headers["Content-Type"] = "application/octet-stream"
     resp.headers["Content-Length"] = len(data)
@@ -1,18 +1,28 @@
 import argparse
+import io
 from multiprocessing import cpu_count
 import os
 from pathlib import Path
 import pytest
+import queue
+import requests
 import tarfile
+import threading
+import time
 from typing import List
 from unittest.mock import patch
 
+from intervaltree import Interval
+
 from gdc_client.common.config import GDCClientArgumentParser
+from gdc_client.parcel.chunk_sizer import ChunkSizer
 from gdc_client.parcel.const import HTTP_CHUNK_SIZE, SAVE_INTERVAL
 from gdc_client.parcel.download_stream import DownloadStream
+from gdc_client.parcel.utils import md5sum
 
 from conftest import make_tarfile, md5, uuids
 from gdc_client.download.client import GDCHTTPDownloadClient, fix_url
+from gdc_client.download.journal import RunJournal
 from gdc_client.download.parser import download
 from gdc_client.query.index import GDCIndexClient
 
@@ -51,15 +61,33 @@ class TestDownloadClient:
         cmd_line_args = {
             "server": BASE_URL,
             "n_processes": 1,
+            "concurrent_files": 1,
+            "concurrent_groups": 1,
+            "prepare_ahead": 2,
+            "engine": "processes",
+            "max_bandwidth": 0,
+            "max_request_rate": 0,
+            "limits_file": None,
+            "metadata_cache": None,
+            "metadata_cache_ttl": 24 * 60 * 60,
+            "metadata_cache_size": 100000,
+            "offline": False,
             "dir": path,
             "save_interval": SAVE_INTERVAL,
             "http_chunk_size": HTTP_CHUNK_SIZE,
+            "min_http_chunk_size": HTTP_CHUNK_SIZE // 4,
+            "max_http_chunk_size": HTTP_CHUNK_SIZE * 32,
+            "small_file_size": HTTP_CHUNK_SIZE,
+            "bundle_size": HTTP_CHUNK_SIZE,
+            "write_method": "pwrite",
+            "storage": "auto",
             "no_segment_md5sums": False,
             "no_file_md5sum": False,
             "no_verify": False,
             "no_related_files": False,
             "no_annotations": False,
             "no_auto_retry": False,
+            "no_run_journal": False,
             "retry_amount": 1,
             "wait_time": 5.0,
             "latest": False,
@@ -134,6 +162,65 @@ class TestDownloadClient:
                 contents = t.extractfile(member).read().decode()
                 assert contents == uuids[member.name]["contents"]
 
+    @pytest.mark.parametrize("tiny_member_size", (0, 1024))
+    def test_download_small_groups_streams_members(
+        self, monkeypatch, tiny_member_size: int
+    ) -> None:
+        monkeypatch.setattr(GDCHTTPDownloadClient, "tiny_member_size", tiny_member_size)
+        files_to_dl = ["small", "small_no_friends"]
+        client = self.get_download_client(files_to_dl)
+
+        errors, count = client.download_small_groups([files_to_dl])
+
+        assert errors == []
+        assert count == 2
+        for f in files_to_dl:
+            assert (self.tmp_path / f).read_text() == uuids[f]["contents"]
+        # nothing but the extracted members is left behind
+        assert sorted(os.listdir(str(self.tmp_path))) == sorted(files_to_dl)
+
+    def test_download_small_groups_concurrently(self) -> None:
+        self.client_kwargs["concurrent_groups"] = 2
+        client = self.get_download_client(["small", "small_no_friends"])
+
+        errors, count = client.download_small_groups([["small"], ["small_no_friends"]])
+
+        assert errors == []
+        assert count == 2
+        assert (self.tmp_path / "small").exists()
+        assert (self.tmp_path / "small_no_friends").exists()
+
+    def test_download_small_groups_share_connection_budget(self, monkeypatch) -> None:
+        self.client_kwargs["n_procs"] = 2
+        self.client_kwargs["concurrent_groups"] = 8
+        client = self.get_download_client()
+        active, most_active = [0], [0]
+        lock = threading.Lock()
+
+        def request_tarfile(small_group):
+            with lock:
+                active[0] += 1
+                most_active[0] = max(most_active[0], active[0])
+            time.sleep(0.05)
+            with lock:
+                active[0] -= 1
+            return None, [small_group]
+
+        monkeypatch.setattr(client, "_request_tarfile", request_tarfile)
+
+        errors, count = client.download_small_groups([[str(i)] for i in range(8)])
+
+        assert count == 0
+        assert sorted(errors) == [[str(i)] for i in range(8)]
+        assert most_active[0] == 2
+
+    def test_tar_member_outside_of_directory(self) -> None:
+        with pytest.raises(ValueError):
+            self.client._member_path("../escaped")
+        assert self.client._member_path("a/b") == os.path.join(
+            os.path.realpath(str(self.tmp_path)), "a", "b"
+        )
+
     def test_download_annotations(self) -> None:
 
         # uuid of file that has an annotation
@@ -157,6 +244,149 @@ class TestDownloadClient:
             file_path.read_text() == uuids["annotations.txt"]["contents"]
         ), "annotations content incorrect"
 
+    def test_download_run_annotations(self, requests_mock, monkeypatch) -> None:
+        rows = {"a1": b"a1\tf1\n", "a2": b"a2\tf2\n", "a3": b"a3\tf1,f2\n"}
+        requested = []
+
+        def annotations_tarfile(request, context):
+            ids = request.json()["ids"]
+            requested.append(ids)
+            contents = b"id\tentity_id\n" + b"".join(rows[i] for i in ids)
+            buf = io.BytesIO()
+            with tarfile.open(fileobj=buf, mode="w:gz") as tar:
+                info = tarfile.TarInfo(name="annotations.txt")
+                info.size = len(contents)
+                tar.addfile(info, io.BytesIO(contents))
+            return buf.getvalue()
+
+        requests_mock.post(BASE_URL + "/data?compress", content=annotations_tarfile)
+        monkeypatch.setattr(GDCHTTPDownloadClient, "annotation_batch_size", 2)
+        for file_id, annotations in [("f1", ["a1", "a3"]), ("f2", ["a3", "a2"])]:
+            self.index_client.metadata[file_id] = {"annotations": annotations}
+            (self.tmp_path / file_id).mkdir()
+
+        written = self.client.download_run_annotations(["f1", "f2", "f3"])
+
+        # every annotation requested once, in as few requests as possible
+        assert requested == [["a1", "a2"], ["a3"]]
+        assert written == ["f1", "f2"]
+        assert (self.tmp_path / "f1" / "annotations.txt").read_bytes() == (
+            b"id\tentity_id\na1\tf1\na3\tf1,f2\n"
+        )
+        assert (self.tmp_path / "f2" / "annotations.txt").read_bytes() == (
+            b"id\tentity_id\na2\tf2\na3\tf1,f2\n"
+        )
+
+    def test_related_files_scheduled_as_peers(self, monkeypatch) -> None:
+        scheduled = []
+
+        def download_files(client, urls):
+            scheduled.append(list(urls))
+            for url in urls:
+                client._make_stream(url)
+            return list(urls), {}
+
+        monkeypatch.setattr(
+            "gdc_client.parcel.client.Client.download_files", download_files
+        )
+        linked = []
+        monkeypatch.setattr(
+            GDCHTTPDownloadClient,
+            "_link_related_file",
+            lambda client, stream, owners: linked.append((stream.directory, owners)),
+        )
+        for file_id in ["bam1", "bam2"]:
+            self.index_client.metadata[file_id] = {
+                "related_files": ["bai"],
+                "annotations": [],
+            }
+        urls = [self.client.data_uri + file_id for file_id in ["bam1", "bam2"]]
+
+        downloaded, errors = self.client.download_files(urls)
+
+        # the shared related file is downloaded once, ahead of its primary file
+        assert scheduled == [[self.client.data_uri + "bai"] + urls]
+        assert linked == [(str(self.tmp_path / "bam1"), ["bam1", "bam2"])]
+        assert downloaded == urls
+        assert errors == {}
+
+    def test_related_file_requested_as_primary(self, monkeypatch) -> None:
+        scheduled = []
+
+        def download_files(client, urls):
+            scheduled.append(list(urls))
+            for url in urls:
+                client._make_stream(url)
+            return list(urls), {}
+
+        monkeypatch.setattr(
+            "gdc_client.parcel.client.Client.download_files", download_files
+        )
+        linked = []
+        monkeypatch.setattr(
+            GDCHTTPDownloadClient,
+            "_link_related_file",
+            lambda client, stream, owners: linked.append((stream.directory, owners)),
+        )
+        self.index_client.metadata["bam"] = {
+            "related_files": ["bai"],
+            "annotations": [],
+        }
+        self.index_client.metadata["bai"] = {"related_files": [], "annotations": []}
+        urls = [self.client.data_uri + file_id for file_id in ["bam", "bai"]]
+
+        downloaded, errors = self.client.download_files(urls)
+
+        # downloaded once, as a primary file, and linked to the bam
+        assert scheduled == [urls]
+        assert linked == [(str(self.tmp_path / "bai"), ["bam"])]
+        assert downloaded == urls
+        assert errors == {}
+
+    @pytest.mark.parametrize(
+        "status_code, error, calls",
+        [
+            # refused for good, not retried
+            (403, "403 Client Error", 1),
+            # retried, then the hole is found before the md5sum check
+            (500, "Incomplete download: 0 of 1024 bytes", 6),
+        ],
+    )
+    def test_failed_segment_fails_download(
+        self, requests_mock, status_code: int, error: str, calls: int
+    ) -> None:
+        self.client_kwargs["debug"] = False
+        # forked workers would hide the requests they make
+        self.client_kwargs["engine"] = "threads"
+        client = self.get_download_client()
+        url = BASE_URL + "/data/controlled"
+        requests_mock.get(url, status_code=status_code, text="Refused")
+        self.index_client.metadata["controlled"] = {
+            "file_size": 1024,
+            "md5sum": "d47b127bc2de2d687ddc82dac354c415",  # pragma: allowlist secret
+            "file_name": "controlled.txt",
+            "related_files": [],
+            "annotations": [],
+        }
+
+        downloaded, errors = client.download_files([url])
+
+        assert downloaded == []
+        assert errors[url].startswith(error)
+        assert requests_mock.call_count == calls
+
+    def test_link_related_file(self) -> None:
+        stream = DownloadStream(BASE_URL + "/data/bai", str(self.tmp_path))
+        stream.name = "file.bai"
+        stream.directory = str(self.tmp_path / "bam1")
+        os.makedirs(stream.directory)
+        Path(stream.path).write_text("index")
+
+        self.client._link_related_file(stream, ["bam1", "bam2", "bam3"])
+
+        for owner in ["bam2", "bam3"]:
+            assert (self.tmp_path / owner / "file.bai").read_text() == "index"
+
     @pytest.mark.parametrize("check_segments", (True, False))
     def test_no_segment_md5sums_args(self, check_segments: bool) -> None:
 
@@ -182,6 +412,102 @@ class TestDownloadClient:
             not temp_file_path.exists()
         ), "test_file.txt.partial should not exist on successful download"
 
+    def test_rerun_skips_completed_files(self, monkeypatch) -> None:
+        self.argparse_args.file_ids = ["big_no_friends", "small_no_friends"]
+        parser = GDCClientArgumentParser()
+        download(parser, self.argparse_args)
+
+        journal = RunJournal(str(self.tmp_path))
+        assert journal.completed(["big_no_friends", "small_no_friends"]) == {
+            "big_no_friends",
+            "small_no_friends",
+        }
+
+        queried = []
+
+        def iter_latest_versions(url, ids, **kwargs):
+            queried.extend(ids)
+            return iter([])
+
+        monkeypatch.setattr(
+            "gdc_client.download.parser.iter_latest_versions", iter_latest_versions
+        )
+        # a file that changed on disk is downloaded again
+        path = journal.load()["small_no_friends"]["path"]
+        (self.tmp_path / path).write_text("changed")
+
+        download(parser, self.argparse_args)
+
+        assert queried == ["small_no_friends"]
+
+        # the latest versions of completed files may be newer
+        queried.clear()
+        self.argparse_args.latest = True
+        download(parser, self.argparse_args)
+
+        assert queried == ["big_no_friends", "small_no_friends"]
+
+    def test_journal_waits_for_related_files(self) -> None:
+        # "related 3" is missing from the data server
+        journal = RunJournal(str(self.tmp_path))
+        self.client_kwargs["debug"] = False
+        self.client_kwargs["run_journal"] = journal
+        client = self.get_download_client(["big_rel"])
+
+        downloaded, errors = client.download_files([BASE_URL + "/data/big_rel"])
+        journal.close()
+
+        assert downloaded == [BASE_URL + "/data/big_rel"]
+        assert journal.completed(["big_rel"]) == set()
+
+    @pytest.mark.parametrize("engine", ("processes", "threads"))
+    def test_download_files_concurrently(self, engine: str) -> None:
+        file_ids = ["big_no_friends", "big_rel"]
+        self.client_kwargs["concurrent_files"] = 2
+        self.client_kwargs["engine"] = engine
+        client = self.get_download_client()
+
+        downloaded, errors = client.download_files(
+            [BASE_URL + "/data/" + file_id for file_id in file_ids]
+        )
+
+        assert errors == {}
+        assert len(downloaded) == 2
+        for file_id in file_ids:
+            file_path = self.tmp_path / file_id / "test_file.txt"
+            assert file_path.read_text() == uuids[file_id]["contents"]
+        assert client.connection_budget.available == client.n_procs
+        # workers aren't forked while other threads run
+        assert client.workers == (2 if engine == "threads" else 1)
+        assert bool(client.prepare_ahead) == (engine == "threads")
+
+    def test_streams_prepared_ahead(self, monkeypatch) -> None:
+        file_ids = ["big_no_friends", "big_rel", "big_ann"]
+        urls = [BASE_URL + "/data/" + file_id for file_id in file_ids]
+        self.client_kwargs["prepare_ahead"] = 2
+        self.client_kwargs["engine"] = "threads"
+        client = self.get_download_client()
+        client.annotations = False
+        prepared = []
+        prepare_stream = client._prepare_stream
+
+        def recording_prepare_stream(url):
+            stream = prepare_stream(url)
+            prepared.append(url)
+            # preallocated before its download started
+            assert os.path.getsize(stream.temp_path) == stream.size
+            return stream
+
+        monkeypatch.setattr(client, "_prepare_stream", recording_prepare_stream)
+
+        downloaded, errors = client.download_files(urls)
+
+        assert errors == {}
+        assert sorted(prepared) == sorted(urls[1:])
+        for file_id in file_ids:
+            file_path = self.tmp_path / file_id / "test_file.txt"
+            assert file_path.read_text() == uuids[file_id]["contents"]
+
 
 def test_fix_url() -> None:
     fixed_url = "https://api.gdc.cancer.gov/"
@@ -189,3 +515,262 @@ def test_fix_url() -> None:
     assert fix_url("api.gdc.cancer.gov") == fixed_url
     assert fix_url(fixed_url) == fixed_url
     assert fix_url("api.gdc.cancer.gov/") == fixed_url
+
+
+def test_download_stream_session_is_reused(monkeypatch) -> None:
+    monkeypatch.setattr(DownloadStream, "_sessions", {})
+    monkeypatch.setattr(DownloadStream, "connection_pool_size", 4)
+
+    stream = DownloadStream(BASE_URL + "/data/big_no_friends", "/tmp")
+    other_stream = DownloadStream(BASE_URL + "/data/big_ann", "/tmp")
+
+    session = stream.session()
+    assert other_stream.session() is session
+    assert session.get_adapter(BASE_URL)._pool_maxsize == 4
+    assert DownloadStream.connection_stats() == {
+        "connections_opened": 0,
+        "connections_reused": 0,
+    }
+
+
+def test_download_stream_known_information_skips_probe(monkeypatch) -> None:
+    def request(*args, **kwargs):
+        raise AssertionError("the file information was known")
+
+    stream = DownloadStream(BASE_URL + "/data/big_no_friends", "/tmp")
+    stream.set_information(size=10, md5sum="abc", name="dir/file.bam")
+    monkeypatch.setattr(stream, "request", request)
+
+    stream.init()
+
+    assert (stream.size, stream.md5sum, stream.name) == (10, "abc", "file.bam")
+
+
+def test_download_stream_range_probe(requests_mock) -> None:
+    url = "https://example.com/data/file"
+    requests_mock.get(
+        url,
+        status_code=206,
+        content=b"x",
+        headers={
+            "Content-Range": "bytes 0-0/1234",
+            "Content-Disposition": "attachment; filename=file.bam",
+            "content-md5": "abc",
+        },
+    )
+
+    stream = DownloadStream(url, "/tmp")
+    stream.get_information()
+
+    assert requests_mock.call_count == 1
+    assert requests_mock.last_request.headers["Range"] == "bytes=0-0"
+    assert (stream.size, stream.md5sum, stream.name) == (1234, "abc", "file.bam")
+
+
+@pytest.mark.parametrize("write_method", ("pwrite", "offset"))
+def test_download_stream_write_chunk(
+    monkeypatch, tmp_path: Path, write_method: str
+) -> None:
+    monkeypatch.setattr(DownloadStream, "write_method", write_method)
+
+    stream = DownloadStream(BASE_URL + "/data/big_no_friends", str(tmp_path))
+    stream.name = "test_file.txt"
+    stream.setup_directories()
+    Path(stream.temp_path).write_bytes(b"\0" * 8)
+
+    stream.write_chunk(b"5678", 4)
+    stream.write_chunk(b"1234", 0)
+    stream.close_file()
+
+    assert Path(stream.temp_path).read_bytes() == b"12345678"
+
+
+def test_download_stream_fd_per_thread(monkeypatch, tmp_path: Path) -> None:
+    monkeypatch.setattr(DownloadStream, "write_method", "pwrite")
+    stream = DownloadStream(BASE_URL + "/data/big_no_friends", str(tmp_path))
+    stream.name = "test_file.txt"
+    stream.setup_directories()
+    Path(stream.temp_path).write_bytes(b"\0" * 8)
+
+    # a slow open, as on a parallel filesystem, lets the threads race
+    opened, closed = [], []
+    real_open, real_close = os.open, os.close
+
+    def slow_open(*args):
+        time.sleep(0.05)
+        fd = real_open(*args)
+        opened.append(fd)
+        return fd
+
+    def tracked_close(fd):
+        closed.append(fd)
+        real_close(fd)
+
+    monkeypatch.setattr(os, "open", slow_open)
+    monkeypatch.setattr(os, "close", tracked_close)
+
+    def worker(i):
+        stream.write_chunk(str(i).encode(), i)
+        stream.close_file()
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert sorted(closed) == sorted(opened) and len(opened) == 8
+    assert Path(stream.temp_path).read_bytes() == b"01234567"
+
+
+def test_write_segment_stops_at_limit(
+    monkeypatch, requests_mock, tmp_path: Path
+) -> None:
+    monkeypatch.setattr(DownloadStream, "http_chunk_size", 256)
+    monkeypatch.setattr(DownloadStream, "limit_check_interval", 0)
+    monkeypatch.setattr(DownloadStream, "write_method", "offset")
+    url = BASE_URL + "/data/big_no_friends"
+    requests_mock.get(url, content=b"A" * 1024)
+
+    stream = DownloadStream(url, str(tmp_path))
+    stream.name = "test_file.txt"
+    stream.setup_directories()
+    Path(stream.temp_path).write_bytes(b"\0" * 1024)
+    q_complete = queue.Queue()
+
+    written = stream.write_segment(Interval(0, 1024, 7), q_complete, limits={7: 512})
+
+    assert written == 512
+    completed = [q_complete.get() for _ in range(q_complete.qsize())]
+    assert [(i.begin, i.end) for i in completed] == [(0, 512)]
+    assert len(completed[0].data["md5sums"]) == 2
+
+
+class LateSplit(dict):
+    """Segment limits that only show a split after a few checks."""
+
+    def __init__(self, task, split, after):
+        super().__init__()
+        self.task, self.split, self.checks = task, split, after
+
+    def get(self, key, default=None):
+        self.checks -= 1
+        if key == self.task and self.checks < 0:
+            return self.split
+        return default
+
+
+def test_write_segment_overruns_split(
+    monkeypatch, requests_mock, tmp_path: Path
+) -> None:
+    monkeypatch.setattr(DownloadStream, "http_chunk_size", 256)
+    monkeypatch.setattr(DownloadStream, "limit_check_interval", 0)
+    monkeypatch.setattr(DownloadStream, "write_method", "offset")
+    url = BASE_URL + "/data/big_no_friends"
+    requests_mock.get(url, content=b"A" * 1024)
+
+    stream = DownloadStream(url, str(tmp_path))
+    stream.name = "test_file.txt"
+    stream.setup_directories()
+    Path(stream.temp_path).write_bytes(b"\0" * 1024)
+    q_complete = queue.Queue()
+    chunk_sizer = ChunkSizer(256, minimum=64, maximum=256)
+
+    # the split at 300 is only noticed once 512 bytes were written
+    written = stream.write_segment(
+        Interval(0, 1024, 7),
+        q_complete,
+        limits=LateSplit(7, 300, after=2),
+        chunk_sizer=chunk_sizer,
+    )
+
+    assert written == 512
+    completed = [q_complete.get() for _ in range(q_complete.qsize())]
+    assert [(i.begin, i.end) for i in completed] == [(0, 512)]
+    assert requests_mock.call_count == 1
+    assert chunk_sizer.size == 256
+
+
+def test_write_segment_reports_batches(
+    monkeypatch, requests_mock, tmp_path: Path
+) -> None:
+    monkeypatch.setattr(DownloadStream, "http_chunk_size", 256)
+    monkeypatch.setattr(DownloadStream, "report_size", 512)
+    monkeypatch.setattr(DownloadStream, "write_method", "offset")
+    url = BASE_URL + "/data/big_no_friends"
+    data = b"A" * 512 + b"B" * 512 + b"C" * 100
+    requests_mock.get(url, content=data)
+
+    stream = DownloadStream(url, str(tmp_path))
+    stream.name = "test_file.txt"
+    stream.setup_directories()
+    Path(stream.temp_path).write_bytes(b"\0" * len(data))
+    q_complete = queue.Queue()
+
+    written = stream.write_segment(Interval(0, len(data), 0), q_complete)
+
+    assert written == len(data)
+    completed = [q_complete.get() for _ in range(q_complete.qsize())]
+    assert [(i.begin, i.end) for i in completed] == [
+        (0, 512),
+        (512, 1024),
+        (1024, 1124),
+    ]
+    assert completed[1].data == {
+        "md5sums": [md5sum(b"B" * 256)] * 2,
+        "chunk_size": 256,
+    }
+    assert completed[2].data == {"md5sums": [md5sum(b"C" * 100)], "chunk_size": 100}
+
+
+def test_write_segment_tunes_chunk_size(
+    monkeypatch, requests_mock, tmp_path: Path
+) -> None:
+    monkeypatch.setattr(DownloadStream, "write_method", "offset")
+    url = BASE_URL + "/data/big_no_friends"
+    data = b"A" * 1024
+    requests_mock.get(
+        url, [{"exc": requests.exceptions.ConnectionError}, {"content": data}]
+    )
+
+    stream = DownloadStream(url, str(tmp_path))
+    stream.name = "test_file.txt"
+    stream.setup_directories()
+    Path(stream.temp_path).write_bytes(b"\0" * len(data))
+    q_complete = queue.Queue()
+    chunk_sizer = ChunkSizer(256, minimum=64, maximum=1024)
+
+    written = stream.write_segment(
+        Interval(0, len(data), 0), q_complete, chunk_sizer=chunk_sizer
+    )
+
+    # the failed request halved the chunk size of the retry
+    assert written == len(data)
+    completed = [q_complete.get() for _ in range(q_complete.qsize())]
+    assert {i.data["chunk_size"] for i in completed} == {128}
+    assert chunk_sizer.report() == {("chunk_size", 128): len(data)}
+
+
+def test_run_journal(tmp_path: Path) -> None:
+    journal = RunJournal(str(tmp_path))
+    (tmp_path / "a").mkdir()
+    (tmp_path / "a" / "file").write_text("data")
+    (tmp_path / "a" / "related").write_text("index")
+    journal.record("a", str(tmp_path / "a" / "file"), "md5")
+    journal.record(
+        "r", str(tmp_path / "a" / "file"), "md5", [str(tmp_path / "a" / "related")]
+    )
+    journal.close()
+    # a line cut short by an interrupted run
+    with open(journal.path, "a") as f:
+        f.write('{"id": "c", "pa')
+
+    assert RunJournal(str(tmp_path)).completed(["a", "r", "c", "d"]) == {"a", "r"}
+    assert RunJournal(str(tmp_path)).load()["a"]["path"] == os.path.join("a", "file")
+
+    # a file or related file that changed since it was recorded
+    os.remove(str(tmp_path / "a" / "related"))
+    assert RunJournal(str(tmp_path)).completed(["a", "r"]) == {"a"}
+    stat = os.stat(str(tmp_path / "a" / "file"))
+    os.utime(str(tmp_path / "a" / "file"), ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+    assert RunJournal(str(tmp_path)).completed(["a", "r"]) == set()
@@ -1,9 +1,19 @@
+import gzip
+import io
 import logging
+import os
 from unittest import mock
 
 import pytest
+import requests
+import urllib3
 
 from gdc_client.parcel import utils
+from gdc_client.parcel import governor
+from gdc_client.parcel import storage
+from gdc_client.parcel.budget import ConnectionBudget
+from gdc_client.parcel.chunk_sizer import ChunkSizer
+from gdc_client.parcel.download_stream import DownloadStream
 from gdc_client import exceptions
 
 
@@ -88,3 +98,191 @@ def test__md5sum_whole_file():
             "d47b127bc2de2d687ddc82dac354c415"  # pragma: allowlist secret
         )
         mock_file.assert_called_once_with("test.txt", "rb")
+
+
+def test_connection_budget():
+    budget = ConnectionBudget(8)
+
+    assert budget.acquire(1) == 1
+    assert budget.acquire(16) == 7
+    assert budget.available == 0
+
+    budget.release(7)
+    assert budget.acquire(8, minimum=4) == 7
+    budget.release(8)
+    assert budget.available == 8
+
+
+def test_token_bucket_sleeps_off_debt(monkeypatch):
+    now = [100.0]
+    sleeps = []
+    monkeypatch.setattr(governor.time, "monotonic", lambda: now[0])
+    monkeypatch.setattr(governor.time, "sleep", sleeps.append)
+    bucket = governor.TokenBucket(100, mock.MagicMock())
+
+    # one second worth of tokens is available up front
+    assert bucket.take(100) == 0
+    assert bucket.take(50) == 0.5
+    now[0] += 0.5
+    assert bucket.take(100) == 1
+    assert sleeps == [0.5, 1]
+
+    bucket.set_rate(0)
+    assert bucket.take(10**9) == 0
+
+
+def test_governor_limits_file(tmp_path, monkeypatch):
+    limits_file = tmp_path / "limits"
+    limits_file.write_text("max_bandwidth = 1000  # bytes\n")
+    gov = governor.Governor(max_bandwidth=10, limits_file=str(limits_file))
+    assert gov.bandwidth.rate == 1000
+    assert gov.requests.rate == 0
+
+    limits_file.write_text("max-bandwidth = 0\nmax_request_rate = 2.5\n")
+    # only re-read once it changed and check_interval has passed
+    os.utime(str(limits_file), (1, 1))
+    monkeypatch.setattr(governor.Governor, "check_interval", 0)
+    gov.take_request()
+    assert gov.bandwidth.rate == 0
+    assert gov.requests.rate == 2.5
+
+
+def test_governor_configure():
+    try:
+        assert governor.configure() is None
+        gov = governor.configure(max_request_rate=5)
+        assert governor._governor is gov
+        assert gov.requests.rate == 5
+    finally:
+        governor.configure()
+
+
+@pytest.mark.parametrize("allocate", ["sparse", "truncate", "fallocate"])
+def test_storage_allocate(tmp_path, allocate):
+    path = str(tmp_path / "file.partial")
+
+    storage.Storage(allocate=allocate).allocate(path, 12345)
+    assert os.path.getsize(path) == 12345
+
+    # an interrupted download of the right length is kept
+    with open(path, "r+b") as f:
+        f.write(b"data")
+    storage.Storage(allocate=allocate).allocate(path, 12345)
+    with open(path, "rb") as f:
+        assert f.read(4) == b"data"
+
+
+def test_storage_aligned_chunks():
+    aligned = storage.Storage(alignment=4)
+    chunks = [b"abcdef", b"ghijklmnop", b"q"]
+
+    pieces = list(aligned.aligned_chunks(iter(chunks), 2, 8))
+
+    assert b"".join(pieces) == b"abcdefghijklmnopq"
+    # up to the first boundary, then whole pieces, then the rest
+    assert [len(piece) for piece in pieces] == [2, 8, 7]
+    assert list(storage.Storage().aligned_chunks(iter(chunks), 2, 8)) == chunks
+
+
+def test_select_storage(tmp_path, monkeypatch):
+    mounts = tmp_path / "mounts"
+    mounts.write_text(
+        "/dev/sda1 / ext4 rw 0 0\n"
+        "server:/export {0} nfs4 rw 0 0\n".format(tmp_path / "nfs")
+    )
+    assert storage.filesystem_type("/data", str(mounts)) == "ext4"
+    assert storage.filesystem_type(str(tmp_path / "nfs" / "a"), str(mounts)) == "nfs4"
+
+    for fs_type, allocate, aligned in [
+        ("xfs", "fallocate", False),
+        ("nfs", "truncate", False),
+        ("lustre", "truncate", True),
+        (None, "sparse", False),
+    ]:
+        monkeypatch.setattr(storage, "filesystem_type", lambda path: fs_type)
+        selected = storage.select_storage(str(tmp_path))
+        assert selected.allocate_method == allocate
+        assert bool(selected.alignment) is aligned
+
+    assert storage.select_storage(str(tmp_path), "truncate").allocate_method == (
+        "truncate"
+    )
+
+
+def _response(body, headers=None):
+    r = requests.Response()
+    r.raw = urllib3.HTTPResponse(
+        body=io.BytesIO(body), headers=headers, preload_content=False
+    )
+    r.headers = requests.structures.CaseInsensitiveDict(headers or {})
+    return r
+
+
+def test_iter_response_reuses_buffer(tmp_path):
+    data = os.urandom(10000)
+    stream = DownloadStream("http://localhost/data/x", str(tmp_path))
+    stream.http_chunk_size = 4096
+
+    chunks = [
+        (chunk.obj, bytes(chunk)) for chunk in stream.iter_response(_response(data))
+    ]
+
+    assert [len(chunk) for _, chunk in chunks] == [4096, 4096, 1808]
+    assert len({id(buf) for buf, _ in chunks}) == 1
+    assert b"".join(chunk for _, chunk in chunks) == data
+
+
+def test_iter_response_truncated_body(tmp_path):
+    data = os.urandom(10000)
+    stream = DownloadStream("http://localhost/data/x", str(tmp_path))
+    stream.http_chunk_size = 4096
+    r = _response(data[:5000], {"Content-Length": str(len(data))})
+
+    received = []
+    with pytest.raises(urllib3.exceptions.ProtocolError):
+        for chunk in stream.iter_response(r):
+            received.append(bytes(chunk))
+    assert data.startswith(b"".join(received))
+
+
+def test_iter_response_decodes_encoded_body(tmp_path):
+    data = os.urandom(10000)
+    stream = DownloadStream("http://localhost/data/x", str(tmp_path))
+    r = _response(gzip.compress(data), {"Content-Encoding": "gzip"})
+
+    assert b"".join(stream.iter_response(r)) == data
+
+
+def test_chunk_sizer():
+    MB = 1024 * 1024
+    sizer = ChunkSizer(MB, minimum=MB // 4, maximum=8 * MB, chunk_seconds=0.25)
+
+    # grows at most twofold per segment, up to the maximum
+    sizer.succeeded(100 * MB, 1)
+    assert sizer.size == 2 * MB
+    sizer.succeeded(100 * MB, 1)
+    sizer.succeeded(100 * MB, 1)
+    assert sizer.size == 8 * MB
+
+    # failures halve it and hold it until the connection recovers
+    sizer.failed(MB)
+    assert sizer.size == 4 * MB
+    sizer.succeeded(100 * MB, 1)
+    assert sizer.size == 4 * MB
+    sizer.succeeded(100 * MB, 1)
+    assert sizer.size == 8 * MB
+
+    assert sizer.report() == {
+        ("chunk_size", MB): 100 * MB,
+        ("chunk_size", 2 * MB): 100 * MB,
+        ("chunk_size", 4 * MB): 300 * MB,
+        ("chunk_size", 8 * MB): MB,
+    }
+
+    # a slow connection shrinks it right away, down to the minimum
+    sizer = ChunkSizer(MB, minimum=MB // 4, maximum=8 * MB, chunk_seconds=0.25)
+    sizer.succeeded(16 * MB, 100)
+    assert sizer.size == MB // 4
+    # segments of a chunk or two aren't measured
+    sizer.succeeded(MB // 4, 1)
+    assert sizer.size == MB // 4
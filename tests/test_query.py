@@ -1,3 +1,4 @@
+import json
 import pytest
 import re
 from typing import List, Iterable, Mapping
@@ -6,8 +7,13 @@ from conftest import uuids
 from requests.exceptions import HTTPError
 
 from gdc_client.parcel.const import HTTP_CHUNK_SIZE
-from gdc_client.query.index import GDCIndexClient
-from gdc_client.query.versions import _chunk_list, get_latest_versions
+from gdc_client.query.cache import METADATA, VERSION, MetadataCache
+from gdc_client.query.index import EndpointStats, GDCIndexClient
+from gdc_client.query.versions import (
+    _chunk_list,
+    get_latest_versions,
+    iter_latest_versions,
+)
 
 # default values for flask
 BASE_URL = "http://127.0.0.1:5000"
@@ -37,6 +43,27 @@ class TestQueryIndex:
 
         self.assert_index_with_uuids(uuid)
 
+    def test_get_metadata_in_pages(self, monkeypatch) -> None:
+        monkeypatch.setattr(GDCIndexClient, "metadata_page_size", 2)
+        input_uuids = ["small", "small_no_friends", "small_ann", "small_rel", "big"]
+        requests_made = []
+        post = self.index.session.post
+
+        def counting_post(url, json=None, **kwargs):
+            requests_made.append(json["size"])
+            return post(url, json=json, **kwargs)
+
+        monkeypatch.setattr(self.index.session, "post", counting_post)
+
+        pages = list(self.index.iter_metadata(input_uuids))
+
+        assert sorted(uuid for page in pages for uuid in page) == sorted(input_uuids)
+        assert all(len(page) <= 2 for page in pages)
+        # the active endpoint resolved every UUID, legacy wasn't asked
+        assert sorted(requests_made) == ["1", "2", "2"]
+        for uuid in input_uuids:
+            self.assert_index_with_uuids(uuid)
+
     ############ mock separate files ############
     @pytest.mark.parametrize(
         "input_uuids,expected_bigs,expected_smalls",
@@ -92,6 +119,40 @@ class TestQueryIndex:
         assert bigs == [invalid]
         assert smalls == []
 
+    def test_metadata_from_cache(self, tmp_path, monkeypatch) -> None:
+        cache = MetadataCache(str(tmp_path / "cache.db"))
+        self.index = GDCIndexClient(uri=BASE_URL, cache=cache)
+        self.index._get_metadata(["small", "big"])
+        self.index = GDCIndexClient(uri=BASE_URL, cache=cache)
+        requests_made = []
+        post = self.index.session.post
+
+        def counting_post(url, json=None, **kwargs):
+            requests_made.append(json["size"])
+            return post(url, json=json, **kwargs)
+
+        monkeypatch.setattr(self.index.session, "post", counting_post)
+
+        self.index._get_metadata(["small", "big", "small_no_friends"])
+
+        # only the uncached file was asked for
+        assert requests_made == ["1"]
+        for uuid in ["small", "big", "small_no_friends"]:
+            self.assert_index_with_uuids(uuid)
+
+    def test_offline_plans_from_cache(self, tmp_path) -> None:
+        cache = MetadataCache(str(tmp_path / "cache.db"), ttl=1)
+        GDCIndexClient(uri=BASE_URL, cache=cache)._get_metadata(["small_no_friends"])
+        cache.ttl = 0.000001  # everything cached has expired
+        self.index = GDCIndexClient(uri="http://127.0.0.1:1", cache=cache, offline=True)
+
+        bigs, smalls = self.index.separate_small_files(
+            ["small_no_friends", "small"], HTTP_CHUNK_SIZE
+        )
+
+        assert bigs == ["small"]
+        assert smalls == [["small_no_friends"]]
+
 
 @pytest.mark.parametrize(
     "case",
@@ -146,3 +207,198 @@ def test_get_latest_versions_error(
 
     with pytest.raises(HTTPError, match=expected_err_msg):
         _ = get_latest_versions(url, ids)
+
+
+def versions_callback(request, context):
+    return [{"id": i, "latest_id": i + "_new"} for i in request.json()["ids"]]
+
+
+def test_iter_latest_versions_yields_chunks(requests_mock) -> None:
+    url = "https://example.com"
+    requests_mock.post(url + "/files/versions", json=versions_callback)
+    ids = [str(i) for i in range(5)]
+
+    chunks = list(iter_latest_versions(url, ids, chunk_size=2, max_workers=2))
+
+    assert sorted(len(chunk) for chunk in chunks) == [1, 2, 2]
+    assert {k: v for chunk in chunks for k, v in chunk.items()} == {
+        i: i + "_new" for i in ids
+    }
+
+
+def test_latest_versions_split_too_large(requests_mock) -> None:
+    url = "https://example.com"
+    sizes = []
+
+    def callback(request, context):
+        ids = request.json()["ids"]
+        sizes.append(len(ids))
+        if len(ids) > 2:
+            context.status_code = 413
+            return []
+        return versions_callback(request, context)
+
+    requests_mock.post(url + "/files/versions", json=callback)
+    ids = [str(i) for i in range(8)]
+
+    result = {}
+    for chunk in iter_latest_versions(url, ids, chunk_size=8, max_workers=1):
+        result.update(chunk)
+
+    assert result == {i: i + "_new" for i in ids}
+    assert sizes[:3] == [8, 4, 2]
+
+
+def test_latest_versions_retry(requests_mock) -> None:
+    url = "https://example.com"
+    requests_mock.post(
+        url + "/files/versions",
+        [
+            {"status_code": 503, "json": []},
+            {"status_code": 429, "json": []},
+            {"json": [{"id": "foo", "latest_id": "bar"}]},
+        ],
+    )
+
+    chunks = list(iter_latest_versions(url, ["foo"], backoff=0))
+
+    assert chunks == [{"foo": "bar"}]
+    assert requests_mock.call_count == 3
+
+
+@pytest.mark.parametrize(
+    "bundle_size, concurrency, expected",
+    [
+        (10, 1, [["a", "d", "e"], ["b", "c"]]),
+        # groups that all download at once are not split any further
+        (10, 4, [["a", "d", "e"], ["b", "c"]]),
+        (100, 4, [["a", "b", "c", "d", "e"]]),
+        # more groups than download at once, rounded up to a multiple
+        (8, 2, [["a"], ["b"], ["c"], ["d", "e"]]),
+    ],
+)
+def test_pack_small_files(
+    bundle_size: int, concurrency: int, expected: List[List[str]]
+) -> None:
+    index = GDCIndexClient(uri=BASE_URL)
+    sizes = {"e": 2, "d": 3, "c": 4, "b": 5, "a": 6}
+    index.metadata = {uuid: {"file_size": size} for uuid, size in sizes.items()}
+
+    groups = index._pack_small_files(list(sizes), bundle_size, concurrency)
+
+    assert groups == expected
+
+
+def test_pack_small_files_multiple_of_concurrency() -> None:
+    index = GDCIndexClient(uri=BASE_URL)
+    index.metadata = {str(i): {"file_size": 1} for i in range(9)}
+
+    groups = index._pack_small_files(list(index.metadata), 2, 4)
+
+    assert len(groups) == 8
+    assert sorted(len(group) for group in groups) == [1] * 7 + [2]
+
+
+def test_pack_small_files_is_deterministic() -> None:
+    index = GDCIndexClient(uri=BASE_URL)
+    index.metadata = {str(i): {"file_size": 1} for i in range(6)}
+
+    groups = index._pack_small_files(["3", "5", "1", "0", "4", "2"], 3)
+
+    assert groups == [["0", "2", "4"], ["1", "3", "5"]]
+
+
+def test_get_metadata_page_asks_legacy_for_unresolved(monkeypatch) -> None:
+    index = GDCIndexClient(uri=BASE_URL)
+    legacy_files = {"old 1", "old 2"}
+    asked = []
+
+    def get_hits(url, metadata_query):
+        endpoint = "legacy" if "legacy" in url else "active"
+        ids = json.loads(metadata_query["filters"])["content"][0]["content"]["value"]
+        asked.append((endpoint, sorted(ids)))
+        return [
+            {"id": i, "access": "open", "file_size": 1, "md5sum": "x"}
+            for i in ids
+            if (i in legacy_files) == (endpoint == "legacy")
+        ]
+
+    monkeypatch.setattr(index, "_get_hits", get_hits)
+
+    index._get_metadata_page(["new", "old 1"])
+    assert asked == [("active", ["new", "old 1"]), ("legacy", ["old 1"])]
+    assert index.endpoint_stats.mixed
+
+    # both endpoints hold files of this manifest, ask them together
+    asked.clear()
+    index._get_metadata_page(["old 2"])
+    assert sorted(asked) == [("active", ["old 2"]), ("legacy", ["old 2"])]
+    assert set(index.metadata) == {"new", "old 1", "old 2"}
+
+
+def test_close_stops_metadata_threads() -> None:
+    index = GDCIndexClient(uri=BASE_URL)
+    index.prefetch_metadata(["small_no_friends"])
+    index.close()
+
+    with pytest.raises(RuntimeError):
+        index.prefetch_metadata(["big_no_friends"])
+
+
+def test_endpoint_stats_preferred() -> None:
+    stats = EndpointStats()
+    assert stats.preferred == "active"
+    stats.record("legacy", 3, 0)
+    stats.record("active", 0, 3)
+    assert stats.preferred == "legacy"
+    assert not stats.mixed
+
+
+def test_metadata_cache_ttl_and_eviction(tmp_path, monkeypatch) -> None:
+    now = [1000.0]
+    monkeypatch.setattr("gdc_client.query.cache.time.time", lambda: now[0])
+    cache = MetadataCache(str(tmp_path / "cache.db"), ttl=10, max_entries=2)
+
+    cache.put_many(VERSION, {"a": "a2", "b": "b"})
+    now[0] += 5
+    assert cache.get_many(VERSION, ["a", "c"]) == {"a": "a2"}
+
+    # "b" is the least recently used
+    now[0] += 1
+    cache.put_many(METADATA, {"c": {"file_size": 1}})
+    assert cache.get_many(VERSION, ["a", "b"]) == {"a": "a2"}
+    assert cache.get_many(METADATA, ["c"]) == {"c": {"file_size": 1}}
+
+    now[0] += 10
+    assert cache.get_many(VERSION, ["a"]) == {}
+    assert cache.get_many(VERSION, ["a"], expired=True) == {"a": "a2"}
+
+
+def test_metadata_cache_invalidate(tmp_path) -> None:
+    cache = MetadataCache(str(tmp_path / "cache.db"))
+    cache.put_many(VERSION, {"a": "a", "b": "b"})
+    cache.put_many(METADATA, {"a": {}})
+
+    assert cache.invalidate(["a"]) == 2
+    assert cache.get_many(VERSION, ["a", "b"]) == {"b": "b"}
+    assert cache.invalidate() == 1
+
+
+def test_latest_versions_cached(tmp_path, requests_mock) -> None:
+    url = "https://example.com"
+    requests_mock.post(url + "/files/versions", json=versions_callback)
+    cache = MetadataCache(str(tmp_path / "cache.db"))
+
+    assert get_latest_versions(url, ["1"], cache=cache) == {"1": "1_new"}
+    assert get_latest_versions(url, ["1", "2"], cache=cache) == {
+        "1": "1_new",
+        "2": "2_new",
+    }
+    assert requests_mock.request_history[-1].json() == {"ids": ["2"]}
+
+    calls = requests_mock.call_count
+    assert get_latest_versions(url, ["1", "3"], cache=cache, offline=True) == {
+        "1": "1_new",
+        "3": "3",
+    }
+    assert requests_mock.call_count == calls
@@ -10,6 +10,8 @@ import pytest
 
 import gdc_client.parcel.segment as segment
 import gdc_client.parcel.download_stream as stream
+import gdc_client.parcel.journal as journal
+import gdc_client.parcel.md5_tracker as md5_tracker
 import gdc_client.parcel.utils as utils
 
 directories_tuple = collections.namedtuple(
@@ -109,6 +111,11 @@ def mock_incomplete_state_file(
     )
 
 
+def finish_verification(producer: segment.SegmentProducer):
+    while producer.verifying:
+        producer.handle_message(producer.q_complete.get())
+
+
 def write_data_file(directory: pathlib.Path, file_name: str, data: bytes):
     file_path = directory.joinpath(file_name)
     with file_path.open("wb") as f:
@@ -191,3 +198,238 @@ def test_load_state_state_temp_exist(
     assert intervals[0].begin == len(incomplete_data.data)
     assert intervals[0].end == len(complete_data.data)
     assert producer.done == False
+
+
+@pytest.mark.usefixtures("mock_incomplete_state_file", "mock_temporary_file")
+def test_md5_tracker_resumes_from_verified_segments(
+    mock_download_stream: stream.DownloadStream,
+    complete_data: NamedTuple,
+    incomplete_data: NamedTuple,
+):
+    producer = segment.SegmentProducer(mock_download_stream, 2)
+    finish_verification(producer)
+    assert producer.md5_tracker.offset == len(incomplete_data.data)
+    assert producer.md5_tracker.hexdigest() is None
+
+    # finish the download out of band and report the remaining segment
+    with open(mock_download_stream.temp_path, "ab") as f:
+        f.write(complete_data.data[len(incomplete_data.data) :])
+    producer.completed.add(
+        intervaltree.Interval(len(incomplete_data.data), len(complete_data.data))
+    )
+    producer.md5_tracker.advance(producer.completed)
+    producer.md5_tracker.close()
+
+    assert producer.md5_tracker.hexdigest() == complete_data.md5sum
+
+
+@pytest.mark.usefixtures("mock_incomplete_state_file", "mock_temporary_file")
+def test_verification_feeds_md5_tracker(
+    monkeypatch,
+    mock_download_stream: stream.DownloadStream,
+    incomplete_data: NamedTuple,
+):
+    def read(self, end):
+        raise AssertionError("verified bytes read again")
+
+    monkeypatch.setattr(md5_tracker.Md5Tracker, "_read", read)
+    producer = segment.SegmentProducer(mock_download_stream, 2)
+    finish_verification(producer)
+
+    assert producer.md5_tracker.offset == len(incomplete_data.data)
+
+
+def test_validate_batched_segment_md5sums(
+    mock_download_stream: stream.DownloadStream, setup_directories: NamedTuple
+):
+    data = b"A" * 256 + b"B" * 256
+    write_data_file(setup_directories.data_directory, "test.txt.partial", data)
+    # the second chunk of the batch was not written correctly
+    md5sums = [utils.md5sum(b"A" * 256), utils.md5sum(b"C" * 256)]
+    completed = intervaltree.IntervalTree(
+        [intervaltree.Interval(0, 512, {"md5sums": md5sums, "chunk_size": 256})]
+    )
+    with setup_directories.state_directory.joinpath("test.txt.parcel").open("wb") as f:
+        pickle.dump(completed, f)
+
+    producer = segment.SegmentProducer(mock_download_stream, 2)
+    assert [(i.begin, i.end) for i in producer.work_pool] == [(512, 1024)]
+    finish_verification(producer)
+
+    assert [(i.begin, i.end) for i in producer.completed] == [(0, 256)]
+    assert sorted((i.begin, i.end) for i in producer.work_pool) == [
+        (256, 512),
+        (512, 1024),
+    ]
+    assert producer.size_complete == 256
+    assert producer.md5_tracker.offset == 256
+
+
+def test_journal_ignores_torn_record(tmp_path: pathlib.Path):
+    path = str(tmp_path.joinpath("test.txt.parcel"))
+    md5sums = [utils.md5sum(b"A" * 256), utils.md5sum(b"B" * 256)]
+    first = intervaltree.Interval(0, 512, {"md5sums": md5sums, "chunk_size": 256})
+    second = intervaltree.Interval(512, 768, {"md5sum": utils.md5sum(b"C" * 256)})
+
+    state = journal.Journal(path)
+    with open(path, "wb") as f:
+        state.write(f, intervaltree.IntervalTree())
+    state.reopen()
+    state.append([first, intervaltree.Interval(768, 800)])
+    state.append([second])
+    state.close()
+    # lose the end of the last record
+    with open(path, "r+b") as f:
+        f.truncate(os.path.getsize(path) - 3)
+
+    completed = journal.Journal(path).load()
+
+    assert sorted(completed.items()) == [first, intervaltree.Interval(768, 800)]
+
+
+def test_journal_compaction_merges_adjacent_chunks():
+    completed = intervaltree.IntervalTree(
+        [
+            intervaltree.Interval(0, 2, {"md5sums": ["a", "b"], "chunk_size": 1}),
+            intervaltree.Interval(2, 3, {"md5sum": "c"}),
+            intervaltree.Interval(5, 7, {"md5sums": ["d"], "chunk_size": 2}),
+        ]
+    )
+
+    assert journal.compact_intervals(completed) == [
+        intervaltree.Interval(0, 3, {"md5sums": ["a", "b", "c"], "chunk_size": 1}),
+        intervaltree.Interval(5, 7, {"md5sums": ["d"], "chunk_size": 2}),
+    ]
+
+
+@pytest.mark.usefixtures("mock_incomplete_state_file", "mock_temporary_file")
+def test_save_state_appends_to_journal(
+    mock_download_stream: stream.DownloadStream,
+    complete_data: NamedTuple,
+    incomplete_data: NamedTuple,
+):
+    producer = segment.SegmentProducer(mock_download_stream, 2)
+    # the first checkpoint replaces the pickled state with a journal
+    producer.save_state()
+    size = os.path.getsize(mock_download_stream.state_path)
+
+    with open(mock_download_stream.temp_path, "ab") as f:
+        f.write(complete_data.data[len(incomplete_data.data) :])
+    producer._complete_interval(
+        intervaltree.Interval(
+            len(incomplete_data.data),
+            len(complete_data.data),
+            {"md5sum": utils.md5sum(complete_data.data[len(incomplete_data.data) :])},
+        )
+    )
+    producer.save_state()
+    producer.journal.close()
+
+    assert os.path.getsize(mock_download_stream.state_path) > size
+    resumed = segment.SegmentProducer(mock_download_stream, 2)
+    finish_verification(resumed)
+    assert producer.integrate(resumed.completed) == len(complete_data.data)
+    assert resumed.md5_tracker.hexdigest() == complete_data.md5sum
+
+
+def test_md5_tracker_out_of_order(tmp_path: pathlib.Path):
+    path = tmp_path.joinpath("data")
+    path.write_bytes(b"0123456789")
+    tracker = md5_tracker.Md5Tracker(str(path), 10)
+    completed = intervaltree.IntervalTree()
+
+    completed.add(intervaltree.Interval(5, 10))
+    tracker.advance(completed)
+    assert tracker.offset == 0
+
+    completed.add(intervaltree.Interval(0, 5))
+    tracker.advance(completed)
+    tracker.close()
+    assert tracker.hexdigest() == utils.md5sum(b"0123456789")
+
+
+def test_md5_tracker_hashes_received_bytes(tmp_path: pathlib.Path):
+    path = tmp_path.joinpath("data")
+    # what is on disk is never read back while the received bytes fit
+    path.write_bytes(b"X" * 6 + b"6789")
+    tracker = md5_tracker.Md5Tracker(str(path), 10, buffer_size=6)
+    completed = intervaltree.IntervalTree()
+
+    for begin, data in [(3, b"345"), (0, b"012"), (6, b"6789")]:
+        tracker.add(begin, bytearray(data))
+        completed.add(intervaltree.Interval(begin, begin + len(data)))
+        tracker.advance(completed)
+    tracker.close()
+
+    assert tracker.offset == 10
+    assert tracker.hexdigest() == utils.md5sum(b"0123456789")
+
+
+@pytest.mark.skipif(
+    md5_tracker.ResumableMd5.libcrypto() is None, reason="needs libcrypto"
+)
+def test_md5_tracker_resumes_from_checkpoint(tmp_path: pathlib.Path):
+    path = tmp_path.joinpath("data")
+    path.write_bytes(b"XXXXX56789")
+    checkpoint = str(tmp_path.joinpath("data.md5"))
+    tracker = md5_tracker.Md5Tracker(str(path), 10, checkpoint_path=checkpoint)
+    tracker.update(b"01234")
+    tracker.save_checkpoint()
+
+    resumed = md5_tracker.Md5Tracker(str(path), 10, checkpoint_path=checkpoint)
+    assert resumed.load_checkpoint()
+    assert resumed.offset == 5
+    resumed.advance(intervaltree.IntervalTree([intervaltree.Interval(0, 10)]))
+    resumed.close()
+    assert resumed.hexdigest() == utils.md5sum(b"0123456789")
+
+    # a checkpoint of another file is ignored
+    other = md5_tracker.Md5Tracker(str(path), 11, checkpoint_path=checkpoint)
+    assert not other.load_checkpoint()
+    assert other.offset == 0
+
+
+def test_received_bytes_are_not_journaled(
+    mock_download_stream: stream.DownloadStream, complete_data: NamedTuple
+):
+    producer = segment.SegmentProducer(mock_download_stream, 2)
+    producer._complete_interval(
+        intervaltree.Interval(0, 1024, {"received": bytearray(complete_data.data)})
+    )
+
+    assert list(producer.completed) == [intervaltree.Interval(0, 1024)]
+    assert producer.md5_tracker.hexdigest() == complete_data.md5sum
+
+
+def test_schedule_splits_slow_segment(
+    monkeypatch, mock_download_stream: stream.DownloadStream
+):
+    monkeypatch.setattr(segment.SegmentProducer, "min_segment_size", 64)
+    producer = segment.SegmentProducer(mock_download_stream, 2)
+
+    first = producer._get_next_interval()
+    second = producer._get_next_interval()
+    assert (first.begin, first.end) == (0, 512)
+    assert (second.begin, second.end) == (512, 1024)
+    assert producer._get_next_interval() is None
+
+    # the first worker is slow, the second one finishes and goes idle
+    producer._complete_interval(intervaltree.Interval(0, 128))
+    for offset in range(512, 1024, 128):
+        producer._complete_interval(intervaltree.Interval(offset, offset + 128))
+    producer._finish_task(second.data)
+
+    stolen = producer._steal_interval()
+    assert (stolen.begin, stolen.end) == (320, 512)
+    assert producer.segment_limits[first.data] == 320
+    assert producer.in_flight[first.data].end == 320
+    assert producer.size_complete == 640
+
+
+def test_integrate_counts_overlap_once(
+    mock_download_stream: stream.DownloadStream,
+):
+    producer = segment.SegmentProducer(mock_download_stream, 2)
+    itree = intervaltree.IntervalTree.from_tuples([(0, 100), (50, 150), (200, 300)])
+
+    assert producer.integrate(itree) == 250